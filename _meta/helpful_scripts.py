@@ -1,17 +1,15 @@
-from db import models
+from db import orphans
 
 
 def find_headers_without_emails():
     """Find all headers that are not related to an email."""
-    headers = models.Header.objects.all()
-    for header in headers:
-        if len(header.email_set.all()) == 0:
-            print(header.id)
+    for checked_count, header_ids in orphans.find_orphans('headers'):
+        for header_id in header_ids:
+            print(header_id)
 
 
 def find_bodies_without_emails():
     """Find all bodies that are not related to an email."""
-    bodies = models.Body.objects.all()
-    for body in bodies:
-        if len(body.email_set.all()) == 0:
-            print(body.id)
+    for checked_count, body_ids in orphans.find_orphans('bodies'):
+        for body_id in body_ids:
+            print(body_id)
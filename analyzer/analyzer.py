@@ -6,7 +6,8 @@ from .external_analysis import analyze_externally
 
 
 def start_analysis(email_object, perform_external_analysis):
-    """Analyze the given email object."""
+    """Analyze the given email object. Returns whether or not the email was submitted for external analysis."""
     if perform_external_analysis:
         # the external analyses will be added later via API, hence they are not returned from this function
-        analyze_externally(email_object)
+        return analyze_externally(email_object)
+    return False
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Queue requests for the external analysis server in the database so they can be sent (and retried) by a worker."""
+
+import collections
+import contextlib
+import datetime
+import json
+import os
+import threading
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from db import blob_store
+from db.models import AnalysisJob, Body, Email, Header
+from utility.metrics import metrics
+
+# the number of seconds to wait before retrying a request the first time (this doubles with each attempt)
+RETRY_DELAY = 5
+# the maximum number of seconds to wait before retrying a request
+MAX_RETRY_DELAY = 60 * 60
+# the number of times to try sending a request before giving up on it
+MAX_ATTEMPTS = 20
+# the number of seconds to wait for the result of a sent request before sending it again (ZeroMQ accepting a message only means it was buffered, so a message can still be lost if the analysis server or the worker goes down)
+ACKNOWLEDGEMENT_TIMEOUT = int(os.environ.get('ANALYSIS_ACKNOWLEDGEMENT_TIMEOUT', 15 * 60))
+# the number of times to send a request whose result is never posted back before giving up on it
+MAX_DELIVERIES = 3
+# the routes whose results are always posted back, so their requests are kept until then (the analysis server does not post anything back for items without network data, so a 'network_data' request is done once it is sent, which only happens while the analysis server is connected - see `AnalysisSender`)
+ACKNOWLEDGED_ROUTES = ('analysis',)
+# the number of days requests which could not be sent are kept (so they can be looked into) before `delete_failed_jobs` deletes them
+FAILED_JOB_RETENTION_DAYS = int(os.environ.get('ANALYSIS_FAILED_JOB_RETENTION_DAYS', 7))
+
+_local = threading.local()
+
+
+def enqueue(job):
+    """Add the given (unsaved) AnalysisJob to the queue (or to the current batch)."""
+    jobs = getattr(_local, 'batch', None)
+    if jobs is not None:
+        jobs.append(job)
+    else:
+        job.first_seen = timezone.now()
+        AnalysisJob.objects.bulk_create([job])
+
+
+@contextlib.contextmanager
+def batch():
+    """Collect the jobs enqueued in this block and add them to the queue (with one query) when the block finishes."""
+    if getattr(_local, 'batch', None) is not None:
+        # this is a nested batch, so the jobs will be added by the outer batch
+        yield
+        return
+
+    _local.batch = []
+    try:
+        yield
+        jobs = _local.batch
+    finally:
+        _local.batch = None
+
+    if jobs:
+        with metrics.timer('queue_analysis'):
+            now = timezone.now()
+            for job in jobs:
+                job.first_seen = now
+            AnalysisJob.objects.bulk_create(jobs)
+
+
+def queue_depth():
+    """Return the number of requests waiting to be sent."""
+    return AnalysisJob.objects.filter(status=AnalysisJob.PENDING).count()
+
+
+def awaiting_results_count():
+    """Return the number of requests which were sent and whose results have not been posted back yet."""
+    return AnalysisJob.objects.filter(status=AnalysisJob.SENT).count()
+
+
+def failed_count():
+    """Return the number of requests which were given up on."""
+    return AnalysisJob.objects.filter(status=AnalysisJob.FAILED).count()
+
+
+def delete_failed_jobs(days=FAILED_JOB_RETENTION_DAYS, dry_run=False):
+    """Delete the requests which were given up on and were queued more than the given number of days ago (or only count them if dry_run is true) and return how many there were."""
+    jobs = AnalysisJob.objects.filter(
+        status=AnalysisJob.FAILED, first_seen__lt=timezone.now() - datetime.timedelta(days=days)
+    )
+    if dry_run:
+        return jobs.count()
+    return jobs.delete()[0]
+
+
+def acknowledge(route, item_ids):
+    """Remove the sent requests of the given route (one of the ACKNOWLEDGED_ROUTES) for the given items from the queue (this is called when their results are posted back to the api). Requests which have not been sent yet (e.g. a reanalysis) are kept."""
+    item_ids = list(item_ids)
+    if item_ids:
+        AnalysisJob.objects.filter(status=AnalysisJob.SENT, route=route, item_id__in=item_ids).delete()
+
+
+def _retry_delay(attempts):
+    return datetime.timedelta(seconds=min(RETRY_DELAY * 2 ** attempts, MAX_RETRY_DELAY))
+
+
+def _job_messages(jobs):
+    """Return the message for each of the given jobs (by job id) with the text read from the database. If the item for a job no longer exists, its message is None."""
+    item_ids = collections.defaultdict(set)
+    for job in jobs:
+        item_ids[job.item_type or job.route].add(job.item_id)
+
+    texts = {
+        'analysis': {
+            email_id: blob_store.read_full_text(full_text, blob_key)
+            for email_id, full_text, blob_key in Email.objects.filter(pk__in=item_ids['analysis']).values_list(
+                'id', 'full_text', 'blob_key'
+            )
+        },
+        'header': {
+            header_id: json.dumps(data)
+            for header_id, data in Header.objects.filter(pk__in=item_ids['header']).values_list('id', 'data')
+        },
+        # if the body content was base64 encoded, the decoded content is sent so that network data is parsed from the decoded content
+        'body': {
+            body_id: decoded_text or full_text
+            for body_id, full_text, decoded_text in Body.objects.filter(pk__in=item_ids['body']).values_list(
+                'id', 'full_text', 'decoded_text'
+            )
+        },
+    }
+
+    messages = {}
+    for job in jobs:
+        text = texts.get(job.item_type or job.route, {}).get(job.item_id)
+        if text is None:
+            messages[job.id] = None
+        elif job.route == 'analysis':
+            messages[job.id] = {'route': 'analysis', 'text': text, 'id': job.item_id}
+        else:
+            messages[job.id] = {
+                'route': job.route,
+                'type': job.item_type,
+                'text': text,
+                'id': job.item_id,
+                'email_id': job.email_id,
+            }
+    return messages
+
+
+def send_pending_jobs(sender, limit=100):
+    """Send up to `limit` of the queued requests which are due using the given AnalysisSender. The requests for each email are sent together. If the analysis server stops accepting requests, the remaining requests are retried later (with exponential backoff). Sent requests of the ACKNOWLEDGED_ROUTES stay in the queue until their results are posted back (see `acknowledge`) and are sent again if that does not happen within ACKNOWLEDGEMENT_TIMEOUT seconds (the other sent requests are removed from the queue). Returns the number of requests which were sent."""
+    with transaction.atomic():
+        jobs = list(
+            AnalysisJob.objects.select_for_update(skip_locked=True)
+            .filter(status__in=(AnalysisJob.PENDING, AnalysisJob.SENT), next_attempt__lte=timezone.now())
+            .order_by('next_attempt', 'id')[:limit]
+        )
+        if not jobs:
+            return 0
+
+        # requests which were sent MAX_DELIVERIES times without a result coming back are not sent again
+        undelivered_job_ids = [job.id for job in jobs if job.deliveries >= MAX_DELIVERIES]
+        if undelivered_job_ids:
+            AnalysisJob.objects.filter(id__in=undelivered_job_ids).update(status=AnalysisJob.FAILED)
+            jobs = [job for job in jobs if job.deliveries < MAX_DELIVERIES]
+
+        messages = _job_messages(jobs)
+        jobs_by_email = collections.OrderedDict()
+        for job in jobs:
+            jobs_by_email.setdefault(job.email_id, []).append(job)
+
+        # jobs for items which have been deleted are removed from the queue without being sent
+        deleted_item_job_ids = [job.id for job in jobs if messages[job.id] is None]
+        sent_job_ids = []
+        done_job_ids = []
+        sent_count = 0
+        failed_jobs = []
+        for email_jobs in jobs_by_email.values():
+            email_messages = [messages[job.id] for job in email_jobs if messages[job.id] is not None]
+            if not email_messages:
+                continue
+            # once the analysis server stops accepting requests, stop sending them
+            if failed_jobs or not sender.send_batch(email_messages):
+                failed_jobs.extend(job for job in email_jobs if messages[job.id] is not None)
+            else:
+                for job in email_jobs:
+                    if messages[job.id] is None:
+                        continue
+                    if job.route in ACKNOWLEDGED_ROUTES:
+                        sent_job_ids.append(job.id)
+                    else:
+                        done_job_ids.append(job.id)
+                sent_count += len(email_messages)
+
+        AnalysisJob.objects.filter(id__in=deleted_item_job_ids + done_job_ids).delete()
+        AnalysisJob.objects.filter(id__in=sent_job_ids).update(
+            status=AnalysisJob.SENT,
+            deliveries=F('deliveries') + 1,
+            next_attempt=timezone.now() + datetime.timedelta(seconds=ACKNOWLEDGEMENT_TIMEOUT),
+        )
+
+        jobs_by_attempts = collections.defaultdict(list)
+        for job in failed_jobs:
+            jobs_by_attempts[job.attempts].append(job.id)
+        for attempts, job_ids in jobs_by_attempts.items():
+            if attempts + 1 >= MAX_ATTEMPTS:
+                AnalysisJob.objects.filter(id__in=job_ids).update(attempts=F('attempts') + 1, status=AnalysisJob.FAILED)
+            else:
+                AnalysisJob.objects.filter(id__in=job_ids).update(
+                    status=AnalysisJob.PENDING,
+                    attempts=F('attempts') + 1,
+                    next_attempt=timezone.now() + _retry_delay(attempts),
+                )
+
+    return sent_count
@@ -2,45 +2,129 @@
 # -*- coding: utf-8 -*-
 """Submit email for analysis by external engines."""
 
+import contextlib
+import json
 import os
+import threading
 
 import zmq
 
+from . import analysis_queue
+from db.models import AnalysisJob
 from utility import utility
 
 EXTERNAL_ANALYSIS_ENDPOINT = 'tcp://{}'.format(os.environ.get('EXTERNAL_ANALYSIS_ENDPOINT'))
+# the maximum number of messages queued for the analysis server (messages sent while the queue is full are dropped rather than blocking the request)
+SEND_HIGH_WATER_MARK = 1000
+# the number of milliseconds queued messages are kept around for after the socket is closed
+SEND_LINGER = 1000
+# the number of milliseconds a new socket waits for the connection to the analysis server before the first messages are sent
+CONNECT_TIMEOUT = 1000
 
 
-def analyze_externally(email_object):
-    """Submit the given email object to external sources."""
-    if not utility.is_running_locally():
-        context = zmq.Context()
+class AnalysisSender(object):
+    """Send messages to the analysis server over one lazily created ZeroMQ PUSH socket per process. Messages are only queued on the socket while it is connected to the analysis server, so a message which cannot be delivered is not sent (rather than waiting in the memory of the process, where it would be lost if the process stopped)."""
+
+    def __init__(
+        self, endpoint, high_water_mark=SEND_HIGH_WATER_MARK, linger=SEND_LINGER, connect_timeout=CONNECT_TIMEOUT
+    ):
+        self.endpoint = endpoint
+        self.high_water_mark = high_water_mark
+        self.linger = linger
+        self.connect_timeout = connect_timeout
+        self.sent_count = 0
+        self.dropped_count = 0
+        self._context = None
+        self._socket = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_socket(self):
+        # zeromq contexts and sockets cannot be shared across a fork, so each process creates its own
+        if self._socket is None or self._pid != os.getpid():
+            self._context = zmq.Context()
+            self._socket = self._context.socket(zmq.PUSH)
+            self._socket.setsockopt(zmq.SNDHWM, self.high_water_mark)
+            self._socket.setsockopt(zmq.LINGER, self.linger)
+            # without this, messages sent while the analysis server is down would be queued until the high water mark is reached (and the requests would be removed from the analysis queue as if they had been sent)
+            self._socket.setsockopt(zmq.IMMEDIATE, 1)
+            self._socket.connect(self.endpoint)
+            self._pid = os.getpid()
+            # the socket can send messages once it is connected (which is when it is ready for output because of the IMMEDIATE option)
+            self._socket.poll(self.connect_timeout, zmq.POLLOUT)
+        return self._socket
+
+    def send_batch(self, messages):
+        """Send the given messages together as a single multipart message. Returns whether or not the messages were sent (they are not sent if the analysis server is not connected or the send queue is full)."""
+        frames = [json.dumps(message).encode('utf-8') for message in messages]
+        with self._lock:
+            try:
+                self._get_socket().send_multipart(frames, zmq.NOBLOCK)
+            except zmq.Again:
+                self.dropped_count += len(frames)
+                return False
+            else:
+                self.sent_count += len(frames)
+                return True
+
+    def send(self, message):
+        """Send the given message (or add it to the current batch)."""
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            batch.append(message)
+        else:
+            self.send_batch([message])
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Collect the messages sent in this block and send them together (as a single multipart message) when the block finishes."""
+        if getattr(self._local, 'batch', None) is not None:
+            # this is a nested batch, so the messages will be sent by the outer batch
+            yield
+            return
+
+        self._local.batch = []
+        try:
+            yield
+            messages = self._local.batch
+        finally:
+            self._local.batch = None
 
-        # Socket to send messages on
-        sender = context.socket(zmq.PUSH)
-        sender.connect(EXTERNAL_ANALYSIS_ENDPOINT)
+        if messages:
+            self.send_batch(messages)
 
-        data = {'route': 'analysis', 'text': """{}""".format(email_object.full_text), 'id': email_object.id}
+    def stats(self):
+        return {'sent': self.sent_count, 'dropped': self.dropped_count}
 
-        sender.send_json(data, zmq.NOBLOCK)
+    def close(self):
+        with self._lock:
+            if self._socket is not None and self._pid == os.getpid():
+                self._socket.close()
+                self._context.term()
+            self._socket = None
+            self._context = None
+
+
+analysis_sender = AnalysisSender(EXTERNAL_ANALYSIS_ENDPOINT)
+
+
+def batch():
+    """Collect the analysis requests made in this block and queue them together when the block finishes."""
+    return analysis_queue.batch()
+
+
+def analyze_externally(email_object):
+    """Submit the given email object to external sources. The request is queued and sent by the analysis worker (see the `analysis_worker` command). Returns whether or not the request was queued."""
+    if not utility.is_running_locally():
+        analysis_queue.enqueue(AnalysisJob(route='analysis', item_id=email_object.id, email_id=email_object.id))
+        return True
+    return False
 
 
 def find_network_data(text, item_id, item_type, email_id):
-    """Send the text to the analysis server to parse network data from it."""
+    """Send the text to the analysis server to parse network data from it. The request is queued and the text of the item is read from the database when the request is sent."""
     if not utility.is_running_locally():
-        context = zmq.Context()
-
-        # Socket to send messages on
-        sender = context.socket(zmq.PUSH)
-        sender.connect(EXTERNAL_ANALYSIS_ENDPOINT)
-
-        sender.send_json(
-            {
-                'route': 'network_data',
-                'type': item_type,
-                'text': """{}""".format(text),
-                'id': item_id,
-                'email_id': email_id,
-            },
-            zmq.NOBLOCK,
+        analysis_queue.enqueue(
+            AnalysisJob(route='network_data', item_type=item_type, item_id=item_id, email_id=email_id)
         )
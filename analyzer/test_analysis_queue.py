@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from db import db_creator
+from db.models import AnalysisJob, Email
+from email_processor import processor
+from test_resources import DefaultTestObject
+from utility import utility
+from .external_analysis import analysis_queue
+
+TestData = DefaultTestObject()
+
+
+class FakeSender(object):
+    def __init__(self, accept=True):
+        self.accept = accept
+        self.batches = []
+
+    def send_batch(self, messages):
+        if self.accept:
+            self.batches.append(messages)
+        return self.accept
+
+
+class AnalysisQueueTests(TestCase):
+    def setUp(self):
+        TestData.create_email()
+        self.email_id = TestData.email_id
+        self.header_id = Email.objects.get(pk=self.email_id).header.id
+
+    def _enqueue_jobs(self):
+        with analysis_queue.batch():
+            analysis_queue.enqueue(AnalysisJob(route='analysis', item_id=self.email_id, email_id=self.email_id))
+            analysis_queue.enqueue(
+                AnalysisJob(route='network_data', item_type='header', item_id=self.header_id, email_id=self.email_id)
+            )
+            assert analysis_queue.queue_depth() == 0
+
+    def test_jobs_for_an_email_are_sent_together(self):
+        self._enqueue_jobs()
+        assert analysis_queue.queue_depth() == 2
+
+        sender = FakeSender()
+        assert analysis_queue.send_pending_jobs(sender) == 2
+        assert len(sender.batches) == 1
+        assert [message['route'] for message in sender.batches[0]] == ['analysis', 'network_data']
+        assert sender.batches[0][0]['text'] == Email.objects.get(pk=self.email_id).full_text
+        assert analysis_queue.queue_depth() == 0
+        # the analysis job is kept until its result is posted back (the analysis server does not post anything back for items without network data, so the network data job is done)
+        assert analysis_queue.awaiting_results_count() == 1
+        assert list(AnalysisJob.objects.values_list('route', flat=True)) == ['analysis']
+
+    def test_jobs_for_a_batch_of_emails_are_queued_together(self):
+        email_texts = [
+            'Subject: queued email {}\nFrom: bob@gmail.com\n\nSee https://github.com/{}\n'.format(i, i)
+            for i in range(3)
+        ]
+        prepared_emails, results = processor.prepare_emails(email_texts)
+
+        original_is_running_locally = utility.is_running_locally
+        try:
+            utility.is_running_locally = lambda: False
+            with mock.patch.object(
+                AnalysisJob.objects, 'bulk_create', wraps=AnalysisJob.objects.bulk_create
+            ) as bulk_create:
+                db_creator.bulk_create_emails(prepared_emails, 'test')
+        finally:
+            utility.is_running_locally = original_is_running_locally
+
+        assert bulk_create.call_count == 1
+        email_ids = [email_id for email_id, status in results]
+        assert AnalysisJob.objects.filter(route='analysis', item_id__in=email_ids).count() == len(email_texts)
+
+    def test_sent_jobs_are_removed_when_their_results_are_posted(self):
+        self._enqueue_jobs()
+        analysis_queue.send_pending_jobs(FakeSender())
+
+        analysis_queue.acknowledge('analysis', [self.email_id])
+        assert not AnalysisJob.objects.exists()
+
+    def test_unacknowledged_jobs_are_sent_again(self):
+        self._enqueue_jobs()
+        sender = FakeSender()
+        assert analysis_queue.send_pending_jobs(sender) == 2
+        # the jobs are not sent again until the acknowledgement timeout passes
+        assert analysis_queue.send_pending_jobs(sender) == 0
+
+        # only the analysis job is sent again
+        for delivery in range(analysis_queue.MAX_DELIVERIES - 1):
+            AnalysisJob.objects.update(next_attempt=timezone.now())
+            assert analysis_queue.send_pending_jobs(sender) == 1
+        assert len(sender.batches) == analysis_queue.MAX_DELIVERIES
+        assert [message['route'] for message in sender.batches[-1]] == ['analysis']
+
+        # once the job has been sent MAX_DELIVERIES times, it is given up on
+        AnalysisJob.objects.update(next_attempt=timezone.now())
+        assert analysis_queue.send_pending_jobs(sender) == 0
+        assert analysis_queue.failed_count() == 1
+
+    def test_pending_jobs_are_not_acknowledged(self):
+        """Make sure a result posted for an earlier request does not remove a request which has not been sent yet (e.g. a reanalysis)."""
+        self._enqueue_jobs()
+        analysis_queue.acknowledge('analysis', [self.email_id])
+        assert analysis_queue.queue_depth() == 2
+
+    def test_failed_jobs_are_retried_later(self):
+        self._enqueue_jobs()
+
+        assert analysis_queue.send_pending_jobs(FakeSender(accept=False)) == 0
+        assert analysis_queue.queue_depth() == 2
+        for job in AnalysisJob.objects.all():
+            assert job.attempts == 1
+            assert job.next_attempt > timezone.now()
+
+        # the jobs are not due yet, so they are not sent
+        sender = FakeSender()
+        assert analysis_queue.send_pending_jobs(sender) == 0
+        AnalysisJob.objects.update(next_attempt=timezone.now())
+        assert analysis_queue.send_pending_jobs(sender) == 2
+
+    def test_jobs_fail_after_max_attempts(self):
+        self._enqueue_jobs()
+        AnalysisJob.objects.update(attempts=analysis_queue.MAX_ATTEMPTS - 1)
+
+        analysis_queue.send_pending_jobs(FakeSender(accept=False))
+        assert analysis_queue.queue_depth() == 0
+        assert analysis_queue.failed_count() == 2
+
+    def test_old_failed_jobs_are_deleted(self):
+        self._enqueue_jobs()
+        AnalysisJob.objects.update(status=AnalysisJob.FAILED)
+        AnalysisJob.objects.filter(route='analysis').update(
+            first_seen=timezone.now() - datetime.timedelta(days=analysis_queue.FAILED_JOB_RETENTION_DAYS + 1)
+        )
+
+        assert analysis_queue.delete_failed_jobs(dry_run=True) == 1
+        assert analysis_queue.failed_count() == 2
+        assert analysis_queue.delete_failed_jobs() == 1
+        assert list(AnalysisJob.objects.values_list('route', flat=True)) == ['network_data']
+        assert analysis_queue.delete_failed_jobs(days=0) == 1
+
+    def test_jobs_for_deleted_items_are_removed(self):
+        analysis_queue.enqueue(AnalysisJob(route='analysis', item_id='missing', email_id='missing'))
+        sender = FakeSender()
+        assert analysis_queue.send_pending_jobs(sender) == 0
+        assert sender.batches == []
+        assert analysis_queue.queue_depth() == 0
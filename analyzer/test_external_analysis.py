@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import zmq
+
+from .external_analysis.external_analysis import AnalysisSender
+
+
+def _receiver():
+    context = zmq.Context()
+    receiver = context.socket(zmq.PULL)
+    receiver.setsockopt(zmq.RCVTIMEO, 5000)
+    port = receiver.bind_to_random_port('tcp://127.0.0.1')
+    return receiver, 'tcp://127.0.0.1:{}'.format(port)
+
+
+def test_sender_reuses_socket():
+    receiver, endpoint = _receiver()
+    sender = AnalysisSender(endpoint)
+
+    sender.send({'id': 1})
+    socket = sender._socket
+    sender.send({'id': 2})
+    assert sender._socket is socket
+
+    assert receiver.recv_json() == {'id': 1}
+    assert receiver.recv_json() == {'id': 2}
+    assert sender.stats() == {'sent': 2, 'dropped': 0}
+    sender.close()
+
+
+def test_sender_batch():
+    """Make sure the messages sent in a batch are sent together as one multipart message."""
+    receiver, endpoint = _receiver()
+    sender = AnalysisSender(endpoint)
+
+    with sender.batch():
+        sender.send({'id': 1})
+        with sender.batch():
+            sender.send({'id': 2})
+        assert sender.stats()['sent'] == 0
+        sender.send({'id': 3})
+
+    assert [frame for frame in receiver.recv_multipart()] == [b'{"id": 1}', b'{"id": 2}', b'{"id": 3}']
+    assert sender.stats() == {'sent': 3, 'dropped': 0}
+    sender.close()
+
+
+def test_sender_batch_with_error():
+    """Make sure nothing is sent if there is an error in the batch."""
+    receiver, endpoint = _receiver()
+    sender = AnalysisSender(endpoint)
+
+    try:
+        with sender.batch():
+            sender.send({'id': 1})
+            raise ValueError
+    except ValueError:
+        pass
+
+    sender.send({'id': 2})
+    assert receiver.recv_json() == {'id': 2}
+    assert sender.stats() == {'sent': 1, 'dropped': 0}
+    sender.close()
+
+
+def test_sender_drops_messages_when_full():
+    receiver, endpoint = _receiver()
+    # the receiver does not read the messages, so they are queued until the high water marks are reached
+    receiver.setsockopt(zmq.RCVHWM, 1)
+    sender = AnalysisSender(endpoint, high_water_mark=1, linger=0)
+    for i in range(1000):
+        sender.send({'id': i})
+    assert sender.stats()['dropped'] > 0
+    assert sender.stats()['sent'] + sender.stats()['dropped'] == 1000
+    sender.close()
+
+
+def test_sender_does_not_queue_messages_without_a_connection():
+    """Make sure messages are not queued in memory while nothing is listening (so the requests stay in the analysis queue)."""
+    sender = AnalysisSender('tcp://127.0.0.1:9', linger=0, connect_timeout=100)
+    assert not sender.send_batch([{'id': 1}])
+    assert sender.stats() == {'sent': 0, 'dropped': 1}
+    sender.close()
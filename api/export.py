@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Export the emails (and, optionally, the data related to them) as newline delimited JSON."""
+
+import collections
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from db.blob_store import read_full_text
+from db.models import Email, Header, Analysis
+from db.network_data import NETWORK_DATA_TYPES, network_data_values
+
+# the data related to the emails which can be included in an export
+EXPORT_INCLUDES = ('header', 'bodies', 'attachments', 'analyses', 'network_data')
+# the number of emails whose related data is found with each set of queries
+EXPORT_CHUNK_SIZE = 500
+
+EMAIL_FIELDS = (
+    'id',
+    'cleaned_id',
+    'full_text',
+    'structure',
+    'first_seen',
+    'modified',
+    'tlsh_hash',
+    'score',
+    'header_id',
+)
+HEADER_FIELDS = ('id', 'data')
+BODY_FIELDS = ('id', 'content_type', 'full_text', 'decoded_text', 'first_seen')
+ATTACHMENT_FIELDS = ('id', 'content_type', 'filename', 'md5', 'sha1', 'size', 'full_text', 'first_seen', 'modified')
+ANALYSIS_FIELDS = ('source', 'score', 'notes', 'first_seen')
+
+
+def parse_export_datetime(value):
+    """Return the datetime for the given date or datetime string (or None if it is not valid). Dates are the start of the day and datetimes without a timezone are in the current timezone."""
+    try:
+        date = parse_datetime(value)
+        if date is None:
+            day = parse_date(value)
+            if day is None:
+                return None
+            date = datetime.datetime.combine(day, datetime.time())
+    except ValueError:
+        return None
+
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return date
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _related_values(through_model, email_ids, related_field_name, fields):
+    """Return the given fields of the objects related to the given emails through the given many-to-many table (by email id)."""
+    related_values = collections.defaultdict(list)
+    rows = (
+        through_model.objects.filter(email_id__in=email_ids)
+        .order_by('id')
+        .values('email_id', *['{}__{}'.format(related_field_name, field_name) for field_name in fields])
+    )
+    for row in rows:
+        related_values[row['email_id']].append(
+            {field_name: row['{}__{}'.format(related_field_name, field_name)] for field_name in fields}
+        )
+    return related_values
+
+
+def _with_full_text(items):
+    """Return the given bodies or attachments with the full text of those whose full text is in the blob store read from it."""
+    for item in items:
+        item['full_text'] = read_full_text(item['full_text'], item.pop('blob_key'))
+    return items
+
+
+def _network_data(emails, body_ids):
+    """Return the network data in the header and bodies of each of the given emails (by email id)."""
+    header_ids = {email['header_id'] for email in emails}
+    all_body_ids = {body_id for email_body_ids in body_ids.values() for body_id in email_body_ids}
+
+    network_data = {email['id']: collections.OrderedDict() for email in emails}
+    for network_data_type, (model, value_field_name, in_headers) in NETWORK_DATA_TYPES.items():
+        values = collections.defaultdict(list)
+        if in_headers:
+            for header_id, network_data_id, value in network_data_values(
+                model, value_field_name, 'headers', header_ids
+            ):
+                values[header_id].append(value)
+        for body_id, network_data_id, value in network_data_values(model, value_field_name, 'bodies', all_body_ids):
+            values[body_id].append(value)
+
+        for email in emails:
+            email_values = []
+            for item_id in [email['header_id']] + body_ids[email['id']]:
+                email_values.extend(value for value in values[item_id] if value not in email_values)
+            network_data[email['id']][network_data_type] = email_values
+    return network_data
+
+
+def _export_chunk(emails, include):
+    """Return the export of each of the given emails (which are dicts of the EMAIL_FIELDS and their blob keys) with the given related data."""
+    email_ids = [email['id'] for email in emails]
+
+    headers = {}
+    if 'header' in include:
+        headers = {
+            header['id']: header
+            for header in Header.objects.filter(id__in={email['header_id'] for email in emails}).values(*HEADER_FIELDS)
+        }
+
+    bodies = {}
+    body_ids = {}
+    if 'bodies' in include or 'network_data' in include:
+        body_fields = BODY_FIELDS + ('blob_key',) if 'bodies' in include else ('id',)
+        bodies = _related_values(Email.bodies.through, email_ids, 'body', body_fields)
+        body_ids = {email_id: [body['id'] for body in bodies[email_id]] for email_id in email_ids}
+
+    attachments = {}
+    if 'attachments' in include:
+        attachments = _related_values(
+            Email.attachments.through, email_ids, 'attachment', ATTACHMENT_FIELDS + ('blob_key',)
+        )
+
+    analyses = collections.defaultdict(list)
+    if 'analyses' in include:
+        for analysis in (
+            Analysis.objects.filter(email_id__in=email_ids).order_by('id').values('email_id', *ANALYSIS_FIELDS)
+        ):
+            analyses[analysis.pop('email_id')].append(analysis)
+
+    network_data = {}
+    if 'network_data' in include:
+        network_data = _network_data(emails, body_ids)
+
+    for email in emails:
+        email['full_text'] = read_full_text(email['full_text'], email['blob_key'])
+        export = collections.OrderedDict((field_name, email[field_name]) for field_name in EMAIL_FIELDS)
+        if 'header' in include:
+            export['header'] = headers.get(email['header_id'])
+        if 'bodies' in include:
+            # the blobs are only read for one email at a time so that no more than one email's blobs are in memory
+            export['bodies'] = _with_full_text(bodies.pop(email['id'], []))
+        if 'attachments' in include:
+            export['attachments'] = _with_full_text(attachments.pop(email['id'], []))
+        if 'analyses' in include:
+            export['analyses'] = analyses[email['id']]
+        if 'network_data' in include:
+            export['network_data'] = network_data[email['id']]
+        yield export
+
+
+def export_emails(emails, include=()):
+    """Yield each of the given emails (in the order they were modified) as a line of JSON with the given related data (see EXPORT_INCLUDES). The emails are read using a server-side cursor and the related data is found for a chunk of emails at a time so that the export never holds more than one chunk in memory."""
+    rows = emails.order_by('modified', 'id').values('blob_key', *EMAIL_FIELDS).iterator()
+    for chunk in _chunks(rows, EXPORT_CHUNK_SIZE):
+        for export in _export_chunk(chunk, include):
+            yield json.dumps(export, cls=DjangoJSONEncoder) + '\n'
@@ -13,9 +13,38 @@ class EmailSerializer(serializers.ModelSerializer):
         fields = ('full_text', 'id', 'tlsh_hash')
         read_only_fields = ('full_text', 'id')
 
+    full_text = serializers.CharField(source='text', read_only=True)
     tlsh_hash = serializers.CharField(max_length=70, required=False)
 
 
+class EmailListSerializer(serializers.ModelSerializer):
+    """Handle the emails in list responses. Only the summary fields are included unless other fields (e.g. the full text) are given as the `fields` argument."""
+
+    summary_fields = ('id', 'header', 'first_seen', 'modified', 'score', 'tlsh_hash')
+
+    full_text = serializers.CharField(source='text', read_only=True)
+
+    class Meta:
+        model = Email
+        fields = (
+            'id',
+            'header',
+            'first_seen',
+            'modified',
+            'score',
+            'tlsh_hash',
+            'cleaned_id',
+            'structure',
+            'full_text',
+        )
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None) or self.summary_fields
+        super(EmailListSerializer, self).__init__(*args, **kwargs)
+        for field_name in set(self.fields) - set(fields):
+            self.fields.pop(field_name)
+
+
 class EmailCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Email
@@ -52,15 +81,19 @@ class HeaderVotesSerializer(serializers.ModelSerializer):
 
 
 class BodySerializer(serializers.ModelSerializer):
+    full_text = serializers.CharField(source='text', read_only=True)
+
     class Meta:
         model = Body
         fields = ('full_text', 'id')
 
 
 class AttachmentSerializer(serializers.ModelSerializer):
+    full_text = serializers.CharField(source='text', read_only=True)
+
     class Meta:
         model = Attachment
-        fields = ('full_text', 'id', 'content_type', 'filename', 'md5', 'sha1', 'sha256')
+        fields = ('full_text', 'id', 'content_type', 'filename', 'md5', 'sha1', 'sha256', 'size')
 
 
 class DomainSerializer(serializers.ModelSerializer):
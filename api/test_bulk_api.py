@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+
+from rest_framework.test import APITestCase
+
+from .api_test_utility import get_user_token
+from db.models import Email, EmailAddress, Host, IPAddress, Url
+from utility import utility
+from test_resources import DefaultTestObject
+
+TestData = DefaultTestObject()
+
+
+class EmailBulkAPITests(APITestCase):
+    def setUp(self):
+        self.token = get_user_token()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def test_bulk_email_creation(self):
+        data = [{'full_text': TestData.email_text}, {'full_text': TestData.delivered_to_email_text}]
+        response = self.client.post('/api/v1/emails/bulk/?localTest=1', data, format='json')
+
+        assert response.status_code == 201
+        assert [result['status'] for result in response.data['results']] == ['created', 'created']
+        assert response.data['results'][0]['id'] == TestData.email_id
+        assert Email.objects.count() == 2
+
+    def test_bulk_email_creation_matches_single_creation(self):
+        """Make sure an email created in bulk is the same as one created through the standard endpoint."""
+        self.client.post('/api/v1/emails/?localTest=1', {'full_text': TestData.email_text})
+        email = Email.objects.get(pk=TestData.email_id)
+        email_data = (email.cleaned_id, email.full_text, email.header.id, email.structure)
+        body_ids = sorted(body.id for body in email.bodies.all())
+        Email.objects.all().delete()
+
+        self.client.post('/api/v1/emails/bulk/?localTest=1', [{'full_text': TestData.email_text}], format='json')
+        email = Email.objects.get(pk=TestData.email_id)
+        assert (email.cleaned_id, email.full_text, email.header.id, email.structure) == email_data
+        assert sorted(body.id for body in email.bodies.all()) == body_ids
+
+    def test_bulk_email_duplicates(self):
+        data = [{'full_text': TestData.email_text}, {'full_text': TestData.email_text}]
+        response = self.client.post('/api/v1/emails/bulk/?localTest=1', data, format='json')
+        assert [result['status'] for result in response.data['results']] == ['created', 'duplicate']
+
+        response = self.client.post('/api/v1/emails/bulk/?localTest=1', data[:1], format='json')
+        assert response.status_code == 200
+        assert response.data['results'] == [{'id': TestData.email_id, 'status': 'duplicate'}]
+        assert Email.objects.count() == 1
+
+    def test_bulk_invalid_emails(self):
+        data = [
+            {'full_text': 'this is not an email'},
+            {'text': TestData.email_text},
+            {'full_text': TestData.email_text},
+        ]
+        response = self.client.post('/api/v1/emails/bulk/?localTest=1', data, format='json')
+        assert [result['status'] for result in response.data['results']] == ['invalid', 'invalid', 'created']
+        assert response.data['results'][0]['id'] is None
+
+    def test_bulk_ndjson(self):
+        data = '\n'.join(json.dumps({'full_text': text}) for text in (TestData.email_text, TestData.email_text))
+        response = self.client.post('/api/v1/emails/bulk/?localTest=1', data, content_type='application/x-ndjson')
+        assert response.status_code == 201
+        assert [result['status'] for result in response.data['results']] == ['created', 'duplicate']
+
+    def test_bulk_requires_a_list(self):
+        response = self.client.post(
+            '/api/v1/emails/bulk/?localTest=1', {'full_text': TestData.email_text}, format='json'
+        )
+        assert response.status_code == 400
+
+    def test_bulk_redaction_values(self):
+        """Make sure the redaction values can be given as a list or as a comma separated string."""
+        email_text = 'Subject: Hi\nFrom: bob@gmail.com\nTo: alice@example.com\n\nMeet me at Acme in Springfield\n'
+        for redaction_values in (['Acme', 'Springfield'], 'Acme,Springfield'):
+            Email.objects.all().delete()
+            data = {'emails': [{'full_text': email_text}], 'redaction_values': redaction_values}
+            response = self.client.post('/api/v1/emails/bulk/?localTest=1', data, format='json')
+
+            assert response.status_code == 201
+            assert 'Meet me at REDACTED in REDACTED' in Email.objects.get().full_text
+
+    def test_bulk_invalid_redaction_values(self):
+        data = {'emails': [{'full_text': TestData.email_text}], 'redaction_values': {'Acme': True}}
+        response = self.client.post('/api/v1/emails/bulk/?localTest=1', data, format='json')
+        assert response.status_code == 400
+        assert not Email.objects.exists()
+
+
+class NetworkDataBulkAPITests(APITestCase):
+    def setUp(self):
+        self.token = get_user_token()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        self.client.post('/api/v1/emails/?localTest=1', {'full_text': TestData.email_text})
+        email = Email.objects.all()[0]
+        self.header_id = email.header.id
+        self.body_id = email.bodies.all()[0].id
+
+    def test_bulk_domain_creation(self):
+        data = [
+            {'host_name': 'example.com', 'bodies': [self.body_id], 'headers': [self.header_id]},
+            {'host_name': 'example.org', 'bodies': [self.body_id]},
+            {'host_name': 'example.com', 'bodies': [self.body_id], 'headers': []},
+            {'bodies': [self.body_id]},
+        ]
+        response = self.client.post('/api/v1/domains/bulk/', data, format='json')
+        assert response.status_code == 201
+        assert response.data['results'] == [
+            {'id': 'example.com', 'status': 'created'},
+            {'id': 'example.org', 'status': 'created'},
+            {'id': 'example.com', 'status': 'created'},
+            {'id': None, 'status': 'invalid'},
+        ]
+        host = Host.objects.get(host_name='example.com')
+        assert [header.id for header in host.headers.all()] == [self.header_id]
+        assert [body.id for body in host.bodies.all()] == [self.body_id]
+
+        # posting existing domains updates them and skips links to headers/bodies which do not exist
+        response = self.client.post(
+            '/api/v1/domains/bulk/',
+            [{'host_name': 'example.org', 'headers': [self.header_id, 'a' * 64]}],
+            format='json',
+        )
+        assert response.status_code == 200
+        assert response.data['results'] == [{'id': 'example.org', 'status': 'updated'}]
+        assert Host.objects.get(host_name='example.org').modified > Host.objects.get(host_name='example.com').modified
+        assert [header.id for header in Host.objects.get(host_name='example.org').headers.all()] == [self.header_id]
+
+    def test_bulk_ip_address_creation(self):
+        data = [{'ip_address': '1.2.3.4', 'headers': [self.header_id]}, {'ip_address': '5.6.7.8' * 5}]
+        response = self.client.post('/api/v1/ipAddresses/bulk/', data, format='json')
+        assert [result['status'] for result in response.data['results']] == ['created', 'invalid']
+        assert IPAddress.objects.get(ip_address='1.2.3.4').headers.all()[0].id == self.header_id
+
+    def test_bulk_email_address_creation(self):
+        data = [
+            {'email_address': 'alice@example.com', 'bodies': [self.body_id]},
+            {'email_address': 'bob@[192.168.0.1]', 'headers': [self.header_id]},
+        ]
+        response = self.client.post('/api/v1/emailAddresses/bulk/', data, format='json')
+        assert [result['status'] for result in response.data['results']] == ['created', 'created']
+
+        # the hosts and ip addresses of the email addresses are created like they are for a single email address
+        email_address = EmailAddress.objects.get(email_address='alice@example.com')
+        assert email_address.host.host_name == 'example.com'
+        assert email_address.bodies.all()[0].id == self.body_id
+        assert EmailAddress.objects.get(email_address='bob@[192.168.0.1]').ip_address.ip_address == '192.168.0.1'
+
+    def test_bulk_url_creation(self):
+        data = [{'url': TestData.url, 'bodies': [self.body_id], 'headers': [self.header_id]}]
+        response = self.client.post('/api/v1/urls/bulk/', data, format='json')
+        assert response.data['results'] == [{'id': utility.sha256(TestData.url), 'status': 'created'}]
+
+        url = Url.objects.get(id=utility.sha256(TestData.url))
+        assert url.url == TestData.url
+        assert url.host.host_name == 'example.com'
+        assert url.bodies.all()[0].id == self.body_id
+
+    def network_data_rows(self):
+        return (
+            list(Host.objects.order_by('host_name').values_list('host_name', flat=True)),
+            list(IPAddress.objects.order_by('ip_address').values_list('ip_address', flat=True)),
+            list(
+                EmailAddress.objects.order_by('email_address').values_list('email_address', 'host_id', 'ip_address_id')
+            ),
+            list(Url.objects.order_by('id').values_list('id', 'url', 'host_id', 'ip_address_id')),
+        )
+
+    def test_bulk_network_data_matches_single_creation(self):
+        """Make sure network data created in bulk is the same as network data created through the standard endpoints."""
+        self.client.post('/api/v1/emailAddresses/', {'email_address': TestData.email_address, 'bodies': [self.body_id]})
+        self.client.post('/api/v1/urls/', {'url': TestData.url, 'bodies': [self.body_id]})
+        single_data = self.network_data_rows()
+        for model in (Host, IPAddress, EmailAddress, Url):
+            model.objects.all().delete()
+
+        self.client.post(
+            '/api/v1/emailAddresses/bulk/',
+            [{'email_address': TestData.email_address, 'bodies': [self.body_id]}],
+            format='json',
+        )
+        self.client.post('/api/v1/urls/bulk/', [{'url': TestData.url, 'bodies': [self.body_id]}], format='json')
+        assert self.network_data_rows() == single_data
+
+    def test_bulk_network_data_errors(self):
+        response = self.client.post('/api/v1/domains/bulk/', {'host_name': 'example.com'}, format='json')
+        assert response.status_code == 400
@@ -126,6 +126,34 @@ class BadEmailTests(APITestCase):
 
 
 class HeaderVotesTests(APITestCase):
+    def test_header_votes_counted(self):
+        header = Header.objects.get(pk=TestData.create_email().header.id)
+        vote_url = '/api/v1/headers/{}/vote/'.format(header.id)
+
+        for value in ['suspicious', 'not suspicious', 'suspicious']:
+            response = self.client.put(vote_url, {'value': value, 'type': 'subject'})
+            assert response.status_code == 201
+
+        updated_header = Header.objects.get(pk=header.id)
+        assert updated_header.subject_suspicious_votes == 2
+        assert updated_header.subject_not_suspicious_votes == 1
+        # voting only changes the vote counts
+        assert updated_header.modified == header.modified
+        assert updated_header.data == header.data
+
+        # votes counted by other requests are not overwritten by a stale copy of the header
+        stale_header = Header.objects.get(pk=header.id)
+        self.client.put(vote_url, {'value': 'suspicious', 'type': 'subject'})
+        self.client.put(vote_url, {'value': 'suspicious', 'type': 'subject'})
+        assert stale_header.subject_suspicious_votes == 2
+        assert Header.objects.get(pk=header.id).subject_suspicious_votes == 4
+
+    def test_header_votes_missing_header(self):
+        response = self.client.put(
+            '/api/v1/headers/{}/vote/'.format('a' * 64), {'value': 'suspicious', 'type': 'subject'}
+        )
+        assert response.status_code == 404
+
     def test_header_votes_simple(self):
         response = self.client.post('/api/v1/emails/?localTest=1', {'full_text': TestData.email_text})
         assert response.status_code == 201
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from .api_test_utility import get_user_token
+from api import export
+from db.models import Analysis, Email, Host
+from test_resources import DefaultTestObject
+
+TestData = DefaultTestObject()
+
+
+class EmailExportAPITests(APITestCase):
+    def setUp(self):
+        self.token = get_user_token()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def export(self, query_string=''):
+        response = self.client.get('/api/v1/emails/export/{}'.format(query_string))
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'application/x-ndjson'
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode('utf-8').splitlines()]
+
+    def test_email_export(self):
+        data = [{'full_text': TestData.email_text}, {'full_text': TestData.delivered_to_email_text}]
+        self.client.post('/api/v1/emails/bulk/?localTest=1', data, format='json')
+
+        exported_emails = self.export()
+        assert sorted(email['id'] for email in exported_emails) == sorted(Email.objects.values_list('id', flat=True))
+        email = Email.objects.get(pk=exported_emails[0]['id'])
+        assert exported_emails[0]['full_text'] == email.full_text
+        assert exported_emails[0]['header_id'] == email.header.id
+        assert 'bodies' not in exported_emails[0]
+
+    def test_email_export_includes(self):
+        self.client.post('/api/v1/emails/?localTest=1', {'full_text': TestData.email_text})
+        email = Email.objects.get(pk=TestData.email_id)
+        body = email.bodies.all()[0]
+        Analysis(email=email, source='test', notes='a note').save()
+        host = Host.objects.create(host_name='example.com')
+        host.headers.add(email.header)
+        host.bodies.add(body)
+
+        exported_email = self.export('?include=header,bodies,attachments,analyses,network_data')[0]
+        assert exported_email['header'] == {'id': email.header.id, 'data': email.header.data}
+        assert [exported_body['id'] for exported_body in exported_email['bodies']] == [body.id]
+        assert exported_email['bodies'][0]['full_text'] == body.full_text
+        assert exported_email['attachments'] == []
+        assert [analysis['notes'] for analysis in exported_email['analyses']] == ['a note']
+        assert exported_email['network_data'] == {
+            'hosts': ['example.com'],
+            'ip_addresses': [],
+            'email_addresses': [],
+            'urls': [],
+        }
+
+    def test_email_export_modified_filters(self):
+        data = [{'full_text': TestData.email_text}, {'full_text': TestData.delivered_to_email_text}]
+        self.client.post('/api/v1/emails/bulk/?localTest=1', data, format='json')
+        old_email = Email.objects.get(pk=TestData.email_id)
+        Email.objects.filter(pk=old_email.id).update(modified=timezone.now() - datetime.timedelta(days=10))
+        cutoff = (timezone.now() - datetime.timedelta(days=1)).date().isoformat()
+
+        assert [email['id'] for email in self.export('?until={}'.format(cutoff))] == [old_email.id]
+        assert old_email.id not in [email['id'] for email in self.export('?since={}'.format(cutoff))]
+        assert len(self.export('?since={}'.format(cutoff))) == 1
+
+    def test_email_export_in_chunks(self):
+        data = [{'full_text': TestData.email_text}, {'full_text': TestData.delivered_to_email_text}]
+        self.client.post('/api/v1/emails/bulk/?localTest=1', data, format='json')
+
+        original_chunk_size = export.EXPORT_CHUNK_SIZE
+        export.EXPORT_CHUNK_SIZE = 1
+        try:
+            exported_emails = self.export('?include=bodies,network_data')
+        finally:
+            export.EXPORT_CHUNK_SIZE = original_chunk_size
+        assert len(exported_emails) == 2
+        assert all(len(email['bodies']) > 0 for email in exported_emails)
+
+    def test_email_export_errors(self):
+        response = self.client.get('/api/v1/emails/export/?since=yesterday')
+        assert response.status_code == 400
+        response = self.client.get('/api/v1/emails/export/?include=bodies,passwords')
+        assert response.status_code == 400
+        assert 'passwords' in response.data['result']
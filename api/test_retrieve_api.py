@@ -21,9 +21,21 @@ class EmailAPITests(APITestCase):
         assert response.status_code == 200
         assert len(response.data) == 1
         assert response.data[0]['id'] == new_email.id
-        assert "full_text" in response.data[0].keys()
+        # the full text is not included in list responses unless it is requested
+        assert "full_text" not in response.data[0].keys()
+        assert response.data[0]['header'] == new_email.header.id
         assert response.data[0]['id'] == new_email.id
 
+    def test_emails_list_fields(self):
+        new_email = TestData.create_email()
+        response = self.client.get('/api/v1/emails/?fields=id,full_text')
+        assert response.status_code == 200
+        assert response.data[0] == {'id': new_email.id, 'full_text': new_email.full_text}
+
+        response = self.client.get('/api/v1/emails/?fields=id,password')
+        assert response.status_code == 400
+        assert 'password' in response.data['result']
+
     def test_emails_list_b(self):
         new_objects = TestData.create_emails_with_same_header(count=6)
         response = self.client.get('/api/v1/emails/')
@@ -170,7 +182,7 @@ class BodyAPITests(APITestCase):
 
     def test_related_email(self):
         new_email = TestData.create_email()
-        response = self.client.get('/api/v1/bodies/{}/emails/'.format(new_email.bodies.all()[0].id))
+        response = self.client.get('/api/v1/bodies/{}/emails/?fields=id,full_text'.format(new_email.bodies.all()[0].id))
         assert response.status_code == 200
         assert len(response.data) == 1
 
@@ -207,7 +219,9 @@ class AttachmentAPITest(APITestCase):
 
     def test_related_email(self):
         new_email = TestData.create_email(TestData.attachment_email_text)
-        response = self.client.get('/api/v1/attachments/{}/emails/'.format(new_email.attachments.all()[0].id))
+        response = self.client.get(
+            '/api/v1/attachments/{}/emails/?fields=id,full_text'.format(new_email.attachments.all()[0].id)
+        )
         assert response.status_code == 200
         assert len(response.data) == 1
 
@@ -5,6 +5,8 @@ from api import views
 app_name = 'api'
 urlpatterns = [
     url(r'^emails/$', views.EmailBase.as_view()),
+    url(r'^emails/bulk/$', views.EmailBulk.as_view(), name='email_bulk'),
+    url(r'^emails/export/$', views.EmailExport.as_view(), name='email_export'),
     url(r'^emails/(?P<pk>[0-9a-f]{64})/$', views.EmailDetail.as_view(), name='email_details'),
     url(r'^emails/(?P<pk>[0-9a-f]{64})/header/$', views.EmailHeader.as_view()),
     url(r'^emails/(?P<pk>[0-9a-f]{64})/bodies/$', views.EmailBodies.as_view()),
@@ -14,11 +16,17 @@ urlpatterns = [
     url(r'^headers/(?P<pk>[0-9a-f]{64})/emails/$', views.HeaderEmails.as_view()),
     url(r'^headers/(?P<pk>[0-9a-f]{64})/vote/$', views.HeaderVotes.as_view()),
     url(r'^bodies/(?P<pk>[0-9a-f]{64})/$', views.BodyDetail.as_view()),
+    url(r'^bodies/(?P<pk>[0-9a-f]{64})/content/$', views.BodyContent.as_view()),
     url(r'^bodies/(?P<pk>[0-9a-f]{64})/emails/$', views.BodyEmails.as_view()),
     url(r'^attachments/(?P<pk>[0-9a-f]{64})/$', views.AttachmentDetail.as_view()),
+    url(r'^attachments/(?P<pk>[0-9a-f]{64})/content/$', views.AttachmentContent.as_view()),
     url(r'^attachments/(?P<pk>[0-9a-f]{64})/emails/$', views.AttachmentEmails.as_view()),
     url(r'^domains/$', views.DomainBase.as_view()),
+    url(r'^domains/bulk/$', views.DomainBulk.as_view()),
     url(r'^emailAddresses/$', views.EmailAddressBase.as_view()),
+    url(r'^emailAddresses/bulk/$', views.EmailAddressBulk.as_view()),
     url(r'^ipAddresses/$', views.IpAddressBase.as_view()),
+    url(r'^ipAddresses/bulk/$', views.IpAddressBulk.as_view()),
     url(r'^urls/$', views.UrlBase.as_view()),
+    url(r'^urls/bulk/$', views.UrlBulk.as_view()),
 ]
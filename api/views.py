@@ -5,11 +5,18 @@ from rest_framework.views import APIView
 from rest_framework import permissions
 from rest_framework import generics
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
-from django.http import Http404
+from django.db.models import F
+from django.http import FileResponse, Http404, StreamingHttpResponse
+
+from api import export
+from api.parsers import NDJSONParser
 
 from api.serializers import (
     EmailSerializer,
+    EmailListSerializer,
     EmailCreateSerializer,
     AnalysisSerializer,
     HeaderSerializer,
@@ -21,13 +28,57 @@ from api.serializers import (
     EmailAddressSerializer,
     UrlSerializer,
 )
+from db import db_creator
+from db.blob_store import BlobNotFoundError
 from db.models import Email, Header, Body, Attachment, Host, IPAddress, EmailAddress, Url, Analysis
+from email_processor import processor
 from totalemail import settings
 
+# the maximum number of emails which can be submitted in one request to the bulk endpoint
+MAX_BULK_EMAILS = 1000
+# the maximum number of pieces of network data which can be submitted in one request to the network data bulk endpoints
+MAX_BULK_NETWORK_DATA = 10000
+# the field which counts the votes of each (type, value) which can be voted on
+HEADER_VOTE_FIELDS = {
+    ('subject', 'suspicious'): 'subject_suspicious_votes',
+    ('subject', 'not suspicious'): 'subject_not_suspicious_votes',
+}
+
+
+class EmailListMixin(object):
+    """List emails with only their summary fields (see `EmailListSerializer`) unless other fields are requested using the "fields" parameter (e.g. `?fields=id,full_text`). Only the fields which are listed are read from the database."""
+
+    serializer_class = EmailListSerializer
+
+    def list_fields(self):
+        fields = [field_name.strip() for field_name in self.request.query_params.get('fields', '').split(',')]
+        fields = [field_name for field_name in fields if field_name]
+        unknown_fields = [field_name for field_name in fields if field_name not in EmailListSerializer.Meta.fields]
+        if unknown_fields:
+            raise ValidationError(
+                {
+                    'result': 'Unknown fields: {}. The fields which can be listed are: {}.'.format(
+                        ', '.join(unknown_fields), ', '.join(EmailListSerializer.Meta.fields)
+                    )
+                }
+            )
+        return fields or EmailListSerializer.summary_fields
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs['fields'] = self.list_fields()
+        return super(EmailListMixin, self).get_serializer(*args, **kwargs)
+
+    def list_emails(self, emails):
+        fields = self.list_fields()
+        # the full text of large emails is read from the blob store (see `db.blob_store`)
+        if 'full_text' in fields:
+            fields = list(fields) + ['blob_key']
+        return emails.only(*fields)
 
-class EmailBase(generics.ListCreateAPIView):
-    serializer_class = EmailSerializer
-    queryset = Email.objects.all()[: settings.MAX_RESULTS]
+
+class EmailBase(EmailListMixin, generics.ListCreateAPIView):
+    def get_queryset(self):
+        return self.list_emails(Email.objects.all())[: settings.MAX_RESULTS]
 
     # TODO: eventually, this function should also return analysis details about the email that was just submitted (or we will have to tell the user to wait and check until the analysis results are available)
     def post(self, request, *args, **kwargs):
@@ -81,6 +132,103 @@ class EmailBase(generics.ListCreateAPIView):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class EmailBulk(APIView):
+    """Create many emails at once from a JSON list (or an NDJSON stream) of objects which each have a "full_text" key."""
+
+    parser_classes = (JSONParser, NDJSONParser)
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        items = request.data
+        redaction_values = []
+        # allow the emails to be given as a list or as a dict with the list in the "emails" key (and, optionally, a list of "redaction_values" which are redacted from all of the emails)
+        if isinstance(items, dict):
+            redaction_values = items.get('redaction_values') or []
+            items = items.get('emails')
+        # the redaction values can also be given as a comma separated string (like they are for the standard endpoint's form)
+        if isinstance(redaction_values, str):
+            redaction_values = [redaction_values]
+        if not isinstance(redaction_values, list) or not all(isinstance(value, str) for value in redaction_values):
+            failure_response = {
+                'result': 'The "redaction_values" must be a list of strings or a comma separated string.'
+            }
+            return Response(failure_response, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(items, list):
+            failure_response = {'result': 'Please provide a list of emails (each with a "full_text" key).'}
+            return Response(failure_response, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > MAX_BULK_EMAILS:
+            failure_response = {'result': 'Please submit {} emails or fewer per request.'.format(MAX_BULK_EMAILS)}
+            return Response(failure_response, status=status.HTTP_400_BAD_REQUEST)
+
+        redact = True
+        if request.query_params.get('redact'):
+            if request.query_params['redact'].lower() == 'false':
+                redact = False
+
+        email_texts = []
+        for item in items:
+            serializer = EmailCreateSerializer(data=item if isinstance(item, dict) else {})
+            if serializer.is_valid():
+                email_texts.append(serializer.validated_data['full_text'])
+            else:
+                email_texts.append('')
+
+        # if the request is simply testing an SDK, return a success response noting that the request data was validated by the serializer
+        if request.query_params.get('sdkTest'):
+            mock_success_response = {
+                'result': 'Emails passed serializer validation.',
+                'results': [{'status': 'valid' if email_text else 'invalid'} for email_text in email_texts],
+            }
+            return Response(mock_success_response, status=status.HTTP_201_CREATED)
+
+        results = processor.process_emails(
+            email_texts,
+            settings._get_request_data(request),
+            redact_email_data=redact,
+            perform_external_analysis=not request.query_params.get('localTest'),
+            redaction_values=','.join(redaction_values),
+        )
+
+        response_data = {'results': [{'id': email_id, 'status': email_status} for email_id, email_status in results]}
+        if any(email_status == 'created' for email_id, email_status in results):
+            status_code = status.HTTP_201_CREATED
+        else:
+            status_code = status.HTTP_200_OK
+        return Response(response_data, status=status_code)
+
+
+class EmailExport(APIView):
+    """Stream all of the emails (or those modified in the given period) as newline delimited JSON in the order they were modified. The "include" parameter is a comma separated list of the related data (see `api.export.EXPORT_INCLUDES`) to include with each email."""
+
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        emails = Email.objects.all()
+        for parameter, lookup in (('since', 'modified__gte'), ('until', 'modified__lt')):
+            if request.query_params.get(parameter):
+                date = export.parse_export_datetime(request.query_params[parameter])
+                if date is None:
+                    failure_response = {
+                        'result': 'The "{}" parameter must be a date or datetime (e.g. 2019-05-01T12:00:00Z).'.format(
+                            parameter
+                        )
+                    }
+                    return Response(failure_response, status=status.HTTP_400_BAD_REQUEST)
+                emails = emails.filter(**{lookup: date})
+
+        include = [name.strip() for name in request.query_params.get('include', '').split(',') if name.strip()]
+        unknown_includes = [name for name in include if name not in export.EXPORT_INCLUDES]
+        if unknown_includes:
+            failure_response = {
+                'result': 'Unable to include {}. The data which can be included is: {}.'.format(
+                    ', '.join(unknown_includes), ', '.join(export.EXPORT_INCLUDES)
+                )
+            }
+            return Response(failure_response, status=status.HTTP_400_BAD_REQUEST)
+
+        return StreamingHttpResponse(export.export_emails(emails, include), content_type='application/x-ndjson')
+
+
 class EmailDetail(APIView):
     def get_object(self, pk):
         try:
@@ -112,6 +260,10 @@ class EmailAnalysis(generics.ListCreateAPIView):
         email = Email.objects.get(id=self.kwargs['pk'])
         return Analysis.objects.filter(email=email.id)
 
+    def perform_create(self, serializer):
+        analysis = serializer.save()
+        db_creator.update_email_score(analysis)
+
 
 class EmailHeader(generics.ListAPIView):
     serializer_class = HeaderSerializer
@@ -152,34 +304,31 @@ class HeaderDetail(generics.RetrieveAPIView):
     permission_classes = (permissions.IsAuthenticated,)
 
 
-class HeaderEmails(generics.ListAPIView):
-    serializer_class = EmailSerializer
+class HeaderEmails(EmailListMixin, generics.ListAPIView):
     permission_classes = (permissions.IsAuthenticated,)
 
     def get_queryset(self):
-        header = Header.objects.get(id=self.kwargs['pk'])
-        return Email.objects.filter(header=header)
+        header = Header.objects.only('id').get(id=self.kwargs['pk'])
+        return self.list_emails(Email.objects.filter(header=header))
 
 
 class HeaderVotes(generics.RetrieveUpdateAPIView):
-    queryset = Header.objects.all()
     serializer_class = HeaderVotesSerializer
 
     def get_queryset(self):
-        header = Header.objects.get(id=self.kwargs['pk'])
-        return header
+        return Header.objects.only('id', *HEADER_VOTE_FIELDS.values())
 
     def put(self, request, pk):
-        header = Header.objects.get(id=pk)
-
         data = request.data
 
         if data.get('value') and data.get('type'):
-            if data['type'] == 'subject' and data['value'] == 'not suspicious':
-                header.subject_not_suspicious_votes += 1
-            elif data['type'] == 'subject' and data['value'] == 'suspicious':
-                header.subject_suspicious_votes += 1
-            header.save()
+            vote_field = HEADER_VOTE_FIELDS.get((data['type'], data['value']))
+            if vote_field:
+                # the vote is counted by the database (rather than by reading and saving the header) so that concurrent votes are never lost and only the vote count is written
+                if not Header.objects.filter(pk=pk).update(**{vote_field: F(vote_field) + 1}):
+                    raise Http404
+            elif not Header.objects.filter(pk=pk).exists():
+                raise Http404
             return Response({'result': 'success'}, status=status.HTTP_201_CREATED)
         else:
             return Response({'result': 'failure'}, status=status.HTTP_400_BAD_REQUEST)
@@ -191,13 +340,30 @@ class BodyDetail(generics.RetrieveAPIView):
     permission_classes = (permissions.IsAuthenticated,)
 
 
-class BodyEmails(generics.ListAPIView):
-    serializer_class = EmailSerializer
+def _full_text_response(item):
+    """Stream the full text of the given body or attachment (which may be in the blob store) as plain text."""
+    try:
+        return FileResponse(item.open_full_text(), content_type='text/plain; charset=utf-8')
+    except BlobNotFoundError:
+        raise Http404('The full text of {} is missing from the blob store.'.format(item.id))
+
+
+class BodyContent(generics.GenericAPIView):
+    """Stream the full text of a body (which may be in the blob store) as plain text."""
+
+    queryset = Body.objects.all()
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        return _full_text_response(self.get_object())
+
+
+class BodyEmails(EmailListMixin, generics.ListAPIView):
     permission_classes = (permissions.IsAuthenticated,)
 
     def get_queryset(self):
-        body = Body.objects.get(id=self.kwargs['pk'])
-        return Email.objects.filter(bodies=body)
+        body = Body.objects.only('id').get(id=self.kwargs['pk'])
+        return self.list_emails(Email.objects.filter(bodies=body))
 
 
 class AttachmentDetail(generics.RetrieveAPIView):
@@ -206,13 +372,22 @@ class AttachmentDetail(generics.RetrieveAPIView):
     permission_classes = (permissions.IsAuthenticated,)
 
 
-class AttachmentEmails(generics.ListAPIView):
-    serializer_class = EmailSerializer
+class AttachmentContent(generics.GenericAPIView):
+    """Stream the full text of an attachment (which may be in the blob store) as plain text."""
+
+    queryset = Attachment.objects.all()
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        return _full_text_response(self.get_object())
+
+
+class AttachmentEmails(EmailListMixin, generics.ListAPIView):
     permission_classes = (permissions.IsAuthenticated,)
 
     def get_queryset(self):
-        attachment = Attachment.objects.get(id=self.kwargs['pk'])
-        return Email.objects.filter(attachments=attachment)
+        attachment = Attachment.objects.only('id').get(id=self.kwargs['pk'])
+        return self.list_emails(Email.objects.filter(attachments=attachment))
 
 
 class DomainBase(generics.ListCreateAPIView):
@@ -287,6 +462,50 @@ class IpAddressBase(generics.ListCreateAPIView):
         return Response(self.serializer_class(ip_address).data, status=status_code)
 
 
+class NetworkDataBulk(APIView):
+    """Create (or update) many pieces of network data at once from a JSON list (or an NDJSON stream) of objects in the same format as the network data endpoints accept."""
+
+    parser_classes = (JSONParser, NDJSONParser)
+    permission_classes = (permissions.IsAuthenticated,)
+    model = None
+
+    def post(self, request, *args, **kwargs):
+        items = request.data
+        if not isinstance(items, list):
+            failure_response = {'result': 'Please provide a list of network data.'}
+            return Response(failure_response, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > MAX_BULK_NETWORK_DATA:
+            failure_response = {
+                'result': 'Please submit {} pieces of network data or fewer per request.'.format(MAX_BULK_NETWORK_DATA)
+            }
+            return Response(failure_response, status=status.HTTP_400_BAD_REQUEST)
+
+        results = db_creator.bulk_create_network_data(self.model, items)
+
+        response_data = {'results': [{'id': item_id, 'status': item_status} for item_id, item_status in results]}
+        if any(item_status == 'created' for item_id, item_status in results):
+            status_code = status.HTTP_201_CREATED
+        else:
+            status_code = status.HTTP_200_OK
+        return Response(response_data, status=status_code)
+
+
+class DomainBulk(NetworkDataBulk):
+    model = Host
+
+
+class EmailAddressBulk(NetworkDataBulk):
+    model = EmailAddress
+
+
+class IpAddressBulk(NetworkDataBulk):
+    model = IPAddress
+
+
+class UrlBulk(NetworkDataBulk):
+    model = Url
+
+
 class UrlBase(generics.ListCreateAPIView):
     serializer_class = UrlSerializer
     queryset = Url.objects.all()
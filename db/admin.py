@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Email, Header, Body, Attachment, Host, IPAddress, EmailAddress, Url, Analysis
+from .models import Email, Header, Body, Attachment, Host, IPAddress, EmailAddress, Url, Analysis, AnalysisJob
 
 admin.site.register(Email)
 admin.site.register(Header)
@@ -13,3 +13,4 @@ admin.site.register(EmailAddress)
 admin.site.register(Url)
 
 admin.site.register(Analysis)
+admin.site.register(AnalysisJob)
@@ -1,5 +1,21 @@
 from django.apps import AppConfig
+from django.db.models.signals import m2m_changed, post_migrate
 
 
 class DbConfig(AppConfig):
     name = 'db'
+
+    def ready(self):
+        from .blob_store import get_blob_store
+        from .db_creator import bump_linked_details_versions
+        from .models import EmailAddress, Host, IPAddress, Url
+        from .search_index import create_trigram_indexes
+
+        # the blob store is set up when the app starts so that a blob store which cannot be used (e.g. the file system blob store on a Heroku dyno) stops the app from starting
+        get_blob_store()
+        post_migrate.connect(create_trigram_indexes, sender=self)
+        # the cached details pages of the emails network data is added to are rendered again (see `details.render_cache`)
+        for model in (Host, IPAddress, EmailAddress):
+            m2m_changed.connect(bump_linked_details_versions, sender=model.headers.through)
+        for model in (Host, IPAddress, EmailAddress, Url):
+            m2m_changed.connect(bump_linked_details_versions, sender=model.bodies.through)
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Store the full text of large emails, bodies, and attachments outside of the rows they belong to (keyed by their sha256 ids)."""
+
+import contextlib
+import importlib
+import io
+import logging
+import os
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+
+logger = logging.getLogger(__name__)
+
+# the full text of emails, bodies, and attachments with more characters than this is kept in the blob store rather than in their rows
+BLOB_STORE_THRESHOLD = int(os.environ.get('BLOB_STORE_THRESHOLD', 64 * 1024))
+# the blob store class and the location it stores blobs in (for the default, file system blob store, this is a directory and, for the database blob store, this is the alias of the database)
+BLOB_STORE_BACKEND = os.environ.get('BLOB_STORE_BACKEND', 'db.blob_store.FileSystemBlobStore')
+BLOB_STORE_LOCATION = os.environ.get('BLOB_STORE_LOCATION', '')
+# the directory the file system blob store stores blobs in if the BLOB_STORE_LOCATION is not set
+DEFAULT_BLOB_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'blobs')
+# the number of bytes in each row of a blob stored by the database blob store
+BLOB_CHUNK_SIZE = 1024 * 1024
+# the text which is shown in place of the full text of a row whose blob is missing from the blob store
+MISSING_BLOB_TEXT = '[The full text of this item is missing from the blob store.]'
+
+_blob_store = None
+
+
+class BlobNotFoundError(LookupError):
+    """Raised when a blob is not in the blob store."""
+
+
+class BlobStore(object):
+    """The interface of a blob store. Blobs are written once and are never changed (the key of a blob is the sha256 id of the row it belongs to)."""
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def create(self, key):
+        """Return a binary file object for writing the blob with the given key, which has to be used in a with block. The blob is only stored when the with block ends without an error (and is not written again if there is a blob with the key already)."""
+        raise NotImplementedError
+
+    def save(self, key, content):
+        """Store the given bytes with the given key (if there is not a blob with the key already)."""
+        with self.create(key) as blob:
+            blob.write(content)
+
+    def open(self, key):
+        """Return a binary file object for reading the blob with the given key. Raises a BlobNotFoundError if there is no blob with the key."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class _BlobWriter(io.RawIOBase):
+    """A binary file object which writes a blob and stores it at the end of the with block using it (unless the with block ends with an error)."""
+
+    def writable(self):
+        return True
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def discard(self):
+        """Close the file object without storing the blob."""
+        super(_BlobWriter, self).close()
+
+
+class _DiscardingBlobWriter(_BlobWriter):
+    """Ignore everything written to it (this is used to write a blob which is already stored)."""
+
+    def write(self, data):
+        return len(data)
+
+
+class FileSystemBlobStore(BlobStore):
+    """Store blobs as files in a directory (outside of the database, so large full texts do not make the database or its backups any larger). The directory has to be on a persistent file system which every process using the blob store can read, so the blob store does not start on a Heroku dyno (whose file system is reset whenever the dyno is restarted)."""
+
+    def __init__(self, location):
+        # heroku sets the DYNO environment variable on its dynos
+        if 'DYNO' in os.environ:
+            raise ImproperlyConfigured(
+                'The file system of a Heroku dyno is not persistent, so the file system blob store cannot be used on it (set the BLOB_STORE_BACKEND environment variable to another blob store, like db.blob_store.DatabaseBlobStore)'
+            )
+        self.location = location or DEFAULT_BLOB_DIRECTORY
+
+    def _path(self, key):
+        # the blobs are spread across subdirectories (by the first characters of their ids) so that no directory is too large
+        key_type, key_id = key.split('/')
+        return os.path.join(self.location, key_type, key_id[:2], key_id)
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def create(self, key):
+        path = self._path(key)
+        if os.path.exists(path):
+            return _DiscardingBlobWriter()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return _FileSystemBlobWriter(path)
+
+    def open(self, key):
+        try:
+            return open(self._path(key), 'rb')
+        except FileNotFoundError:
+            raise BlobNotFoundError(key)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class _FileSystemBlobWriter(_BlobWriter):
+    """Write a blob to a temporary file which is renamed to the blob's path when it is closed so that a partially written blob is never read."""
+
+    def __init__(self, path):
+        super(_FileSystemBlobWriter, self).__init__()
+        self.path = path
+        file_descriptor, self.temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        self.temporary_file = os.fdopen(file_descriptor, 'wb')
+
+    def write(self, data):
+        return self.temporary_file.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.temporary_file.close()
+            os.replace(self.temporary_path, self.path)
+        except BaseException:
+            self.discard()
+            raise
+        super(_FileSystemBlobWriter, self).close()
+
+    def discard(self):
+        if self.closed:
+            return
+        self.temporary_file.close()
+        try:
+            os.remove(self.temporary_path)
+        except FileNotFoundError:
+            pass
+        super(_FileSystemBlobWriter, self).discard()
+
+    def __del__(self):
+        # a blob which is never closed is not stored (and its temporary file is removed)
+        self.discard()
+
+
+class DatabaseBlobStore(BlobStore):
+    """Store blobs in the database as rows of (at most) BLOB_CHUNK_SIZE bytes (see `db.models.BlobChunk`). This is for hosts without a persistent file system (e.g. Heroku): the blobs are as durable as the rows they belong to and do not make those rows (and the tables which are listed and searched) any larger, but they are still in the database and its backups. Blobs are written and read a chunk at a time."""
+
+    def __init__(self, location):
+        # the location is the alias of the database the blobs are stored in
+        self.using = location or 'default'
+
+    def _chunks(self):
+        from .models import BlobChunk
+
+        return BlobChunk.objects.using(self.using)
+
+    def exists(self, key):
+        return self._chunks().filter(key=key, position=0).exists()
+
+    def create(self, key):
+        if self.exists(key):
+            return _DiscardingBlobWriter()
+        return _DatabaseBlobWriter(self, key)
+
+    def open(self, key):
+        if not self.exists(key):
+            raise BlobNotFoundError(key)
+        return io.BufferedReader(_DatabaseBlobReader(self, key))
+
+    def delete(self, key):
+        self._chunks().filter(key=key).delete()
+
+
+class _DatabaseBlobWriter(_BlobWriter):
+    """Write a blob to the database a chunk at a time. The chunks are written in a transaction which is opened and closed by the with block using the writer so that a partially written blob is never read."""
+
+    def __init__(self, blob_store, key):
+        super(_DatabaseBlobWriter, self).__init__()
+        self.blob_store = blob_store
+        self.key = key
+        self.position = 0
+        self.buffer = bytearray()
+        # whether another process stored the blob while this one was being written
+        self.stored_elsewhere = False
+        self.atomic = None
+
+    def __enter__(self):
+        self.atomic = transaction.atomic(using=self.blob_store.using)
+        self.atomic.__enter__()
+        return self
+
+    def write(self, data):
+        if self.atomic is None:
+            raise ValueError('A blob has to be written to the database in a with block')
+        if self.stored_elsewhere:
+            return len(data)
+        self.buffer += data
+        while len(self.buffer) >= BLOB_CHUNK_SIZE and not self.stored_elsewhere:
+            self._write_chunk(bytes(self.buffer[:BLOB_CHUNK_SIZE]))
+            del self.buffer[:BLOB_CHUNK_SIZE]
+        return len(data)
+
+    def _write_chunk(self, data):
+        try:
+            with transaction.atomic(using=self.blob_store.using):
+                self.blob_store._chunks().create(key=self.key, position=self.position, data=data)
+        except IntegrityError:
+            # the blob has the same content as this one because its key is the id of its row (which is the hash of its content)
+            self.stored_elsewhere = True
+            return
+        self.position += 1
+
+    def __exit__(self, exception_type, exception, traceback):
+        try:
+            # an empty blob is stored as a single empty chunk
+            if exception_type is None and not self.stored_elsewhere and (self.buffer or not self.position):
+                self._write_chunk(bytes(self.buffer))
+        except BaseException as e:
+            exception_type, exception, traceback = type(e), e, e.__traceback__
+            raise
+        finally:
+            # the chunks are rolled back if writing the blob failed or if another process stored it
+            if exception_type is None and self.stored_elsewhere:
+                transaction.set_rollback(True, using=self.blob_store.using)
+            self.atomic.__exit__(exception_type, exception, traceback)
+            self.discard()
+
+
+class _DatabaseBlobReader(io.RawIOBase):
+    """Read a blob from the database a chunk at a time."""
+
+    def __init__(self, blob_store, key):
+        super(_DatabaseBlobReader, self).__init__()
+        self.blob_store = blob_store
+        self.key = key
+        self.position = 0
+        self.chunk = b''
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.offset >= len(self.chunk):
+            data = self.blob_store._chunks().filter(key=self.key, position=self.position).values_list('data', flat=True)
+            data = data.first()
+            if data is None:
+                return 0
+            self.chunk = bytes(data)
+            self.offset = 0
+            self.position += 1
+        size = min(len(buffer), len(self.chunk) - self.offset)
+        buffer[:size] = self.chunk[self.offset : self.offset + size]
+        self.offset += size
+        return size
+
+
+def get_blob_store():
+    """Return the blob store (as configured by the BLOB_STORE_BACKEND and BLOB_STORE_LOCATION environment variables)."""
+    global _blob_store
+    if _blob_store is None:
+        module_name, class_name = BLOB_STORE_BACKEND.rsplit('.', 1)
+        _blob_store = getattr(importlib.import_module(module_name), class_name)(BLOB_STORE_LOCATION)
+    return _blob_store
+
+
+def set_blob_store(blob_store):
+    """Use the given blob store (e.g. in tests) and return the blob store which was being used."""
+    global _blob_store
+    previous_blob_store = _blob_store
+    _blob_store = blob_store
+    return previous_blob_store
+
+
+def blob_key(model_name, object_id):
+    return '{}/{}'.format(model_name, object_id)
+
+
+def store_full_text(model_name, object_id, full_text, inline_text=''):
+    """Store the given full text in the blob store if it is large. Returns the full text and blob key which should be saved in the row: if the full text was stored in the blob store, this is the given inline text (which is empty unless some of the full text has to stay in the row, like the searchable text of an email) and the blob key and, if it was not, it is the full text and an empty blob key."""
+    if full_text is None or len(full_text) <= BLOB_STORE_THRESHOLD:
+        return full_text, ''
+    key = blob_key(model_name, object_id)
+    get_blob_store().save(key, full_text.encode('utf-8'))
+    return inline_text, key
+
+
+class FullTextWriter(object):
+    """Write the full text of a row a piece at a time (e.g. `write_attachment_text(attachment, writer)`) in a with block. The text is kept in memory until it is longer than the BLOB_STORE_THRESHOLD, at which point it is written to the blob store (so the full text of a large row is never copied in memory). Once the with block ends, the writer's full_text and blob_key are the values which should be saved in the row (see `store_full_text`)."""
+
+    def __init__(self, model_name, object_id, inline_text=''):
+        self.key = blob_key(model_name, object_id)
+        self.inline_text = inline_text
+        self.pieces = []
+        self.length = 0
+        self.blob = None
+        # the blob is written in a with block which ends with the writer's with block
+        self.exit_stack = contextlib.ExitStack()
+        self.full_text = None
+        self.blob_key = None
+
+    def write(self, text):
+        if self.blob is not None:
+            self.blob.write(text.encode('utf-8'))
+            return len(text)
+
+        self.pieces.append(text)
+        self.length += len(text)
+        if self.length > BLOB_STORE_THRESHOLD:
+            self.blob = self.exit_stack.enter_context(get_blob_store().create(self.key))
+            for piece in self.pieces:
+                self.blob.write(piece.encode('utf-8'))
+            self.pieces = []
+        return len(text)
+
+    def __enter__(self):
+        self.exit_stack.__enter__()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.exit_stack.__exit__(exception_type, exception, traceback)
+        if exception_type is None:
+            if self.blob is None:
+                self.full_text, self.blob_key = ''.join(self.pieces), ''
+            else:
+                self.full_text, self.blob_key = self.inline_text, self.key
+        self.pieces = []
+
+
+def open_full_text(full_text, key):
+    """Return a binary file object for reading the full text of a row with the given full text and blob key. Raises a BlobNotFoundError if the blob is missing."""
+    if key:
+        return get_blob_store().open(key)
+    return io.BytesIO((full_text or '').encode('utf-8'))
+
+
+def read_full_text(full_text, key):
+    """Return the full text of a row with the given full text and blob key. If the blob is missing, the error is logged and MISSING_BLOB_TEXT is returned."""
+    if key:
+        try:
+            with get_blob_store().open(key) as blob:
+                return blob.read().decode('utf-8')
+        except BlobNotFoundError:
+            logger.error('The blob {} is missing from the blob store'.format(key))
+            return MISSING_BLOB_TEXT
+    return full_text
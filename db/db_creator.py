@@ -2,19 +2,30 @@
 # -*- coding: utf-8 -*-
 """Utility to create entities in the database."""
 
+import collections
 import json
 
-from django.db import transaction
+from django.db import connection, models, transaction
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
+from psycopg2.extras import execute_values
 
-from .models import Email, Header, Body, Attachment, JOIN_STRING
-from email_processor import parse_bodies
+from . import blob_store
+from .models import Email, Header, HeaderField, Body, Attachment, Host, IPAddress, EmailAddress, Url, JOIN_STRING
+from .network_data import overlapping_network_data_ids
+from .search_index import header_fields, update_search_vectors
+from email_processor import parse_attachments, parse_bodies
 from utility import utility
 import analyzer
+from analyzer.external_analysis import analysis_queue
 
 created_network_data = {'ip_addresses': list(), 'hosts': list(), 'email_addresses': list(), 'urls': list()}
 
+# the number of rows inserted by each query when creating objects in bulk
+BULK_INSERT_PAGE_SIZE = 500
+# the field with the value of each type of network data (this is the key used for the value when the network data is posted to the api)
+NETWORK_DATA_VALUE_FIELDS = {Host: 'host_name', IPAddress: 'ip_address', EmailAddress: 'email_address', Url: 'url'}
+
 
 # TODO: could all of these functions be moved into the `save` functions in the classes in models.py?
 
@@ -29,15 +40,18 @@ def create_email(
     email_body_objects,
     email_attachment_objects,
     perform_external_analysis,
+    searchable_text=None,
 ):
     # the try-except business below handles cases where an email is uploaded and then the same email is uploaded, but then redacted - there may be a better way to handle these situations
     try:
         email_in_db = Email.objects.get(pk=original_sha256)
     except ObjectDoesNotExist:
+        full_text, blob_key = _store_email_text(original_sha256, email_text, searchable_text)
         new_email, created = Email.objects.update_or_create(
             id=original_sha256,
             cleaned_id=cleaned_sha256,
-            full_text=email_text,
+            full_text=full_text,
+            blob_key=blob_key,
             submitter=submitter_hash,
             structure=email_structure,
             header=email_header,
@@ -49,6 +63,7 @@ def create_email(
         for attachment in email_attachment_objects:
             new_email.attachments.add(attachment)
 
+        update_search_vectors([new_email.id])
         analyzer.start_analysis(new_email, perform_external_analysis)
         return new_email
     else:
@@ -60,11 +75,17 @@ def create_email(
         return email_in_db
 
 
+def _store_email_text(email_id, email_text, searchable_text):
+    """Return the full text and blob key which should be saved for the given email. The full text of a large email is moved into the blob store and its searchable text (see `email_processor.processor.searchable_email_text`) is kept in the database because it is what text searches match substrings of (see `search.views._text_search_filter`)."""
+    return blob_store.store_full_text('emails', email_id, email_text, inline_text=searchable_text or '')
+
+
 def create_header(header_json, email_id, perform_external_analysis=True):
     header_string = json.dumps(header_json)
 
     with transaction.atomic():
         new_header, created = Header.objects.update_or_create(id=utility.sha256(header_string), data=header_json)
+        create_header_fields([new_header])
 
     if perform_external_analysis:
         analyzer.external_analysis.find_network_data(header_string, new_header.id, 'header', email_id=email_id)
@@ -72,8 +93,8 @@ def create_header(header_json, email_id, perform_external_analysis=True):
     return new_header
 
 
-def create_body(body_payload, body_content_type, email_id, perform_external_analysis=True, decode_body_as_base64=False):
-    """'While we live in these earthly bodies, we groan and sigh, but it’s not that we want to die and get rid of these bodies that clothe us. Rather, we want to put on our new bodies so that these dying bodies will be swallowed up by life.' ~ 2 Corinthians 5:4."""
+def _body_text(body_payload, decode_body_as_base64=False):
+    """Return the text and decoded text (if the body is base64 encoded) for the given body payload."""
     body_text = str(body_payload).strip()
 
     decoded_text = None
@@ -81,9 +102,30 @@ def create_body(body_payload, body_content_type, email_id, perform_external_anal
     if decode_body_as_base64:
         decoded_text = parse_bodies.decode_base64(str(body_text).split('\n\n')[-1])
 
+    return body_text, decoded_text
+
+
+def _store_body_text(body_id, body_text, decoded_text):
+    """Return the full text and blob key which should be saved for the given body. Only the full text of bodies which have decoded text is moved into the blob store because the full text of the other bodies is what is searched and analyzed."""
+    if decoded_text:
+        return blob_store.store_full_text('bodies', body_id, body_text)
+    return body_text, ''
+
+
+def create_body(body_payload, body_content_type, email_id, perform_external_analysis=True, decode_body_as_base64=False):
+    """'While we live in these earthly bodies, we groan and sigh, but it’s not that we want to die and get rid of these bodies that clothe us. Rather, we want to put on our new bodies so that these dying bodies will be swallowed up by life.' ~ 2 Corinthians 5:4."""
+    body_text, decoded_text = _body_text(body_payload, decode_body_as_base64=decode_body_as_base64)
+    body_id = utility.sha256(body_text)
+    full_text, blob_key = _store_body_text(body_id, body_text, decoded_text)
+
     new_body, created = Body.objects.update_or_create(
-        id=utility.sha256(body_text),
-        defaults={'full_text': body_text, 'content_type': body_content_type, 'decoded_text': decoded_text},
+        id=body_id,
+        defaults={
+            'full_text': full_text,
+            'blob_key': blob_key,
+            'content_type': body_content_type,
+            'decoded_text': decoded_text,
+        },
     )
 
     if perform_external_analysis:
@@ -101,22 +143,391 @@ def _filename_exists(existing_filenames, new_filename):
     return new_filename in existing_filenames
 
 
+def _merge_filenames(existing_filenames, new_filename):
+    """Add the new filename to the existing filenames (if it is not already there)."""
+    if existing_filenames:
+        # check to see if the new file name already exists... only add new filenames
+        if not _filename_exists(existing_filenames, new_filename):
+            return existing_filenames + JOIN_STRING + new_filename
+        return existing_filenames
+    else:
+        return new_filename
+
+
+def _store_attachment_text(attachment_data):
+    """Write the text of the given attachment (as parsed by `email_processor.parse_attachments.parse_attachment`) to the blob store if it is large and return the full text and blob key which should be saved in the attachment's row (see `blob_store.store_full_text`). The text is written from the attachment's MIME part a piece at a time (attachment data with the full text rather than the part, e.g. from the test resources, is stored as it is)."""
+    if 'part' not in attachment_data:
+        return blob_store.store_full_text('attachments', attachment_data['id'], attachment_data['full_text'])
+    with blob_store.FullTextWriter('attachments', attachment_data['id']) as full_text:
+        parse_attachments.write_attachment_text(attachment_data['part'], full_text)
+    return full_text.full_text, full_text.blob_key
+
+
 def create_attachment(attachment_data):
+    full_text, blob_key = _store_attachment_text(attachment_data)
     new_attachment, created = Attachment.objects.update_or_create(
         id=attachment_data['id'],
         defaults={
             'content_type': attachment_data['content_type'],
             'md5': attachment_data['md5'],
             'sha1': attachment_data['sha1'],
-            'full_text': attachment_data['full_text'],
+            'size': attachment_data['size'],
+            'full_text': full_text,
+            'blob_key': blob_key,
         },
     )
     # handle multiple file names
-    if new_attachment.filename:
-        # check to see if the new file name already exists... only add new filenames
-        if not _filename_exists(new_attachment.filename, attachment_data['filename']):
-            new_attachment.filename = new_attachment.filename + JOIN_STRING + attachment_data['filename']
-    else:
-        new_attachment.filename = attachment_data['filename']
+    new_attachment.filename = _merge_filenames(new_attachment.filename, attachment_data['filename'])
     new_attachment.save()
     return new_attachment
+
+
+def _bulk_insert(model, objects, update_fields=None):
+    """Insert the given (unsaved) model instances using a single `INSERT ... ON CONFLICT` query. Rows which already exist are skipped unless update_fields is given, in which case those fields of the existing rows are updated (like the `defaults` given to `update_or_create`)."""
+    if not objects:
+        return
+
+    quote_name = connection.ops.quote_name
+    fields = [field for field in model._meta.concrete_fields if not isinstance(field, models.AutoField)]
+    sql = 'INSERT INTO {} ({}) VALUES %s'.format(
+        quote_name(model._meta.db_table), ', '.join(quote_name(field.column) for field in fields)
+    )
+    if update_fields:
+        columns = [quote_name(model._meta.get_field(field_name).column) for field_name in update_fields]
+        sql += ' ON CONFLICT ({}) DO UPDATE SET {}'.format(
+            quote_name(model._meta.pk.column), ', '.join('{0} = EXCLUDED.{0}'.format(column) for column in columns)
+        )
+    else:
+        sql += ' ON CONFLICT DO NOTHING'
+    values = [
+        tuple(field.get_db_prep_save(getattr(obj, field.attname), connection) for field in fields) for obj in objects
+    ]
+
+    # the cursor is passed to psycopg2 as it is (rather than the database cursor it wraps) so that the query of each page is counted by the metrics (see `utility.metrics`)
+    with connection.cursor() as cursor:
+        execute_values(cursor, sql, values, page_size=BULK_INSERT_PAGE_SIZE)
+
+
+def create_header_fields(headers):
+    """Create the header fields (which are used to search specific header keys) of the given headers. Fields which already exist are skipped."""
+    _bulk_insert(HeaderField, [field for header in headers for field in header_fields(header)])
+
+
+def update_email_score(analysis):
+    """Update the score of the given analysis' email with the score of the analysis (which is the most recent analysis from its source)."""
+    with transaction.atomic():
+        source_scores = (
+            Email.objects.select_for_update().values_list('source_scores', flat=True).get(pk=analysis.email_id)
+        )
+        source_scores[analysis.source] = float(utility._calculate(analysis.score, analysis.source))
+        Email.objects.filter(pk=analysis.email_id).update(
+            source_scores=source_scores,
+            score=utility.email_score(list(source_scores.values())),
+            details_version=models.F('details_version') + 1,
+        )
+    analysis_queue.acknowledge('analysis', [analysis.email_id])
+
+
+def bump_details_versions(email_ids=(), header_ids=(), body_ids=(), network_data=()):
+    """Increment the details versions of the given emails, of the emails with the given headers or bodies, and of the emails whose headers or bodies (as given by the item field name) have the given network data (given as (model, item field name, network data ids)) so that their cached details pages are rendered again. This is done using a single query."""
+    email_ids, header_ids, body_ids = list(email_ids), list(header_ids), list(body_ids)
+    email_filter = models.Q()
+    if email_ids:
+        email_filter |= models.Q(pk__in=email_ids)
+    if header_ids:
+        email_filter |= models.Q(header_id__in=header_ids)
+    if body_ids:
+        email_filter |= models.Q(pk__in=Email.bodies.through.objects.filter(body_id__in=body_ids).values('email_id'))
+    for model, item_field_name, network_data_ids in network_data:
+        network_data_ids = list(network_data_ids)
+        if not network_data_ids:
+            continue
+        field = model._meta.get_field(item_field_name)
+        item_ids = field.remote_field.through.objects.filter(
+            **{'{}__in'.format(field.m2m_column_name()): network_data_ids}
+        ).values(field.m2m_reverse_name())
+        if field.related_model is Header:
+            email_filter |= models.Q(header_id__in=item_ids)
+        else:
+            email_filter |= models.Q(
+                pk__in=Email.bodies.through.objects.filter(body_id__in=item_ids).values('email_id')
+            )
+    if email_filter:
+        Email.objects.filter(email_filter).update(details_version=models.F('details_version') + 1)
+
+
+def bump_linked_details_versions(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """Increment the details versions of the emails whose headers or bodies network data is added to (or removed from) using the related managers (e.g. `host.headers.add(header)`) and of the other emails with the network data whose overlaps were changed by it (see `db.network_data.overlapping_network_data_ids`). This is connected to the `m2m_changed` signal of the network data's relations in `db.apps`."""
+    if action not in ('post_add', 'post_remove'):
+        return
+    if reverse:
+        network_data_model, network_data_ids = model, pk_set or []
+        related_model, related_ids = type(instance), [instance.pk]
+        new_link_counts = {network_data_id: 1 for network_data_id in network_data_ids}
+    else:
+        network_data_model, network_data_ids = type(instance), [instance.pk]
+        related_model, related_ids = model, pk_set or []
+        new_link_counts = {instance.pk: len(related_ids)}
+    if not related_ids:
+        return
+
+    item_field_name = 'headers' if related_model is Header else 'bodies'
+    overlapping_ids = overlapping_network_data_ids(
+        network_data_model, item_field_name, new_link_counts, removed=action == 'post_remove'
+    )
+    bump_details_versions(
+        header_ids=related_ids if related_model is Header else (),
+        body_ids=related_ids if related_model is Body else (),
+        network_data=[(network_data_model, item_field_name, overlapping_ids)],
+    )
+
+
+def _network_data_host_name(model, value):
+    """Return the host name of the given email address or url (see `EmailAddress.save` and `Url.save`)."""
+    if model is EmailAddress:
+        # NOTE: I'm stripping off '[' and ']' in case the hostname is an ip address
+        return value.split('@')[-1].strip('[').strip(']')
+    return utility.url_domain_name(value)
+
+
+def _network_data_is_valid(model, value):
+    return (
+        isinstance(value, str) and 0 < len(value) <= model._meta.get_field(NETWORK_DATA_VALUE_FIELDS[model]).max_length
+    )
+
+
+def _network_data_links(model, item_field_name, links):
+    """Return the (unsaved) through model instances relating the network data of the given model to the headers or bodies (as given by the item_field_name) in the given (network data id, item id) links. Links to headers or bodies which do not exist are skipped."""
+    field = model._meta.get_field(item_field_name)
+    item_ids = set(
+        field.related_model.objects.filter(pk__in={item_id for network_data_id, item_id in links}).values_list(
+            'pk', flat=True
+        )
+    )
+    return [
+        field.remote_field.through(**{field.m2m_column_name(): network_data_id, field.m2m_reverse_name(): item_id})
+        for network_data_id, item_id in sorted(links)
+        if item_id in item_ids
+    ]
+
+
+def bulk_create_network_data(model, items):
+    """Create (or update) the given network data of the given model and relate it to the headers and bodies it was found in using a handful of queries for the entire batch. Each item is a dict with the value of the network data (e.g. the "host_name" of a host) and, optionally, lists of the ids of the "headers" and "bodies" it was found in. Returns the id and status ("created", "updated", or "invalid") of each item in the order they were given."""
+    value_field_name = NETWORK_DATA_VALUE_FIELDS[model]
+    now = timezone.now()
+    results = []
+    network_data = {}
+    header_links = set()
+    body_links = set()
+
+    for item in items:
+        value = item.get(value_field_name) if isinstance(item, dict) else None
+        if not _network_data_is_valid(model, value):
+            results.append((None, 'invalid'))
+            continue
+
+        network_data_id = utility.sha256(value) if model is Url else value
+        if network_data_id not in network_data:
+            new_object = model(first_seen=now, modified=now, **{value_field_name: value})
+            # the id of a url is the hash of the url (see `Url.save`)
+            new_object.pk = network_data_id
+            network_data[network_data_id] = new_object
+        results.append((network_data_id, None))
+
+        # urls are only found in bodies
+        if model is not Url:
+            header_links.update(
+                (network_data_id, header_id) for header_id in item.get('headers') or [] if isinstance(header_id, str)
+            )
+        body_links.update(
+            (network_data_id, body_id) for body_id in item.get('bodies') or [] if isinstance(body_id, str)
+        )
+
+    existing_ids = set(model.objects.filter(pk__in=network_data).values_list('pk', flat=True))
+
+    # the hosts and ip addresses of new email addresses and urls are created with them (like `EmailAddress.save` and `Url.save` do)
+    hosts = {}
+    ip_addresses = {}
+    if model in (EmailAddress, Url):
+        for network_data_id, new_object in network_data.items():
+            if network_data_id in existing_ids:
+                continue
+            host_name = _network_data_host_name(model, getattr(new_object, value_field_name))
+            if utility.is_ip_address(host_name):
+                if _network_data_is_valid(IPAddress, host_name):
+                    ip_addresses[host_name] = IPAddress(ip_address=host_name, first_seen=now, modified=now)
+                    new_object.ip_address_id = host_name
+            elif _network_data_is_valid(Host, host_name):
+                hosts[host_name] = Host(host_name=host_name, first_seen=now, modified=now)
+                new_object.host_id = host_name
+
+    with transaction.atomic():
+        # the rows are written in order so that concurrent requests lock them in the same order
+        _bulk_insert(Host, [hosts[host_name] for host_name in sorted(hosts)], update_fields=('modified',))
+        _bulk_insert(
+            IPAddress, [ip_addresses[ip_address] for ip_address in sorted(ip_addresses)], update_fields=('modified',)
+        )
+        _bulk_insert(
+            model,
+            [network_data[network_data_id] for network_data_id in sorted(network_data)],
+            update_fields=('modified',),
+        )
+        if header_links:
+            _bulk_insert(model.headers.through, _network_data_links(model, 'headers', header_links))
+        if body_links:
+            _bulk_insert(model.bodies.through, _network_data_links(model, 'bodies', body_links))
+    bump_details_versions(
+        header_ids={header_id for network_data_id, header_id in header_links},
+        body_ids={body_id for network_data_id, body_id in body_links},
+        network_data=[
+            (
+                model,
+                item_field_name,
+                overlapping_network_data_ids(
+                    model, item_field_name, collections.Counter(network_data_id for network_data_id, item_id in links)
+                ),
+            )
+            for item_field_name, links in (('headers', header_links), ('bodies', body_links))
+            if links
+        ],
+    )
+
+    return [
+        (network_data_id, status or ('updated' if network_data_id in existing_ids else 'created'))
+        for network_data_id, status in results
+    ]
+
+
+def existing_email_ids(email_ids):
+    """Return the ids of the given emails which are already in the database."""
+    return set(Email.objects.filter(pk__in=set(email_ids)).values_list('id', flat=True))
+
+
+def update_duplicate_emails(email_ids):
+    """Update the modified date of the emails with the given ids which are already in the database and return the ids of those emails."""
+    duplicate_email_ids = existing_email_ids(email_ids)
+
+    if duplicate_email_ids:
+        Email.objects.filter(pk__in=duplicate_email_ids).update(modified=timezone.now())
+        message = 'Duplicate emails with ids {}'.format(', '.join(sorted(duplicate_email_ids)))
+        utility.create_alerta_alert('Duplicate emails uploaded', 'info', message)
+
+    return duplicate_email_ids
+
+
+def bulk_create_emails(prepared_emails, submitter_hash, perform_external_analysis=True):
+    """Create the given emails (as prepared by `email_processor.processor.prepare_email`) and their headers, bodies, and attachments using a handful of queries for the entire batch. The emails should not already exist in the database (see `update_duplicate_emails`)."""
+    if not prepared_emails:
+        return []
+
+    now = timezone.now()
+    headers = {}
+    bodies = {}
+    attachments = {}
+    new_emails = []
+    email_bodies = []
+    email_attachments = []
+    # the (text, id, type) of each header and body which is sent to the analysis server (by email id)
+    network_data_items = {}
+
+    # the filenames of attachments which are already in the database are needed to handle multiple file names
+    attachment_filenames = dict(
+        Attachment.objects.filter(
+            pk__in=[data['id'] for prepared_email in prepared_emails for data in prepared_email['attachments']]
+        ).values_list('id', 'filename')
+    )
+
+    for prepared_email in prepared_emails:
+        email_id = prepared_email['original_sha256']
+
+        header_string = json.dumps(prepared_email['header'])
+        header_id = utility.sha256(header_string)
+        if header_id not in headers:
+            headers[header_id] = Header(id=header_id, data=prepared_email['header'], first_seen=now, modified=now)
+            headers[header_id].summarize()
+        network_data_items[email_id] = [(header_string, header_id, 'header')]
+
+        body_ids = []
+        for body in prepared_email['bodies']:
+            body_text, decoded_text = _body_text(body['payload'], decode_body_as_base64=body['decode_as_base64'])
+            body_id = utility.sha256(body_text)
+            # large texts are written to the blob store before the rows referring to them are inserted (a blob whose row is never inserted is harmless because blobs are only read through their rows)
+            full_text, blob_key = _store_body_text(body_id, body_text, decoded_text)
+            bodies[body_id] = Body(
+                id=body_id,
+                full_text=full_text,
+                blob_key=blob_key,
+                content_type=body['content_type'],
+                decoded_text=decoded_text,
+                first_seen=now,
+            )
+            if body_id not in body_ids:
+                body_ids.append(body_id)
+                email_bodies.append(Email.bodies.through(email_id=email_id, body_id=body_id))
+            network_data_items[email_id].append((decoded_text or body_text, body_id, 'body'))
+
+        attachment_ids = []
+        for attachment_data in prepared_email['attachments']:
+            attachment_id = attachment_data['id']
+            attachment_filenames[attachment_id] = _merge_filenames(
+                attachment_filenames.get(attachment_id), attachment_data['filename'] or ''
+            )
+            full_text, blob_key = _store_attachment_text(attachment_data)
+            attachments[attachment_id] = Attachment(
+                id=attachment_id,
+                content_type=attachment_data['content_type'],
+                md5=attachment_data['md5'],
+                sha1=attachment_data['sha1'],
+                size=attachment_data['size'],
+                full_text=full_text,
+                blob_key=blob_key,
+                filename=attachment_filenames[attachment_id],
+                first_seen=now,
+                modified=now,
+            )
+            if attachment_id not in attachment_ids:
+                attachment_ids.append(attachment_id)
+                email_attachments.append(Email.attachments.through(email_id=email_id, attachment_id=attachment_id))
+
+        full_text, blob_key = _store_email_text(
+            email_id, prepared_email['full_text'], prepared_email.get('searchable_text')
+        )
+        new_emails.append(
+            Email(
+                id=email_id,
+                cleaned_id=prepared_email['cleaned_sha256'],
+                full_text=full_text,
+                blob_key=blob_key,
+                submitter=submitter_hash,
+                structure=prepared_email['structure'],
+                header_id=header_id,
+                first_seen=now,
+                modified=now,
+            )
+        )
+
+    with transaction.atomic():
+        _bulk_insert(Header, list(headers.values()))
+        create_header_fields(headers.values())
+        _bulk_insert(
+            Body, list(bodies.values()), update_fields=('full_text', 'blob_key', 'content_type', 'decoded_text')
+        )
+        _bulk_insert(
+            Attachment,
+            list(attachments.values()),
+            update_fields=('content_type', 'md5', 'sha1', 'size', 'full_text', 'blob_key', 'filename', 'modified'),
+        )
+        _bulk_insert(Email, new_emails)
+        _bulk_insert(Email.bodies.through, email_bodies)
+        _bulk_insert(Email.attachments.through, email_attachments)
+        update_search_vectors(new_email.id for new_email in new_emails)
+
+    # the analysis requests are queued once everything is in the database (the analysis server posts its results back to the api) - the requests of every email are queued together (with one query)
+    with analyzer.external_analysis.batch():
+        for new_email in new_emails:
+            if perform_external_analysis:
+                for text, item_id, item_type in network_data_items[new_email.id]:
+                    analyzer.external_analysis.find_network_data(text, item_id, item_type, email_id=new_email.id)
+            analyzer.start_analysis(new_email, perform_external_analysis)
+
+    return new_emails
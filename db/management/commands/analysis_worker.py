@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Send the queued analysis requests to the external analysis server."""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analyzer.external_analysis import analysis_queue
+from analyzer.external_analysis.external_analysis import analysis_sender
+
+
+class Command(BaseCommand):
+    help = 'Send the queued analysis requests to the external analysis server. Requests which cannot be sent are retried with exponential backoff. More than one worker can be run at a time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100, help='the maximum number of requests read from the queue at a time'
+        )
+        parser.add_argument(
+            '--rate-limit',
+            type=float,
+            default=0,
+            help='the maximum number of requests sent per second by this worker (0 for no limit)',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1,
+            help='the number of seconds to wait before checking the queue again when it is empty',
+        )
+        parser.add_argument(
+            '--stats-interval', type=float, default=60, help='the number of seconds between queue depth reports'
+        )
+        parser.add_argument('--once', action='store_true', help='send the requests which are due and then exit')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        if options['rate_limit'] < 0:
+            raise CommandError('--rate-limit cannot be negative')
+
+        last_report_time = time.time()
+        try:
+            while True:
+                start_time = time.time()
+                sent_count = analysis_queue.send_pending_jobs(analysis_sender, limit=options['batch_size'])
+
+                if options['once'] and sent_count < options['batch_size']:
+                    break
+
+                if time.time() - last_report_time >= options['stats_interval']:
+                    self._report()
+                    last_report_time = time.time()
+
+                if options['rate_limit']:
+                    # wait long enough that the requests just sent stay within the rate limit
+                    time.sleep(max(sent_count / options['rate_limit'] - (time.time() - start_time), 0))
+                if sent_count == 0:
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._report()
+            analysis_sender.close()
+
+    def _report(self):
+        stats = analysis_sender.stats()
+        self.stdout.write(
+            '{} requests queued, {} awaiting results, {} failed, {} sent, {} not accepted by the analysis server (will be retried)'.format(
+                analysis_queue.queue_depth(),
+                analysis_queue.awaiting_results_count(),
+                analysis_queue.failed_count(),
+                stats['sent'],
+                stats['dropped'],
+            )
+        )
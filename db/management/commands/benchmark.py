@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Time the steps of the email processing pipeline over a corpus of emails and compare them with the implementations they replaced."""
+
+import collections
+import os
+import re
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from email_processor import formatter, pii
+from .ingest import SOURCE_FORMATS, read_messages
+
+# the text of the sample email used when no corpus is given (it is repeated to make the sample emails larger)
+SAMPLE_EMAIL_TEXT = '''From: Bob Bradbury <bob@gmail.com>
+To: Alice Asimov <alice@gmail.com>
+Subject: Your account
+Content-Type: text/html; charset="utf-8"
+
+<p>Hi Alice, please call us at 1 (800) 123-4567 or reply to billing@example.com to confirm your SSN (123-45-6789).</p>
+<p>Your card 4111 1111 1111 1111 and your account GB82 WEST 1234 5698 7654 32 will be charged on Wed, 08 May 2019 03:44:37 -0400.</p>
+'''
+
+
+def _decode(message):
+    """Decode the raw bytes of an email for the benchmarks of the steps which are run on the decoded text."""
+    return message.decode('utf-8', errors='replace')
+
+
+def _legacy_clean_pii(text):
+    """The PII redaction `email_processor.cleaner` used before `email_processor.pii.PIIRedactor` (kept to compare it with)."""
+    ssn_pattern = r'(\d{3}-\d{2}-\d{4})'
+    cleaned_text = re.sub(ssn_pattern, 'REDACTED', text, flags=re.IGNORECASE)
+
+    phone_number_pattern = r'(?<!\d)(?:(?:\(?[0-9]{3}(\)?(?: |[-.]))))[0-9]{3}[ -.][0-9]{4}'
+    cleaned_text = re.sub(phone_number_pattern, 'REDACTED', cleaned_text, flags=re.IGNORECASE)
+
+    return cleaned_text
+
+
+def _legacy_format_email_for_db(email_text):
+    """The formatting `email_processor.formatter.format_email_for_db` did before it formatted bytes before decoding them (kept to compare it with)."""
+    if isinstance(email_text, bytes):
+        try:
+            email_text = email_text.decode('utf-8')
+        except UnicodeDecodeError:
+            email_text = str(email_text)
+    email_text = re.sub('\x00.*?\n', '\n', email_text)
+    email_text = re.sub('(?<!\r)\n', '\r\n', email_text)
+    if not email_text.endswith('\r\n'):
+        email_text = email_text + '\r\n'
+    return email_text
+
+
+def _benchmark_format(messages):
+    """Return the implementations of email formatting to time, the function each one is run with, and the input it is run on."""
+    return collections.OrderedDict(
+        [
+            ('legacy (bytes)', (_legacy_format_email_for_db, messages)),
+            ('format_email_for_db (bytes)', (formatter.format_email_for_db, messages)),
+            (
+                'format_email_for_db (memoryview)',
+                (formatter.format_email_for_db, [memoryview(message) for message in messages]),
+            ),
+            ('format_email_for_db (str)', (formatter.format_email_for_db, [_decode(message) for message in messages])),
+        ]
+    )
+
+
+def _benchmark_pii(messages):
+    """Return the implementations of PII redaction to time, the function each one is run with, and the input it is run on."""
+    email_texts = [_decode(message) for message in messages]
+    legacy_redactor = pii.PIIRedactor(('ssn', 'phone_number'))
+    default_redactor = pii.PIIRedactor()
+    all_redactor = pii.PIIRedactor(tuple(pii.PII_PATTERNS))
+
+    def redact_chunks(text):
+        return ''.join(all_redactor.redact_chunks(text[index : index + 65536] for index in range(0, len(text), 65536)))
+
+    return collections.OrderedDict(
+        [
+            ('legacy (ssn and phone numbers)', (_legacy_clean_pii, email_texts)),
+            ('PIIRedactor (ssn and phone numbers)', (legacy_redactor.redact, email_texts)),
+            ('PIIRedactor (default categories)', (default_redactor.redact, email_texts)),
+            ('PIIRedactor (all categories)', (all_redactor.redact, email_texts)),
+            ('PIIRedactor (all categories, 64 KB chunks)', (redact_chunks, email_texts)),
+        ]
+    )
+
+
+BENCHMARKS = collections.OrderedDict([('format', _benchmark_format), ('pii', _benchmark_pii)])
+
+
+class Command(BaseCommand):
+    help = 'Time the steps of the email processing pipeline over a corpus of emails (or over sample emails if no corpus is given) and compare them with the implementations they replaced.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=list(BENCHMARKS), help='the step to benchmark')
+        parser.add_argument('paths', nargs='*', help='mbox files, Maildirs, .eml files, or directories of .eml files')
+        parser.add_argument('--format', choices=SOURCE_FORMATS, default='auto', help='the format of the given paths')
+        parser.add_argument('--repeat', type=int, default=5, help='the number of times each implementation is timed')
+        parser.add_argument(
+            '--sample-size', type=int, default=1000, help='the number of times the sample email text is repeated'
+        )
+        parser.add_argument('--sample-count', type=int, default=10, help='the number of sample emails')
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1')
+        for path in options['paths']:
+            if not os.path.exists(path):
+                raise CommandError('{} does not exist'.format(path))
+
+        messages = self._messages(options)
+        if not messages:
+            raise CommandError('No emails were found')
+        total_bytes = sum(len(message) for message in messages)
+        self.stdout.write(
+            'Benchmarking {} over {} emails ({} bytes)'.format(options['benchmark'], len(messages), total_bytes)
+        )
+
+        implementations = BENCHMARKS[options['benchmark']](messages)
+        baseline_time = None
+        for name, (function, inputs) in implementations.items():
+            # the fastest run is reported because the slower runs are slowed down by other processes, not by the implementation
+            elapsed_time = min(
+                timeit.repeat(lambda: [function(item) for item in inputs], number=1, repeat=options['repeat'])
+            )
+            baseline_time = baseline_time or elapsed_time
+            self.stdout.write(
+                '{:<50} {:>9.4f}s {:>9.2f} MB/s {:>7.2f}x'.format(
+                    name,
+                    elapsed_time,
+                    total_bytes / max(elapsed_time, 1e-9) / 1e6,
+                    baseline_time / max(elapsed_time, 1e-9),
+                )
+            )
+
+    def _messages(self, options):
+        """Return the raw bytes of each email in the given paths (or of the sample emails if no paths were given)."""
+        if not options['paths']:
+            return [(SAMPLE_EMAIL_TEXT * options['sample_size']).encode('utf-8')] * options['sample_count']
+
+        return [message for path in options['paths'] for label, message in read_messages(path, options['format'])]
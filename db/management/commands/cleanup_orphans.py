@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Delete the headers, bodies, attachments, and network data which nothing refers to anymore (and the old analysis requests which were given up on)."""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analyzer.external_analysis import analysis_queue
+from db.orphans import ORPHAN_TYPES, delete_orphans, find_orphans
+
+# the type of rows which are cleaned up after the orphans (the analysis requests which were given up on and were queued more than --failed-job-days days ago)
+FAILED_JOBS_TYPE = 'failed_analysis_jobs'
+CLEANUP_TYPES = tuple(ORPHAN_TYPES) + (FAILED_JOBS_TYPE,)
+
+
+class Command(BaseCommand):
+    help = 'Delete the headers, bodies, and attachments which are not part of an email, the network data which is not in a header or body (or part of an email address or url), and the old analysis requests which were given up on. Use --dry-run to count the rows without deleting them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'types',
+            nargs='*',
+            help='the types of rows to clean up (all of them by default): {}'.format(', '.join(CLEANUP_TYPES)),
+        )
+        parser.add_argument('--dry-run', action='store_true', help='count the orphans without deleting them')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000, help='the number of rows checked (and deleted) at a time'
+        )
+        parser.add_argument(
+            '--failed-job-days',
+            type=int,
+            default=analysis_queue.FAILED_JOB_RETENTION_DAYS,
+            help='the number of days after they were queued that the analysis requests which were given up on are kept',
+        )
+        parser.add_argument(
+            '--sleep', type=float, default=0, help='the number of seconds to wait between batches (to limit the load)'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        if options['sleep'] < 0:
+            raise CommandError('--sleep cannot be negative')
+        if options['failed_job_days'] < 0:
+            raise CommandError('--failed-job-days cannot be negative')
+        unknown_types = [orphan_type for orphan_type in options['types'] if orphan_type not in CLEANUP_TYPES]
+        if unknown_types:
+            raise CommandError(
+                'Unknown types: {} (the types are: {})'.format(', '.join(unknown_types), ', '.join(CLEANUP_TYPES))
+            )
+
+        # the types are cleaned up in order because deleting the rows of a type can orphan the rows of the types after it
+        orphan_types = [
+            orphan_type for orphan_type in ORPHAN_TYPES if orphan_type in (options['types'] or ORPHAN_TYPES)
+        ]
+        for orphan_type in orphan_types:
+            checked_count = 0
+            orphan_count = 0
+            deleted_count = 0
+            for chunk_size, orphan_ids in find_orphans(orphan_type, batch_size=options['batch_size']):
+                checked_count += chunk_size
+                orphan_count += len(orphan_ids)
+                if not options['dry_run']:
+                    deleted_count += delete_orphans(orphan_type, orphan_ids)
+                self.stdout.write('Checked {} {} ({} orphans found)'.format(checked_count, orphan_type, orphan_count))
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+
+            if options['dry_run']:
+                message = 'Found {} orphaned {} (of {})'.format(orphan_count, orphan_type, checked_count)
+            else:
+                message = 'Deleted {} orphaned {} (of {})'.format(deleted_count, orphan_type, checked_count)
+            self.stdout.write(self.style.SUCCESS(message))
+
+        if FAILED_JOBS_TYPE in (options['types'] or CLEANUP_TYPES):
+            failed_job_count = analysis_queue.delete_failed_jobs(options['failed_job_days'], dry_run=options['dry_run'])
+            if options['dry_run']:
+                message = 'Found {} {} older than {} days'.format(
+                    failed_job_count, FAILED_JOBS_TYPE, options['failed_job_days']
+                )
+            else:
+                message = 'Deleted {} {} older than {} days'.format(
+                    failed_job_count, FAILED_JOBS_TYPE, options['failed_job_days']
+                )
+            self.stdout.write(self.style.SUCCESS(message))
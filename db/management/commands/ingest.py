@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Load emails from mbox files, Maildirs, and directories of .eml files into the database."""
+
+import collections
+import mailbox
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from db import db_creator
+from email_processor import processor
+
+SOURCE_FORMATS = ('auto', 'mbox', 'maildir', 'eml')
+
+
+def _source_format(path):
+    """Determine the format of the given path."""
+    if os.path.isdir(path):
+        if all(os.path.isdir(os.path.join(path, subdirectory)) for subdirectory in ('cur', 'new', 'tmp')):
+            return 'maildir'
+        return 'eml'
+    elif path.lower().endswith('.eml'):
+        return 'eml'
+    else:
+        return 'mbox'
+
+
+def _read_eml_files(path):
+    """Yield the name and content of each .eml file in the given path (which can be a file or a directory)."""
+    if os.path.isfile(path):
+        paths = [path]
+    else:
+        paths = (
+            os.path.join(directory, filename)
+            for directory, subdirectories, filenames in os.walk(path)
+            for filename in sorted(filenames)
+            if filename.lower().endswith('.eml')
+        )
+
+    for file_path in paths:
+        with open(file_path, 'rb') as f:
+            yield file_path, f.read()
+
+
+def _read_mailbox(source):
+    """Yield the key and raw content of each message in the given mailbox (without parsing the messages)."""
+    for key in source.iterkeys():
+        yield key, source.get_bytes(key)
+
+
+def read_messages(path, source_format='auto'):
+    """Yield a label (for error messages) and the raw bytes of each email in the given path."""
+    if source_format == 'auto':
+        source_format = _source_format(path)
+
+    if source_format == 'eml':
+        messages = _read_eml_files(path)
+    elif source_format == 'maildir':
+        messages = _read_mailbox(mailbox.Maildir(path, factory=None, create=False))
+    else:
+        messages = _read_mailbox(mailbox.mbox(path, factory=None, create=False))
+
+    for key, message in messages:
+        yield '{}:{}'.format(path, key), message
+
+
+def _batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _prepare_batch(batch, redaction_options):
+    """Prepare a batch of (label, raw email) tuples for the database (this is run in the worker processes). Returns the prepared emails, the statuses of the emails, and a list of the emails which could not be prepared."""
+    labels, email_texts = zip(*batch)
+    try:
+        prepared_emails, results = processor.prepare_emails(email_texts, **redaction_options)
+        return prepared_emails, [status for email_id, status in results], []
+    except Exception:
+        # prepare the emails one at a time so that one bad email does not stop the rest of the batch from being created
+        prepared_emails, statuses, errors = [], [], []
+        for label, email_text in batch:
+            try:
+                prepared, results = processor.prepare_emails([email_text], **redaction_options)
+            except Exception as e:
+                errors.append((label, '{}: {}'.format(type(e).__name__, e)))
+            else:
+                prepared_emails.extend(prepared)
+                statuses.extend(status for email_id, status in results)
+        return prepared_emails, statuses, errors
+
+
+class Command(BaseCommand):
+    help = 'Load emails from mbox files, Maildirs, or directories of .eml files. Emails which are already in the database are skipped, so an interrupted ingest can be resumed by running the command again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='mbox files, Maildirs, .eml files, or directories of .eml files')
+        parser.add_argument('--format', choices=SOURCE_FORMATS, default='auto', help='the format of the given paths')
+        parser.add_argument(
+            '--workers', type=int, default=multiprocessing.cpu_count(), help='the number of parser processes'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=200, help='the number of emails parsed and created together'
+        )
+        parser.add_argument('--submitter', default='ingest', help='the submitter recorded for the emails')
+        parser.add_argument('--redact', action='store_true', help='redact recipient data from the emails')
+        parser.add_argument('--redaction-values', default=None, help='comma separated values to redact')
+        parser.add_argument('--redact-pii', action='store_true', help='redact PII from the emails')
+        parser.add_argument(
+            '--analyze', action='store_true', help='submit the new emails for external analysis (off by default)'
+        )
+        parser.add_argument(
+            '--progress-interval', type=float, default=10, help='the number of seconds between progress reports'
+        )
+
+    def handle(self, *args, **options):
+        for path in options['paths']:
+            if not os.path.exists(path):
+                raise CommandError('{} does not exist'.format(path))
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        redaction_options = {
+            'redact_email_data': options['redact'],
+            'redaction_values': options['redaction_values'],
+            'redact_pii': options['redact_pii'],
+        }
+        self.counts = collections.Counter()
+        self.start_time = self.last_report_time = time.time()
+
+        messages = (message for path in options['paths'] for message in read_messages(path, options['format']))
+        batches = _batches(messages, options['batch_size'])
+
+        if options['workers'] > 1:
+            # the worker processes open their own database connections (a connection must not be shared across a fork)
+            connections.close_all()
+            pool = multiprocessing.Pool(options['workers'])
+            try:
+                # limit the number of batches in flight so that memory use is bounded regardless of the size of the source
+                pending = collections.deque()
+                for batch in batches:
+                    pending.append(pool.apply_async(_prepare_batch, (batch, redaction_options)))
+                    if len(pending) >= options['workers'] * 2:
+                        self._write(pending.popleft().get(), options)
+                while pending:
+                    self._write(pending.popleft().get(), options)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for batch in batches:
+                self._write(_prepare_batch(batch, redaction_options), options)
+
+        self._report(final=True)
+
+    def _write(self, prepared_batch, options):
+        """Create the prepared emails in the database (all writes happen in this process)."""
+        prepared_emails, statuses, errors = prepared_batch
+        self.counts.update(statuses)
+
+        # the same email may have been prepared by more than one worker at a time, so check for emails created since the batch was prepared
+        created_email_ids = db_creator.existing_email_ids(
+            [prepared_email['original_sha256'] for prepared_email in prepared_emails]
+        )
+        if created_email_ids:
+            prepared_emails = [
+                prepared_email
+                for prepared_email in prepared_emails
+                if prepared_email['original_sha256'] not in created_email_ids
+            ]
+            self.counts['created'] -= len(created_email_ids)
+            self.counts['duplicate'] += len(created_email_ids)
+
+        db_creator.bulk_create_emails(
+            prepared_emails, options['submitter'], perform_external_analysis=options['analyze']
+        )
+
+        self.counts['error'] += len(errors)
+        self.counts['bytes'] += sum(len(prepared_email['full_text']) for prepared_email in prepared_emails)
+        for label, error in errors:
+            self.stderr.write('Unable to ingest {}: {}'.format(label, error))
+
+        if time.time() - self.last_report_time >= options['progress_interval']:
+            self._report()
+
+    def _report(self, final=False):
+        self.last_report_time = time.time()
+        elapsed_time = max(self.last_report_time - self.start_time, 0.001)
+        processed_count = sum(self.counts[status] for status in ('created', 'duplicate', 'invalid', 'error'))
+
+        message = '{} {} emails in {:.1f}s ({:.1f} emails/s, {:.2f} MB/s): {} created, {} skipped (already in the database), {} invalid, {} errors'.format(
+            'Ingested' if final else 'Processed',
+            processed_count,
+            elapsed_time,
+            processed_count / elapsed_time,
+            self.counts['bytes'] / elapsed_time / 1024 / 1024,
+            self.counts['created'],
+            self.counts['duplicate'],
+            self.counts['invalid'],
+            self.counts['error'],
+        )
+        if final:
+            self.stdout.write(self.style.SUCCESS(message))
+        else:
+            self.stdout.write(message)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Move the full text of the large emails, bodies, and attachments which are already in the database into the blob store."""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models.functions import Length
+
+from db import blob_store
+from db.models import Attachment, Body, Email
+from email_processor.parsed_email import ParsedEmail
+from email_processor.processor import searchable_email_text
+
+
+class Command(BaseCommand):
+    help = 'Move the full text of the emails, bodies (with decoded text), and attachments which are larger than the blob store threshold (the BLOB_STORE_THRESHOLD environment variable) into the blob store.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='the number of rows moved at a time')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        for model_name, rows in (
+            ('emails', Email.objects.all()),
+            ('bodies', Body.objects.filter(decoded_text__isnull=False).exclude(decoded_text='')),
+            ('attachments', Attachment.objects.all()),
+        ):
+            rows = (
+                rows.filter(blob_key='')
+                .annotate(full_text_length=Length('full_text'))
+                .filter(full_text_length__gt=blob_store.BLOB_STORE_THRESHOLD)
+                .order_by('id')
+            )
+            moved_count = 0
+            last_id = ''
+            while True:
+                ids = list(rows.filter(id__gt=last_id).values_list('id', flat=True)[: options['batch_size']])
+                if not ids:
+                    break
+
+                with transaction.atomic():
+                    # the rows are locked so that the full text which is stored is the full text which is removed from the row
+                    for row_id, full_text in (
+                        rows.model.objects.select_for_update().filter(pk__in=ids).values_list('id', 'full_text')
+                    ):
+                        # the searchable text of an email is kept in the database (see `db.db_creator.create_email`)
+                        inline_text = ''
+                        if model_name == 'emails':
+                            inline_text = searchable_email_text(ParsedEmail(full_text))
+                        full_text, blob_key = blob_store.store_full_text(
+                            model_name, row_id, full_text, inline_text=inline_text
+                        )
+                        rows.model.objects.filter(pk=row_id).update(full_text=full_text, blob_key=blob_key)
+
+                moved_count += len(ids)
+                last_id = ids[-1]
+                self.stdout.write('Moved {} {}'.format(moved_count, model_name))
+
+            self.stdout.write(
+                self.style.SUCCESS('Moved the full text of {} {} into the blob store'.format(moved_count, model_name))
+            )
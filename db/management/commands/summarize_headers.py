@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Set the summary fields (subject, from, to, date, and message id) of the headers created before the summary fields existed."""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from db.models import Header
+
+SUMMARY_FIELDS = ('subject_value', 'has_subject', 'from_value', 'to_value', 'date_value', 'message_id_value')
+
+
+class Command(BaseCommand):
+    help = 'Set the summary fields (subject, from, to, date, and message id) of the headers which have not been summarized from their data. Use --all to summarize every header again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='the number of headers updated at a time')
+        parser.add_argument('--all', action='store_true', help='summarize all of the headers')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        headers = Header.objects.order_by('id')
+        if not options['all']:
+            headers = headers.filter(subject_value__isnull=True)
+
+        updated_count = 0
+        last_header_id = ''
+        while True:
+            batch = list(headers.filter(id__gt=last_header_id).only('id', 'data')[: options['batch_size']])
+            if not batch:
+                break
+
+            with transaction.atomic():
+                for header in batch:
+                    header.summarize()
+                    # the headers are updated rather than saved so that their modified dates are not changed
+                    Header.objects.filter(pk=header.id).update(
+                        **{field_name: getattr(header, field_name) for field_name in SUMMARY_FIELDS}
+                    )
+
+            updated_count += len(batch)
+            last_header_id = batch[-1].id
+            self.stdout.write('Summarized {} headers'.format(updated_count))
+
+        self.stdout.write(self.style.SUCCESS('Summarized {} headers'.format(updated_count)))
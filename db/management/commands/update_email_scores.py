@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Recalculate the stored scores of the emails from their analyses (e.g. for emails analyzed before the scores were stored)."""
+
+import collections
+
+from django.core.management.base import BaseCommand, CommandError
+
+from db.models import Analysis, Email
+from utility import utility
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the stored scores of the emails which have been analyzed from the most recent analysis from each source.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='the number of emails updated at a time')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        emails = Email.objects.filter(analysis__isnull=False).distinct().order_by('id')
+        updated_count = 0
+        last_email_id = ''
+        while True:
+            email_ids = list(emails.filter(id__gt=last_email_id).values_list('id', flat=True)[: options['batch_size']])
+            if not email_ids:
+                break
+
+            # the most recent analysis from each source for each of the emails
+            source_scores = collections.defaultdict(dict)
+            analyses = (
+                Analysis.objects.filter(email_id__in=email_ids)
+                .order_by('email_id', 'source', '-first_seen')
+                .distinct('email_id', 'source')
+                .values_list('email_id', 'source', 'score')
+            )
+            for email_id, source, score in analyses:
+                source_scores[email_id][source] = float(utility._calculate(score, source))
+
+            for email_id, scores in source_scores.items():
+                Email.objects.filter(pk=email_id).update(
+                    source_scores=scores, score=utility.email_score(list(scores.values()))
+                )
+
+            updated_count += len(email_ids)
+            last_email_id = email_ids[-1]
+
+        self.stdout.write(self.style.SUCCESS('Updated the scores of {} emails'.format(updated_count)))
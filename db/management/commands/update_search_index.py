@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Build the search index of the emails which are not indexed yet (e.g. emails created before the search index was added)."""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from db.db_creator import create_header_fields
+from db.models import Email, Header
+from db.search_index import create_trigram_indexes, update_search_vectors
+
+
+class Command(BaseCommand):
+    help = 'Build the search vectors of the emails which do not have one and the header fields of the headers which do not have any. Use --all to rebuild the search vectors of every email.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='the number of emails updated by each query')
+        parser.add_argument('--all', action='store_true', help='rebuild the search vectors of all of the emails')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        create_trigram_indexes()
+
+        emails = Email.objects.order_by('id')
+        if not options['all']:
+            emails = emails.filter(search_vector__isnull=True)
+
+        updated_count = 0
+        last_email_id = ''
+        while True:
+            email_ids = list(emails.filter(id__gt=last_email_id).values_list('id', flat=True)[: options['batch_size']])
+            if not email_ids:
+                break
+            update_search_vectors(email_ids)
+            updated_count += len(email_ids)
+            last_email_id = email_ids[-1]
+            self.stdout.write('Updated the search vectors of {} emails'.format(updated_count))
+
+        self.stdout.write(self.style.SUCCESS('Updated the search vectors of {} emails'.format(updated_count)))
+
+        headers = Header.objects.filter(headerfield__isnull=True).order_by('id')
+        created_count = 0
+        last_header_id = ''
+        while True:
+            new_headers = list(headers.filter(id__gt=last_header_id).only('id', 'data')[: options['batch_size']])
+            if not new_headers:
+                break
+            create_header_fields(new_headers)
+            created_count += len(new_headers)
+            last_header_id = new_headers[-1].id
+
+        self.stdout.write(self.style.SUCCESS('Created the header fields of {} headers'.format(created_count)))
@@ -2,50 +2,30 @@
 # -*- coding: utf-8 -*-
 
 from decimal import Decimal
+from email.utils import parsedate_to_datetime
 import re
 
 from django.db import models
 from django.utils import timezone
 from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 
 from utility import utility
+from . import blob_store
 
 JOIN_STRING = '|||'
-
-
-def _get_related_headers_and_bodies(network_data_object, email, get_related_headers=True):
-    """."""
-    links = []
-    related_headers = None
-    related_bodies = network_data_object.bodies.all()
-    MAX_RESULTS_LIMIT = 4
-
-    if get_related_headers:
-        related_headers = network_data_object.headers.all()
-        for header in related_headers[:MAX_RESULTS_LIMIT]:
-            if header.id != email.header.id:
-                link_text = '(header) {}'.format(header.subject)
-                if link_text not in [l['text'] for l in links]:
-                    links.append({'link': '/{}'.format(header.link), 'text': link_text})
-    for body in related_bodies[:MAX_RESULTS_LIMIT]:
-        if body.id not in [b.id for b in email.bodies.all()]:
-            for link in body.links:
-                link_text = '(body) {}'.format(body.email_set.all()[0].header.subject)
-                if link_text not in [l['text'] for l in links]:
-                    links.append({'link': '/{}'.format(link), 'text': link_text})
-
-    if related_bodies and len(related_bodies) > MAX_RESULTS_LIMIT:
-        links.append({'link': '/search?q={}'.format(network_data_object), 'text': ''})
-    if related_headers and len(related_headers) > MAX_RESULTS_LIMIT:
-        links.append({'link': '/search?q={}'.format(network_data_object), 'text': ''})
-
-    return links
+# the text search configuration used to build and query the search vectors of the emails
+SEARCH_CONFIG = 'english'
 
 
 class Email(models.Model):
     id = models.CharField(max_length=64, primary_key=True)
     cleaned_id = models.CharField(max_length=64)
+    # the full text of the email or, if the full text is stored in the blob store, the searchable text of the email (the full text without the payloads of its large attachments, see `email_processor.processor.searchable_email_text`)
     full_text = models.TextField()
+    # the key of the full text in the blob store if the full text is stored there (see `db.blob_store`)
+    blob_key = models.CharField(max_length=100, blank=True, default='', editable=False)
     first_seen = models.DateTimeField(editable=False)
     modified = models.DateTimeField()
     submitter = models.CharField(max_length=16)
@@ -55,6 +35,20 @@ class Email(models.Model):
     bodies = models.ManyToManyField('Body')
     attachments = models.ManyToManyField('Attachment', blank=True)
     tlsh_hash = models.CharField(max_length=70, null=True, blank=True)
+    # the header values and body text of the email (this is maintained by `db.search_index.update_search_vectors`)
+    search_vector = SearchVectorField(null=True, editable=False)
+    # the weighted score of the most recent analysis from each source (by source) and the email's score calculated from them (these are maintained by `db.db_creator.update_email_score`)
+    source_scores = JSONField(default=dict, editable=False)
+    score = models.FloatField(default=0.5, db_index=True, editable=False)
+    # incremented whenever something shown on the email's details page changes so that the cached details page is rendered again (see `db.db_creator.bump_details_versions` and `details.render_cache`)
+    details_version = models.IntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector']),
+            models.Index(fields=['first_seen', 'id']),
+            models.Index(fields=['modified', 'id']),
+        ]
 
     def save(self, *args, **kwargs):
         """On save, update timestamps"""
@@ -63,6 +57,15 @@ class Email(models.Model):
         self.modified = timezone.now()
         return super(Email, self).save(*args, **kwargs)
 
+    @property
+    def text(self):
+        """Return the full text of the email (from the blob store if it is stored there)."""
+        return blob_store.read_full_text(self.full_text, self.blob_key)
+
+    def open_full_text(self):
+        """Return a binary file object for reading the full text of the email."""
+        return blob_store.open_full_text(self.full_text, self.blob_key)
+
     def _structure_as_html_iterator(
         self,
         current_structure,
@@ -141,105 +144,10 @@ class Email(models.Model):
         return structure
 
     def network_data(self):
-        """Get the network data for the given email."""
-        # prepare the network data
-        network_data = {
-            'header': {'hosts': {}, 'ip_addresses': {}, 'email_addresses': {}},
-            'bodies': {'hosts': {}, 'ip_addresses': {}, 'email_addresses': {}, 'urls': {}},
-        }
-        # this is simply a list of all of the network data so that the user can copy it
-        network_data_flat_list = []
-        network_data_overlaps = 0
-        # right now (may, 2019), this value is primarily used to determine whether we need to display the analysis data in the template
-        network_data_count = 0
-
-        # get network data from headers
-        if self.header.host_set.exists:
-            for host in self.header.host_set.all():
-                network_data_count += 1
-                if utility.domain_is_common(host.host_name):
-                    data = [
-                        {
-                            'link': '/search?q=dom({})'.format(host.host_name),
-                            'text': 'view more (this is a generic domain and no overlaps will be shown)...',
-                        }
-                    ]
-                else:
-                    data = _get_related_headers_and_bodies(host, self)
-                    network_data_overlaps += len(data)
-                network_data['header']['hosts'][host.host_name] = data
-                network_data_flat_list.append(host.host_name)
-        if self.header.ipaddress_set.exists:
-            for address in self.header.ipaddress_set.all():
-                network_data_count += 1
-                if utility.ip_address_is_common(address.ip_address):
-                    data = [
-                        {
-                            'link': '/search?q={}'.format(address.ip_address),
-                            'text': 'view more (this is a generic IP address and no overlaps will be shown)...',
-                        }
-                    ]
-                else:
-                    data = _get_related_headers_and_bodies(address, self)
-                    network_data_overlaps += len(data)
-                network_data['header']['ip_addresses'][address.ip_address] = data
-                network_data_flat_list.append(address.ip_address)
-        if self.header.emailaddress_set.exists:
-            for address in self.header.emailaddress_set.all():
-                network_data_count += 1
-                data = _get_related_headers_and_bodies(address, self)
-                network_data_overlaps += len(data)
-                network_data['header']['email_addresses'][address.email_address] = data
-                network_data_flat_list.append(address.email_address)
-
-        # get network data from bodies
-        for body in self.bodies.all():
-            if body.host_set.exists:
-                for host in body.host_set.all():
-                    network_data_count += 1
-                    if utility.domain_is_common(host.host_name):
-                        data = [
-                            {
-                                'link': '/search?q=dom({})'.format(host.host_name),
-                                'text': 'view more (this is a generic domain and no overlaps will be shown)...',
-                            }
-                        ]
-                    else:
-                        data = _get_related_headers_and_bodies(host, self)
-                        network_data_overlaps += len(data)
-                    network_data['bodies']['hosts'][host.host_name] = data
-                    network_data_flat_list.append(host.host_name)
-            if body.ipaddress_set.exists:
-                for address in body.ipaddress_set.all():
-                    network_data_count += 1
-                    if utility.ip_address_is_common(address.ip_address):
-                        data = [
-                            {
-                                'link': '/search?q={}'.format(address.ip_address),
-                                'text': 'view more (this is a generic IP address and no overlaps will be shown)...',
-                            }
-                        ]
-                    else:
-                        data = _get_related_headers_and_bodies(address, self)
-                        network_data_overlaps += len(data)
-                    network_data['bodies']['ip_addresses'][address.ip_address] = data
-                    network_data_flat_list.append(address.ip_address)
-            if body.emailaddress_set.exists:
-                for address in body.emailaddress_set.all():
-                    network_data_count += 1
-                    data = _get_related_headers_and_bodies(address, self)
-                    network_data_overlaps += len(data)
-                    network_data['bodies']['email_addresses'][address.email_address] = data
-                    network_data_flat_list.append(address.email_address)
-            if body.url_set.exists:
-                for url in body.url_set.all():
-                    network_data_count += 1
-                    data = _get_related_headers_and_bodies(url, self, get_related_headers=False)
-                    network_data_overlaps += len(data)
-                    network_data['bodies']['urls'][url.url] = data
-                    network_data_flat_list.append(url.url)
-
-        return network_data, network_data_flat_list, network_data_overlaps, network_data_count
+        """Get the network data for the given email (see `db.network_data`)."""
+        from .network_data import NetworkDataResolver
+
+        return NetworkDataResolver(self).resolve()
 
     def __str__(self):
         return str(self.id)
@@ -252,34 +160,65 @@ class Header(models.Model):
     modified = models.DateTimeField()
     subject_suspicious_votes = models.IntegerField(default=0)
     subject_not_suspicious_votes = models.IntegerField(default=0)
+    # the values of the common header keys (these are found in the data once, by `summarize`, so they can be displayed and searched without reading the data) - the subject value is None until the header has been summarized
+    subject_value = models.TextField(null=True, editable=False)
+    # whether the header has a subject (an empty subject is displayed as it is, but a missing one is displayed as 'N/A')
+    has_subject = models.BooleanField(default=False, editable=False)
+    # the subject, from, and to values are searched with the `sub()`, `from()`, and `to()` search functions (using their trigram indexes, see `db.search_index`), so they are not truncated
+    from_value = models.TextField(blank=True, default='', editable=False)
+    to_value = models.TextField(blank=True, default='', editable=False)
+    date_value = models.DateTimeField(null=True, editable=False)
+    message_id_value = models.TextField(blank=True, default='', editable=False)
 
     def save(self, *args, **kwargs):
         """On save, update timestamps"""
         if not self.first_seen:
             self.first_seen = timezone.now()
         self.modified = timezone.now()
+        if self.subject_value is None:
+            self.summarize()
         return super(Header, self).save(*args, **kwargs)
 
+    def summarize(self):
+        """Set the values of the common header keys from the first value of each key in the header's data (this does not save the header)."""
+        first_values = {}
+        for header_key, header_value in self.data:
+            first_values.setdefault(header_key.lower(), header_value)
+
+        # if the email has been run through SpamAssassin, the subject will be changed and the original subject is stored in the "X-Spam-Prev-Subject" field
+        self.subject_value = first_values.get('x-spam-prev-subject', first_values.get('subject', ''))
+        self.has_subject = 'x-spam-prev-subject' in first_values or 'subject' in first_values
+        for field_name, header_key in (('from_value', 'from'), ('to_value', 'to'), ('message_id_value', 'message-id')):
+            setattr(self, field_name, first_values.get(header_key, ''))
+
+        self.date_value = None
+        if first_values.get('date'):
+            try:
+                self.date_value = parsedate_to_datetime(first_values['date'])
+            except (TypeError, ValueError, IndexError, OverflowError):
+                pass
+            else:
+                if timezone.is_naive(self.date_value):
+                    self.date_value = timezone.make_aware(self.date_value, timezone.utc)
+
     @property
     def link(self):
         """Return a link to the first email with the header."""
-        email_set = self.email_set.all()
+        # only the id of the first email is read (rather than every email with the header)
+        email_id = self.email_set.values_list('id', flat=True).first()
 
-        if any(email_set):
-            return 'email/{}{}'.format(email_set[0].id, '#header')
+        if email_id:
+            return 'email/{}{}'.format(email_id, '#header')
 
     @property
     def subject(self):
-        # if the email has been run through SpamAssassin, the subject will be changed and the original subject is stored in the "X-Spam-Prev-Subject" field
-        if self.get_header_key_values('x-spam-prev-subject'):
-            subject_value = self.get_header_key_values('x-spam-prev-subject')[0]
-        elif self.get_header_key_values('subject'):
-            subject_value = self.get_header_key_values('subject')[0]
+        # headers created before the summary fields existed are summarized when they are first displayed (see the `summarize_headers` command)
+        if self.subject_value is None:
+            self.summarize()
         # if there is no subject for the email, return 'N/A' (I'm returning a string rather than None because this function is often used to display the subject line in the UI)
-        else:
-            subject_value = 'N/A'
-
-        return subject_value
+        if self.subject_value or self.has_subject:
+            return self.subject_value
+        return 'N/A'
 
     def get_header_key_values(self, desired_header_key):
         header_values = []
@@ -312,12 +251,31 @@ class Header(models.Model):
         return string
 
 
+class HeaderField(models.Model):
+    """A key and value from a header (used to search the values of specific header keys)."""
+
+    header = models.ForeignKey('Header', on_delete=models.CASCADE)
+    # the position of the field in the header
+    position = models.IntegerField()
+    # the key is stored in lowercase so that searches for a key are case insensitive
+    key = models.TextField(db_index=True)
+    value = models.TextField()
+
+    class Meta:
+        unique_together = [('header', 'position')]
+
+    def __str__(self):
+        return '{}: {}'.format(self.key, self.value)
+
+
 class Body(models.Model):
     id = models.CharField(max_length=64, primary_key=True)
     first_seen = models.DateTimeField(editable=False)
     full_text = models.TextField()
     decoded_text = models.TextField(null=True, blank=True)
     content_type = models.CharField(max_length=50, null=True, blank=True)
+    # the key of the full text in the blob store if the full text is stored there rather than in the full_text field (see `db.blob_store`)
+    blob_key = models.CharField(max_length=100, blank=True, default='', editable=False)
 
     def save(self, *args, **kwargs):
         """On save, update timestamps"""
@@ -325,11 +283,20 @@ class Body(models.Model):
             self.first_seen = timezone.now()
         return super(Body, self).save(*args, **kwargs)
 
+    @property
+    def text(self):
+        """Return the full text of the body (from the blob store if it is stored there)."""
+        return blob_store.read_full_text(self.full_text, self.blob_key)
+
+    def open_full_text(self):
+        """Return a binary file object for reading the full text of the body."""
+        return blob_store.open_full_text(self.full_text, self.blob_key)
+
     @property
     def links(self):
         links = []
-        for email in self.email_set.all():
-            links.append('email/{}{}'.format(email.id, '#bodies'))
+        for email_id in self.email_set.values_list('id', flat=True):
+            links.append('email/{}{}'.format(email_id, '#bodies'))
         return links
 
     def __str__(self):
@@ -345,7 +312,11 @@ class Attachment(models.Model):
     # content_transfer_encoding = models.CharField(max_length=100)
     md5 = models.CharField(max_length=32)
     sha1 = models.CharField(max_length=40)
+    # the size (in bytes) of the decoded content of the attachment
+    size = models.IntegerField(default=0)
     full_text = models.TextField()
+    # the key of the full text in the blob store if the full text is stored there rather than in the full_text field (see `db.blob_store`)
+    blob_key = models.CharField(max_length=100, blank=True, default='', editable=False)
     first_seen = models.DateTimeField(editable=False)
     modified = models.DateTimeField()
 
@@ -356,6 +327,15 @@ class Attachment(models.Model):
         self.modified = timezone.now()
         return super(Attachment, self).save(*args, **kwargs)
 
+    @property
+    def text(self):
+        """Return the full text of the attachment (from the blob store if it is stored there)."""
+        return blob_store.read_full_text(self.full_text, self.blob_key)
+
+    def open_full_text(self):
+        """Return a binary file object for reading the full text of the attachment."""
+        return blob_store.open_full_text(self.full_text, self.blob_key)
+
     @property
     def sha256(self):
         return str(self.id)
@@ -368,6 +348,21 @@ class Attachment(models.Model):
         return str(self.id)
 
 
+class BlobChunk(models.Model):
+    """A piece of a blob stored in the database by `db.blob_store.DatabaseBlobStore`."""
+
+    key = models.CharField(max_length=100)
+    # the position of the chunk in the blob
+    position = models.IntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = [('key', 'position')]
+
+    def __str__(self):
+        return '{} ({})'.format(self.key, self.position)
+
+
 class Analysis(models.Model):
     notes = models.TextField()
     source = models.CharField(max_length=50)
@@ -396,6 +391,40 @@ class Analysis(models.Model):
         return '{}: {}'.format(self.email.id, self.first_seen)
 
 
+class AnalysisJob(models.Model):
+    """A request for the external analysis server which has not been sent yet or whose result has not been posted back yet (see `analyzer.external_analysis.analysis_queue`)."""
+
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    # the route on the analysis server ('analysis' or 'network_data')
+    route = models.CharField(max_length=20)
+    # the type ('header' or 'body') and id of the item whose network data is requested (for the 'analysis' route, this is the email)
+    item_type = models.CharField(max_length=20, blank=True)
+    item_id = models.CharField(max_length=64)
+    email_id = models.CharField(max_length=64)
+    status = models.CharField(max_length=10, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    # the number of times the request was handed to the analysis server without its result being posted back
+    deliveries = models.IntegerField(default=0)
+    # when the request should be sent next (for a sent request, this is when it is sent again if its result has not been posted back)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    first_seen = models.DateTimeField(editable=False)
+
+    class Meta:
+        index_together = [('status', 'next_attempt')]
+
+    def save(self, *args, **kwargs):
+        """On save, update timestamps"""
+        if not self.first_seen:
+            self.first_seen = timezone.now()
+        return super(AnalysisJob, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return '{} {} {}: {}'.format(self.route, self.item_type, self.item_id, self.status)
+
+
 class Host(models.Model):
     # TODO: is this the proper length of a hostname (255 characters)? (3)
     host_name = models.CharField(max_length=255, primary_key=True)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Find the network data of an email and the other emails which share it using a fixed number of queries (rather than a few queries for every piece of network data)."""
+
+import collections
+
+from django.db import connections
+
+from utility import utility
+from .models import Email, Header, Host, IPAddress, EmailAddress, Url
+
+# the maximum number of related headers and bodies which are linked for each piece of network data
+MAX_RESULTS_LIMIT = 4
+
+# the first few headers/bodies related to each of the given pieces of network data (in the order they were related)
+RELATED_ITEMS_SQL = '''
+SELECT {network_data}, {item} FROM (
+    SELECT {network_data}, {item}, ROW_NUMBER() OVER (PARTITION BY {network_data} ORDER BY id) AS position
+    FROM {table}
+    WHERE {network_data} = ANY(%s)
+) related_items
+WHERE position <= %s
+ORDER BY {network_data}, position
+'''
+
+# the models of each type of network data, the field with the value which is displayed, and whether or not it is found in headers
+NETWORK_DATA_TYPES = collections.OrderedDict(
+    [
+        ('hosts', (Host, 'host_name', True)),
+        ('ip_addresses', (IPAddress, 'ip_address', True)),
+        ('email_addresses', (EmailAddress, 'email_address', True)),
+        ('urls', (Url, 'url', False)),
+    ]
+)
+
+COMMON_DOMAIN_TEXT = 'view more (this is a generic domain and no overlaps will be shown)...'
+COMMON_IP_ADDRESS_TEXT = 'view more (this is a generic IP address and no overlaps will be shown)...'
+
+
+def is_common(network_data_type, network_data_id):
+    """Return whether the given network data is so common that no overlaps are shown for it."""
+    if network_data_type == 'hosts':
+        return utility.domain_is_common(network_data_id)
+    elif network_data_type == 'ip_addresses':
+        return utility.ip_address_is_common(network_data_id)
+    return False
+
+
+def _related_items(model, item_field_name, network_data_ids, limit=MAX_RESULTS_LIMIT + 1):
+    """Return the ids of the first few headers or bodies (as given by the item_field_name) related to each of the given pieces of network data (by network data id). By default, one more than the MAX_RESULTS_LIMIT is returned so that we know whether there are more to see."""
+    related_items = collections.defaultdict(list)
+    if not network_data_ids:
+        return related_items
+
+    field = model._meta.get_field(item_field_name)
+    through_model = field.remote_field.through
+    connection = connections[through_model.objects.db]
+    quote_name = connection.ops.quote_name
+    sql = RELATED_ITEMS_SQL.format(
+        network_data=quote_name(through_model._meta.get_field(field.m2m_field_name()).column),
+        item=quote_name(through_model._meta.get_field(field.m2m_reverse_field_name()).column),
+        table=quote_name(through_model._meta.db_table),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [list(network_data_ids), limit])
+        for network_data_id, item_id in cursor.fetchall():
+            related_items[network_data_id].append(item_id)
+    return related_items
+
+
+def network_data_in(model, item_field_name, item_ids, *fields):
+    """Return the given fields of the network data of the given model which is in the given headers or bodies (as given by the item_field_name) in the order it was related."""
+    field = model._meta.get_field(item_field_name)
+    return (
+        field.remote_field.through.objects.filter(**{'{}__in'.format(field.m2m_reverse_name()): item_ids})
+        .order_by('id')
+        .values_list(field.m2m_reverse_name(), field.m2m_column_name(), *fields)
+    )
+
+
+def network_data_values(model, value_field_name, item_field_name, item_ids):
+    """Return the (header/body id, network data id, value) of the network data of the given model which is in the given headers or bodies (as given by the item_field_name) in the order it was related."""
+    if model._meta.pk.name == value_field_name:
+        return [
+            (item_id, network_data_id, network_data_id)
+            for item_id, network_data_id in network_data_in(model, item_field_name, item_ids)
+        ]
+    # the urls are the only network data whose id is not its value
+    value_field = '{}__{}'.format(model._meta.get_field(item_field_name).m2m_field_name(), value_field_name)
+    return list(network_data_in(model, item_field_name, item_ids, value_field))
+
+
+def overlapping_network_data_ids(model, item_field_name, new_link_counts, removed=False):
+    """Return the network data of the given model (from the given number of links to headers or bodies which were just added to each piece of network data by network data id, as given by the item_field_name) which is shown as an overlap on the details pages of the emails with it and whose overlaps were changed by the links. The pages show links to the first few headers and bodies with each piece of network data (see `_related_items`), so new links only change them if there were no more than MAX_RESULTS_LIMIT links to the network data before. If the links were removed, all of the given network data is returned (there is no way to tell where the removed links were). Network data which is too common for overlaps to be shown is skipped."""
+    network_data_type = next(
+        name for name, (model_, value_field_name, in_headers) in NETWORK_DATA_TYPES.items() if model_ is model
+    )
+    new_link_counts = {
+        network_data_id: count
+        for network_data_id, count in new_link_counts.items()
+        if not is_common(network_data_type, network_data_id)
+    }
+    if removed or not new_link_counts:
+        return list(new_link_counts)
+
+    # the new links are the last links to the network data (they have the largest ids), so there were no more than MAX_RESULTS_LIMIT links before them if there are no more than MAX_RESULTS_LIMIT + the number of new links now
+    limit = MAX_RESULTS_LIMIT + 1 + max(new_link_counts.values())
+    related_items = _related_items(model, item_field_name, list(new_link_counts), limit=limit)
+    return [
+        network_data_id
+        for network_data_id, count in new_link_counts.items()
+        if len(related_items.get(network_data_id, [])) - count <= MAX_RESULTS_LIMIT
+    ]
+
+
+class NetworkDataResolver(object):
+    """Resolve the network data of an email and the links to the other headers and bodies which share it."""
+
+    def __init__(self, email):
+        self.email = email
+
+    def _find_network_data(self):
+        """Find the network data in the email's header and in each of the email's bodies (in the order of the bodies)."""
+        self.body_ids = list(
+            Email.bodies.through.objects.filter(email_id=self.email.id).order_by('id').values_list('body_id', flat=True)
+        )
+        # network data by the item (header or body) it was found in and by network data type
+        self.header_network_data = collections.OrderedDict()
+        self.body_network_data = collections.OrderedDict(
+            (body_id, collections.OrderedDict()) for body_id in self.body_ids
+        )
+
+        for network_data_type, (model, value_field_name, in_headers) in NETWORK_DATA_TYPES.items():
+            if in_headers:
+                self.header_network_data[network_data_type] = [
+                    (network_data_id, value)
+                    for header_id, network_data_id, value in network_data_values(
+                        model, value_field_name, 'headers', [self.email.header_id]
+                    )
+                ]
+
+            for body_id, network_data_id, value in network_data_values(
+                model, value_field_name, 'bodies', self.body_ids
+            ):
+                self.body_network_data[body_id].setdefault(network_data_type, []).append((network_data_id, value))
+
+    def _find_related_items(self):
+        """Find the first few headers and bodies related to each piece of network data, the first email of each of those bodies, and the headers needed to describe them."""
+        self.related_headers = {}
+        self.related_bodies = {}
+        for network_data_type, (model, value_field_name, in_headers) in NETWORK_DATA_TYPES.items():
+            network_data_ids = {
+                network_data_id for network_data_id, value in self.header_network_data.get(network_data_type, [])
+            }
+            for body_network_data in self.body_network_data.values():
+                network_data_ids.update(
+                    network_data_id for network_data_id, value in body_network_data.get(network_data_type, [])
+                )
+            network_data_ids = [
+                network_data_id
+                for network_data_id in network_data_ids
+                if not self._is_common(network_data_type, network_data_id)
+            ]
+
+            if in_headers:
+                self.related_headers[network_data_type] = _related_items(model, 'headers', network_data_ids)
+            self.related_bodies[network_data_type] = _related_items(model, 'bodies', network_data_ids)
+
+        related_header_ids = {
+            header_id
+            for related_headers in self.related_headers.values()
+            for header_ids in related_headers.values()
+            for header_id in header_ids[:MAX_RESULTS_LIMIT]
+        }
+        related_body_ids = {
+            body_id
+            for related_bodies in self.related_bodies.values()
+            for body_ids in related_bodies.values()
+            for body_id in body_ids[:MAX_RESULTS_LIMIT]
+        }
+        related_header_ids.discard(self.email.header_id)
+        related_body_ids.difference_update(self.body_ids)
+
+        # the first email with each of the related bodies (by body id) as (email id, header id)
+        self.body_first_emails = {}
+        if related_body_ids:
+            for body_id, email_id, header_id in (
+                Email.bodies.through.objects.filter(body_id__in=related_body_ids)
+                .order_by('body_id', 'id')
+                .distinct('body_id')
+                .values_list('body_id', 'email_id', 'email__header_id')
+            ):
+                self.body_first_emails[body_id] = (email_id, header_id)
+
+        # the first email with each of the related headers (by header id)
+        self.header_first_emails = {}
+        if related_header_ids:
+            self.header_first_emails = dict(
+                Email.objects.filter(header_id__in=related_header_ids)
+                .order_by('header_id', 'first_seen', 'id')
+                .distinct('header_id')
+                .values_list('header_id', 'id')
+            )
+
+        header_ids = related_header_ids | {header_id for email_id, header_id in self.body_first_emails.values()}
+        self.headers = {}
+        if header_ids:
+            self.headers = {
+                header.id: header
+                for header in Header.objects.filter(id__in=header_ids).only('id', 'subject_value', 'has_subject')
+            }
+
+    def _is_common(self, network_data_type, network_data_id):
+        return is_common(network_data_type, network_data_id)
+
+    def _links(self, network_data_type, network_data_id, value):
+        """Return the links to the headers and bodies which share the given network data with the email."""
+        links = []
+        related_headers = self.related_headers.get(network_data_type, {}).get(network_data_id, [])
+        related_bodies = self.related_bodies[network_data_type].get(network_data_id, [])
+
+        for header_id in related_headers[:MAX_RESULTS_LIMIT]:
+            if header_id != self.email.header_id:
+                link_text = '(header) {}'.format(self.headers[header_id].subject)
+                if link_text not in [l['text'] for l in links]:
+                    header_link = None
+                    if header_id in self.header_first_emails:
+                        header_link = 'email/{}{}'.format(self.header_first_emails[header_id], '#header')
+                    links.append({'link': '/{}'.format(header_link), 'text': link_text})
+        for body_id in related_bodies[:MAX_RESULTS_LIMIT]:
+            if body_id not in self.body_ids and body_id in self.body_first_emails:
+                email_id, header_id = self.body_first_emails[body_id]
+                link_text = '(body) {}'.format(self.headers[header_id].subject)
+                if link_text not in [l['text'] for l in links]:
+                    links.append({'link': '/email/{}{}'.format(email_id, '#bodies'), 'text': link_text})
+
+        if len(related_bodies) > MAX_RESULTS_LIMIT:
+            links.append({'link': '/search?q={}'.format(value), 'text': ''})
+        if len(related_headers) > MAX_RESULTS_LIMIT:
+            links.append({'link': '/search?q={}'.format(value), 'text': ''})
+
+        return links
+
+    def _data(self, network_data_type, network_data_id, value):
+        """Return the data displayed for the given network data and whether or not it counts as an overlap."""
+        if network_data_type == 'hosts' and self._is_common(network_data_type, network_data_id):
+            return [{'link': '/search?q=dom({})'.format(value), 'text': COMMON_DOMAIN_TEXT}], False
+        elif network_data_type == 'ip_addresses' and self._is_common(network_data_type, network_data_id):
+            return [{'link': '/search?q={}'.format(value), 'text': COMMON_IP_ADDRESS_TEXT}], False
+        return self._links(network_data_type, network_data_id, value), True
+
+    def resolve(self):
+        """Return the network data of the email (by location and type), a list of all of the network data, the number of links to other emails, and the number of pieces of network data."""
+        self._find_network_data()
+        self._find_related_items()
+
+        network_data = {
+            'header': {'hosts': {}, 'ip_addresses': {}, 'email_addresses': {}},
+            'bodies': {'hosts': {}, 'ip_addresses': {}, 'email_addresses': {}, 'urls': {}},
+        }
+        # this is simply a list of all of the network data so that the user can copy it
+        network_data_flat_list = []
+        network_data_overlaps = 0
+        network_data_count = 0
+
+        found_network_data = [('header', self.header_network_data)] + [
+            ('bodies', body_network_data) for body_network_data in self.body_network_data.values()
+        ]
+        for location, network_data_by_type in found_network_data:
+            for network_data_type in NETWORK_DATA_TYPES:
+                for network_data_id, value in network_data_by_type.get(network_data_type, []):
+                    network_data_count += 1
+                    data, is_overlap = self._data(network_data_type, network_data_id, value)
+                    if is_overlap:
+                        network_data_overlaps += len(data)
+                    network_data[location][network_data_type][value] = data
+                    network_data_flat_list.append(value)
+
+        return network_data, network_data_flat_list, network_data_overlaps, network_data_count
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Find and delete the rows which nothing refers to anymore (e.g. a header whose emails have all been deleted)."""
+
+import collections
+
+from django.db import connections, transaction
+
+from . import blob_store
+from .models import Email, Header, Body, Attachment, Host, IPAddress, EmailAddress, Url
+
+# the models of each type of row which can be orphaned and the (model, field) of everything which can refer to them - the types are in the order they should be cleaned up because deleting the rows of a type can orphan the rows of the types after it
+ORPHAN_TYPES = collections.OrderedDict(
+    [
+        ('headers', (Header, [(Email, 'header')])),
+        ('bodies', (Body, [(Email.bodies.through, 'body')])),
+        ('attachments', (Attachment, [(Email.attachments.through, 'attachment')])),
+        (
+            'email_addresses',
+            (
+                EmailAddress,
+                [(EmailAddress.headers.through, 'emailaddress'), (EmailAddress.bodies.through, 'emailaddress')],
+            ),
+        ),
+        ('urls', (Url, [(Url.bodies.through, 'url')])),
+        (
+            'hosts',
+            (
+                Host,
+                [
+                    (Host.headers.through, 'host'),
+                    (Host.bodies.through, 'host'),
+                    (EmailAddress, 'host'),
+                    (Url, 'host'),
+                ],
+            ),
+        ),
+        (
+            'ip_addresses',
+            (
+                IPAddress,
+                [
+                    (IPAddress.headers.through, 'ipaddress'),
+                    (IPAddress.bodies.through, 'ipaddress'),
+                    (EmailAddress, 'ip_address'),
+                    (Url, 'ip_address'),
+                ],
+            ),
+        ),
+    ]
+)
+
+# whether or not each of the next rows (in order of their ids) is an orphan
+SCAN_SQL = '''
+SELECT {table}.{pk}, {is_orphan} FROM {table}
+WHERE {table}.{pk} > %s
+ORDER BY {table}.{pk}
+LIMIT %s
+'''
+
+# lock the given rows which are still orphans
+LOCK_SQL = '''
+SELECT {table}.{pk} FROM {table}
+WHERE {table}.{pk} = ANY(%s) AND {is_orphan}
+FOR UPDATE
+'''
+
+
+def _sql(sql, orphan_type, connection):
+    """Return the given sql for the given type of row."""
+    model, references = ORPHAN_TYPES[orphan_type]
+    quote_name = connection.ops.quote_name
+    table = quote_name(model._meta.db_table)
+    pk = quote_name(model._meta.pk.column)
+    is_orphan = ' AND '.join(
+        'NOT EXISTS (SELECT 1 FROM {reference_table} WHERE {reference_table}.{reference_column} = {table}.{pk})'.format(
+            reference_table=quote_name(reference_model._meta.db_table),
+            reference_column=quote_name(reference_model._meta.get_field(field_name).column),
+            table=table,
+            pk=pk,
+        )
+        for reference_model, field_name in references
+    )
+    return sql.format(table=table, pk=pk, is_orphan=is_orphan)
+
+
+def find_orphans(orphan_type, batch_size=1000, using='default'):
+    """Yield the number of rows checked and the ids of the orphans among them for each chunk of batch_size rows of the given type (in order of their ids). Each chunk is found with one query which only reads the rows in the chunk."""
+    connection = connections[using]
+    sql = _sql(SCAN_SQL, orphan_type, connection)
+    last_id = ''
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [last_id, batch_size])
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield len(rows), [row_id for row_id, is_orphan in rows if is_orphan]
+
+
+def delete_orphans(orphan_type, ids, using='default'):
+    """Delete the rows of the given type with the given ids which are still orphans and return the number of rows deleted. The rows are locked and checked again before they are deleted in case something started referring to them after they were found."""
+    if not ids:
+        return 0
+
+    model = ORPHAN_TYPES[orphan_type][0]
+    connection = connections[using]
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            cursor.execute(_sql(LOCK_SQL, orphan_type, connection), [list(ids)])
+            orphan_ids = [row[0] for row in cursor.fetchall()]
+        if not orphan_ids:
+            return 0
+        blob_keys = []
+        if model in (Body, Attachment):
+            blob_keys = list(
+                model.objects.using(using)
+                .filter(pk__in=orphan_ids)
+                .exclude(blob_key='')
+                .values_list('blob_key', flat=True)
+            )
+        # deleting through the orm also deletes the rows which refer to the orphans but do not keep them from being orphans (e.g. the fields of a header)
+        deleted_count, deleted_counts = model.objects.using(using).filter(pk__in=orphan_ids).delete()
+        if blob_keys:
+            # the blobs are only deleted once the rows are (and not if the transaction is rolled back)
+            transaction.on_commit(lambda: _delete_blobs(model, blob_keys, using), using=using)
+    return deleted_counts.get(model._meta.label, 0)
+
+
+def _delete_blobs(model, blob_keys, using='default'):
+    """Delete the blobs with the given keys which no row refers to (a row with the same id may have been created again since the orphans were deleted)."""
+    used_blob_keys = set(model.objects.using(using).filter(blob_key__in=blob_keys).values_list('blob_key', flat=True))
+    for key in blob_keys:
+        if key not in used_blob_keys:
+            blob_store.get_blob_store().delete(key)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Maintain the full-text search index of the emails."""
+
+import logging
+
+from django.db import DatabaseError, connections, transaction
+
+from .models import Email, Header, HeaderField, Body, SEARCH_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# the maximum number of characters of the header values and of the body text used to build the search vector of an email (a tsvector cannot be larger than 1MB)
+SEARCH_TEXT_LIMIT = 256 * 1024
+
+# the trigram indexes used for substring (`icontains`) searches - these use an operator class which cannot be given to an index in the model's Meta, so they are created after migrating
+TRIGRAM_INDEXES = [
+    ('db_email_full_text_trgm', Email, 'full_text'),
+    ('db_body_full_text_trgm', Body, 'full_text'),
+    ('db_body_decoded_text_trgm', Body, 'decoded_text'),
+    ('db_header_subject_value_trgm', Header, 'subject_value'),
+    ('db_header_from_value_trgm', Header, 'from_value'),
+    ('db_header_to_value_trgm', Header, 'to_value'),
+]
+
+UPDATE_SEARCH_VECTORS_SQL = '''
+UPDATE {email} SET search_vector =
+    setweight(to_tsvector(%(config)s::regconfig, left(coalesce((
+        SELECT string_agg(header_field ->> 1, ' ')
+        FROM {header}, jsonb_array_elements({header}.data) header_field
+        WHERE {header}.id = {email}.header_id
+    ), ''), %(limit)s)), 'A') ||
+    setweight(to_tsvector(%(config)s::regconfig, left(coalesce((
+        SELECT string_agg(coalesce({body}.decoded_text, {body}.full_text), ' ')
+        FROM {body} JOIN {email_bodies} ON {email_bodies}.body_id = {body}.id
+        WHERE {email_bodies}.email_id = {email}.id
+    ), ''), %(limit)s)), 'B')
+WHERE {email}.id = ANY(%(email_ids)s)
+'''
+
+
+def header_fields(header):
+    """Return the (unsaved) HeaderField objects for the key/value pairs of the given header."""
+    return [
+        HeaderField(header_id=header.id, position=position, key=key.lower(), value=value)
+        for position, (key, value) in enumerate(header.data)
+    ]
+
+
+def update_search_vectors(email_ids):
+    """Build the search vectors of the given emails from the values of their headers (weighted highest) and the (decoded) text of their bodies."""
+    email_ids = list(email_ids)
+    if not email_ids:
+        return
+
+    connection = connections[Email.objects.db]
+    quote_name = connection.ops.quote_name
+    sql = UPDATE_SEARCH_VECTORS_SQL.format(
+        email=quote_name(Email._meta.db_table),
+        header=quote_name(Header._meta.db_table),
+        body=quote_name(Body._meta.db_table),
+        email_bodies=quote_name(Email.bodies.through._meta.db_table),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {'config': SEARCH_CONFIG, 'limit': SEARCH_TEXT_LIMIT, 'email_ids': email_ids})
+
+
+def create_trigram_indexes(using='default', **kwargs):
+    """Create the pg_trgm extension and the trigram indexes (this is run after migrating). If the extension is not available, substring searches still work, but they are not indexed."""
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    try:
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for index_name, model, field_name in TRIGRAM_INDEXES:
+                # django's `icontains` lookup compares the UPPER() of the column, so the index is on the same expression
+                cursor.execute(
+                    'CREATE INDEX IF NOT EXISTS {} ON {} USING gin (UPPER({}) gin_trgm_ops)'.format(
+                        quote_name(index_name),
+                        quote_name(model._meta.db_table),
+                        quote_name(model._meta.get_field(field_name).column),
+                    )
+                )
+    except DatabaseError as e:
+        logger.warning('Unable to create the trigram indexes (substring searches will not be indexed): {}'.format(e))
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+import email
+from io import StringIO
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import TestCase
+from rest_framework.test import APITestCase
+
+from api.api_test_utility import get_user_token
+from db import blob_store, orphans
+from db.models import Attachment, Body, Email
+from test_resources import DefaultTestObject
+
+TestData = DefaultTestObject()
+
+
+def large_email_text():
+    """Return the text of an email with a plain text body and an attachment which are larger than the blob store threshold used in the tests."""
+    message = MIMEMultipart()
+    message['Subject'] = 'Large attachment'
+    message['From'] = 'alice@example.com'
+    message['To'] = 'bob@example.com'
+    message.attach(MIMEText('Hello Bob, the report is attached. ' * 5, 'plain'))
+    attachment = MIMEApplication(b'report data ' * 200, 'octet-stream')
+    attachment.add_header('Content-Disposition', 'attachment', filename='report.bin')
+    message.attach(attachment)
+    return message.as_string()
+
+
+def large_attachment_payload():
+    """Return the (base64 encoded) payload of the attachment in `large_email_text`."""
+    return email.message_from_string(large_email_text()).get_payload()[1].get_payload()
+
+
+class BlobStoreTestCase(object):
+    """Use a blob store in a temporary directory with a low threshold so that the full text of the bodies and attachments of `large_email_text` is stored in the blob store."""
+
+    def setUp(self):
+        super(BlobStoreTestCase, self).setUp()
+        self.blob_directory = tempfile.mkdtemp()
+        self.original_blob_store = blob_store.set_blob_store(blob_store.FileSystemBlobStore(self.blob_directory))
+        self.original_threshold = blob_store.BLOB_STORE_THRESHOLD
+        blob_store.BLOB_STORE_THRESHOLD = 1000
+
+    def tearDown(self):
+        blob_store.BLOB_STORE_THRESHOLD = self.original_threshold
+        blob_store.set_blob_store(self.original_blob_store)
+        shutil.rmtree(self.blob_directory)
+        super(BlobStoreTestCase, self).tearDown()
+
+
+class BlobStoreTests(BlobStoreTestCase, TestCase):
+    def test_file_system_blob_store(self):
+        store = blob_store.get_blob_store()
+        key = blob_store.blob_key('attachments', 'a' * 64)
+        assert not store.exists(key)
+        store.save(key, b'content')
+        # blobs are never overwritten
+        store.save(key, b'other content')
+        assert store.exists(key)
+        with store.open(key) as blob:
+            assert blob.read() == b'content'
+        store.delete(key)
+        assert not store.exists(key)
+        store.delete(key)
+
+    def test_file_system_blob_store_location(self):
+        """The file system blob store does not start on a Heroku dyno (whose file system is not persistent)."""
+        assert blob_store.FileSystemBlobStore('').location == blob_store.DEFAULT_BLOB_DIRECTORY
+        with mock.patch.dict(os.environ, {'DYNO': 'web.1'}):
+            with self.assertRaises(ImproperlyConfigured):
+                blob_store.FileSystemBlobStore(self.blob_directory)
+
+    def test_database_blob_store(self):
+        store = blob_store.DatabaseBlobStore('default')
+        original_chunk_size = blob_store.BLOB_CHUNK_SIZE
+        blob_store.BLOB_CHUNK_SIZE = 4
+        try:
+            key = blob_store.blob_key('attachments', 'a' * 64)
+            assert not store.exists(key)
+            store.save(key, b'content which spans chunks')
+            # blobs are never overwritten
+            store.save(key, b'other content')
+            assert store.exists(key)
+            with store.open(key) as blob:
+                assert blob.read() == b'content which spans chunks'
+            with store.open(key) as blob:
+                assert blob.read(3) == b'con'
+                assert blob.read(5) == b'tent '
+            store.delete(key)
+            assert not store.exists(key)
+            with self.assertRaises(blob_store.BlobNotFoundError):
+                store.open(key)
+
+            # empty blobs are stored
+            store.save(key, b'')
+            assert store.open(key).read() == b''
+            store.delete(key)
+
+            # a blob is not stored if writing it fails
+            with self.assertRaises(ValueError):
+                with store.create(key) as blob:
+                    blob.write(b'partial content')
+                    raise ValueError
+            assert not store.exists(key)
+
+            # blobs are only written in with blocks (which can overlap with the with blocks of other blobs)
+            with self.assertRaises(ValueError):
+                store.create(key).write(b'content')
+            other_key = blob_store.blob_key('attachments', 'b' * 64)
+            with store.create(key) as blob:
+                blob.write(b'content')
+                with store.create(other_key) as other_blob:
+                    other_blob.write(b'other content')
+                blob.write(b' which spans chunks')
+            assert store.open(key).read() == b'content which spans chunks'
+            assert store.open(other_key).read() == b'other content'
+        finally:
+            blob_store.BLOB_CHUNK_SIZE = original_chunk_size
+
+    def test_missing_blob(self):
+        """The full text of a row whose blob is missing is shown as a placeholder (and the error is logged)."""
+        key = blob_store.blob_key('attachments', 'a' * 64)
+        with self.assertLogs('db.blob_store', level='ERROR'):
+            assert blob_store.read_full_text('', key) == blob_store.MISSING_BLOB_TEXT
+        with self.assertRaises(blob_store.BlobNotFoundError):
+            blob_store.open_full_text('', key)
+
+    def test_store_full_text(self):
+        assert blob_store.store_full_text('attachments', 'a' * 64, 'small') == ('small', '')
+        full_text, key = blob_store.store_full_text('attachments', 'a' * 64, 'large ' * 200)
+        assert full_text == ''
+        assert key == 'attachments/' + 'a' * 64
+        assert blob_store.read_full_text(full_text, key) == 'large ' * 200
+        assert blob_store.open_full_text(full_text, key).read() == ('large ' * 200).encode('utf-8')
+        assert blob_store.read_full_text('small', '') == 'small'
+        assert blob_store.store_full_text('emails', 'b' * 64, 'large ' * 200, inline_text='searchable') == (
+            'searchable',
+            'emails/' + 'b' * 64,
+        )
+
+    def test_full_text_writer(self):
+        with blob_store.FullTextWriter('attachments', 'a' * 64) as full_text:
+            full_text.write('small')
+        assert (full_text.full_text, full_text.blob_key) == ('small', '')
+        assert not blob_store.get_blob_store().exists(blob_store.blob_key('attachments', 'a' * 64))
+
+        with blob_store.FullTextWriter('attachments', 'a' * 64) as full_text:
+            for i in range(200):
+                full_text.write('large ')
+        assert (full_text.full_text, full_text.blob_key) == ('', 'attachments/' + 'a' * 64)
+        assert blob_store.read_full_text(full_text.full_text, full_text.blob_key) == 'large ' * 200
+
+        # a blob which is not completely written is not stored
+        with self.assertRaises(ValueError):
+            with blob_store.FullTextWriter('attachments', 'b' * 64) as full_text:
+                full_text.write('large ' * 200)
+                raise ValueError
+        assert not blob_store.get_blob_store().exists(blob_store.blob_key('attachments', 'b' * 64))
+
+    def test_email_creation(self):
+        email = TestData.create_email(large_email_text())
+        assert email.blob_key == 'emails/{}'.format(email.id)
+        assert large_attachment_payload() in email.text
+        assert email.open_full_text().read().decode('utf-8') == email.text
+        # the email's text without the payload of its large attachment is kept in the database
+        assert large_attachment_payload() not in email.full_text
+        assert 'Hello Bob' in email.full_text
+        assert email.full_text == email.text.replace(large_attachment_payload(), '')
+
+        attachment = email.attachments.all()[0]
+        assert attachment.full_text == ''
+        assert attachment.blob_key == 'attachments/{}'.format(attachment.id)
+        assert 'report.bin' in attachment.text
+        assert attachment.open_full_text().read().decode('utf-8') == attachment.text
+
+        # the full text of bodies which are not base64 encoded is kept in the database so it can be searched
+        body = email.bodies.all()[0]
+        assert body.blob_key == ''
+        assert 'Hello Bob' in body.full_text
+
+    def test_searchable_email_text(self):
+        """Only the text of a large email which is not kept with its attachments and bodies (up to BLOB_STORE_THRESHOLD characters of it) is kept in the email's row, however small its attachments are."""
+        message = MIMEMultipart()
+        message['Subject'] = 'Many attachments'
+        message.attach(MIMEText('Hello Bob, this is encoded. ' * 50, 'plain', 'utf-8'))
+        for i in range(10):
+            attachment = MIMEApplication('small attachment {} '.format(i).encode('utf-8') * 20, 'octet-stream')
+            attachment.add_header('Content-Disposition', 'attachment', filename='small{}.bin'.format(i))
+            message.attach(attachment)
+        new_email = TestData.create_email(message.as_string())
+        assert new_email.blob_key
+        assert len(new_email.full_text) <= blob_store.BLOB_STORE_THRESHOLD
+        assert 'Many attachments' in new_email.full_text
+        for part in email.message_from_string(new_email.text).walk():
+            if not part.is_multipart():
+                assert part.get_payload() not in new_email.full_text
+
+    def test_large_email_full_text_is_searchable(self):
+        """The searchable text of a large email is kept in the database because it is what text searches match substrings of."""
+        email = TestData.create_email(large_email_text())
+        assert email.blob_key
+        assert 'report.bin' in email.full_text
+        # the filename is only in the header fields of the attachment (which are not in the search vector)
+        response = self.client.get('/search?q=report.bin')
+        assert 'Found 1 email matching "<i>report.bin</i>"' in response.content.decode('utf-8')
+
+    def test_base64_body(self):
+        message = MIMEText('Hello Bob, this is encoded. ' * 50, 'plain', 'utf-8')
+        message['Subject'] = 'Encoded body'
+        email = TestData.create_email(message.as_string())
+        body = email.bodies.all()[0]
+        assert body.full_text == ''
+        assert body.blob_key == 'bodies/{}'.format(body.id)
+        assert 'Hello Bob' in body.decoded_text
+        assert body.text
+
+    def test_details_view(self):
+        email = TestData.create_email(large_email_text())
+        attachment = email.attachments.all()[0]
+        response = self.client.get('/email/{}/'.format(email.id))
+        assert '/email/{}/attachments/{}'.format(email.id, attachment.id) in response.content.decode('utf-8')
+
+        response = self.client.get('/email/{}/attachments/{}/'.format(email.id, attachment.id))
+        assert response.status_code == 200
+        assert b''.join(response.streaming_content).decode('utf-8') == attachment.text
+
+        blob_store.get_blob_store().delete(attachment.blob_key)
+        response = self.client.get('/api/v1/attachments/{}/content/'.format(attachment.id))
+        assert response.status_code == 404
+        # only the bodies and attachments of the email can be viewed through it
+        response = self.client.get('/email/{}/bodies/{}/'.format(email.id, attachment.id))
+        assert response.status_code == 404
+
+        # the full text of an attachment whose blob is missing is not found
+        blob_store.get_blob_store().delete(attachment.blob_key)
+        response = self.client.get('/email/{}/attachments/{}/'.format(email.id, attachment.id))
+        assert response.status_code == 404
+
+    def test_cleanup_orphans_deletes_blobs(self):
+        email = TestData.create_email(large_email_text())
+        attachment = email.attachments.all()[0]
+        # the blobs of rows which still exist are not deleted
+        orphans._delete_blobs(Attachment, [attachment.blob_key])
+        assert blob_store.get_blob_store().exists(attachment.blob_key)
+
+        email.delete()
+        assert orphans.delete_orphans('attachments', [attachment.id]) == 1
+        # the blobs are deleted when the transaction is committed (which never happens in a test case)
+        orphans._delete_blobs(Attachment, [attachment.blob_key])
+        assert not blob_store.get_blob_store().exists(attachment.blob_key)
+
+    def test_store_blobs(self):
+        blob_store.BLOB_STORE_THRESHOLD = 1000000
+        email = TestData.create_email(large_email_text())
+        email_text = email.full_text
+        attachment = email.attachments.all()[0]
+        full_text = attachment.full_text
+        assert email.blob_key == ''
+        assert attachment.blob_key == ''
+
+        blob_store.BLOB_STORE_THRESHOLD = 1000
+        call_command('store_blobs', '--batch-size', '1', stdout=StringIO())
+        attachment = Attachment.objects.get(pk=attachment.id)
+        assert attachment.full_text == ''
+        assert attachment.text == full_text
+        email = Email.objects.get(pk=email.id)
+        assert email.text == email_text
+        assert large_attachment_payload() not in email.full_text
+        assert 'report.bin' in email.full_text
+        # bodies without decoded text are not moved
+        assert Body.objects.filter(blob_key='').count() == Body.objects.count()
+
+
+class BlobStoreAPITests(BlobStoreTestCase, APITestCase):
+    def setUp(self):
+        super(BlobStoreAPITests, self).setUp()
+        self.token = get_user_token()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def test_bulk_email_creation(self):
+        self.client.post('/api/v1/emails/bulk/?localTest=1', [{'full_text': large_email_text()}], format='json')
+        email = Email.objects.get()
+        assert email.blob_key
+        attachment = email.attachments.all()[0]
+        assert attachment.blob_key
+
+        response = self.client.get('/api/v1/emails/{}/'.format(email.id))
+        assert response.data['full_text'] == email.text
+        response = self.client.get('/api/v1/emails/?fields=id,full_text')
+        assert response.data[0] == {'id': email.id, 'full_text': email.text}
+
+        response = self.client.get('/api/v1/attachments/{}/'.format(attachment.id))
+        assert response.data['full_text'] == attachment.text
+        response = self.client.get('/api/v1/attachments/{}/content/'.format(attachment.id))
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'text/plain; charset=utf-8'
+        assert b''.join(response.streaming_content).decode('utf-8') == attachment.text
+
+    def test_export(self):
+        self.client.post('/api/v1/emails/?localTest=1', {'full_text': large_email_text()})
+        attachment = Email.objects.get().attachments.all()[0]
+        response = self.client.get('/api/v1/emails/export/?include=attachments')
+        exported_email = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        assert exported_email['full_text'] == Email.objects.get().text
+        assert 'blob_key' not in exported_email
+        exported_attachment = exported_email['attachments'][0]
+        assert exported_attachment['full_text'] == attachment.text
+        assert 'blob_key' not in exported_attachment
@@ -2,9 +2,14 @@
 
 import datetime
 import hashlib
+from io import StringIO
 
+from django.core.management import call_command
 from django.test import TestCase
 
+from db import db_creator
+from db.models import Analysis, Email, Header
+from email_processor import processor
 from utility import utility
 from test_resources import DefaultTestObject
 
@@ -224,6 +229,17 @@ class HeaderTests(TestCase):
         new_header = TestData.create_email().header
         assert new_header is not None
 
+    def test_header_fields(self):
+        new_header = TestData.create_email().header
+        fields = new_header.headerfield_set.order_by('position')
+        assert [(field.key, field.value) for field in fields] == [
+            (header_key.lower(), header_value) for header_key, header_value in new_header.data
+        ]
+
+        # creating the header again does not duplicate the fields
+        TestData.create_email()
+        assert new_header.headerfield_set.count() == len(new_header.data)
+
     def test_bad_content_type(self):
         new_header = TestData.create_email(TestData.bad_content_type_email_text).header
         assert new_header is not None
@@ -246,6 +262,60 @@ Hello!
 
         new_email = TestData.create_email(email_text=email_text)
         assert new_email.header.subject == 'Did You Authorize Her?'
+        assert Header.objects.get(pk=new_email.header.id).subject_value == 'Did You Authorize Her?'
+
+    def test_header_summary(self):
+        email_text = '''Subject: Lunch
+From: Bob Bradbury <bob@gmail.com>
+To: Alice Asimov <alice@gmail.com>
+Date: Mon, 1 Jan 2018 10:00:00 -0500
+Message-ID: <lunch@gmail.com>
+
+Hello!
+'''
+        db_creator.bulk_create_emails([processor.prepare_email(email_text)], 'test', perform_external_analysis=False)
+        header = Header.objects.get()
+        assert header.subject_value == 'Lunch'
+        assert header.has_subject
+        assert header.from_value == 'Bob Bradbury <bob@gmail.com>'
+        assert header.to_value == 'Alice Asimov <alice@gmail.com>'
+        assert header.date_value is not None
+        assert header.message_id_value == '<lunch@gmail.com>'
+
+        unsaved_header = Header(data=header.data)
+        unsaved_header.summarize()
+        assert unsaved_header.date_value == datetime.datetime(2018, 1, 1, 15, 0, tzinfo=datetime.timezone.utc)
+
+    def test_header_summary_without_values(self):
+        header = Header(id='a' * 64, data=[['Date', 'not a date'], ['X-Mailer', 'test']])
+        header.save()
+        assert header.subject_value == ''
+        assert header.subject == 'N/A'
+        assert header.from_value == ''
+        assert header.date_value is None
+
+    def test_header_summary_with_empty_values(self):
+        header = Header(id='b' * 64, data=[['Subject', ''], ['From', ''], ['To', 'alice@gmail.com, ' * 100]])
+        header.save()
+        # a subject which is empty is displayed as it is (only a missing subject is displayed as 'N/A')
+        assert header.subject == ''
+        assert Header.objects.get(pk=header.id).subject == ''
+        assert header.from_value == ''
+        # the values are not truncated so that the header search functions match all of them
+        assert header.to_value == 'alice@gmail.com, ' * 100
+
+    def test_summarize_headers(self):
+        new_header = TestData.create_email().header
+        Header.objects.filter(pk=new_header.id).update(subject_value=None, from_value='')
+        header = Header.objects.get(pk=new_header.id)
+        # headers which have not been summarized are summarized when their subject is displayed
+        assert header.subject == new_header.get_header_key_values('subject')[0]
+
+        call_command('summarize_headers', stdout=StringIO())
+        header = Header.objects.get(pk=new_header.id)
+        assert header.subject_value == new_header.get_header_key_values('subject')[0]
+        assert header.from_value == new_header.get_header_key_values('from')[0]
+        assert header.modified == new_header.modified
 
 
 class BodyTests(TestCase):
@@ -397,3 +467,16 @@ class AnalysisTests(TestCase):
         new_email = TestData.create_email()
         new_analysis = TestData.create_analysis(new_email)
         assert str(new_analysis) == '{}: {}'.format(new_email.id, new_analysis.first_seen)
+
+    def test_email_score(self):
+        new_email = TestData.create_email()
+        assert Email.objects.get(pk=new_email.id).score == 0.5
+
+        for source, score in [('Orange Assassin', 1), ('internal', 0.2), ('Orange Assassin', 2)]:
+            analysis = Analysis(notes='', source=source, score=score, email=new_email)
+            analysis.save()
+            db_creator.update_email_score(analysis)
+
+        new_email = Email.objects.get(pk=new_email.id)
+        assert new_email.score == utility.email_score_calculate(new_email)
+        assert new_email.source_scores == {'Orange Assassin': 0.5, 'internal': 0.2}
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import mailbox
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from db.models import Email
+from test_resources import DefaultTestObject
+
+TestData = DefaultTestObject()
+
+
+class IngestCommandTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.mbox_path = os.path.join(self.directory.name, 'test.mbox')
+        mbox = mailbox.mbox(self.mbox_path)
+        mbox.add(TestData.email_text)
+        mbox.add(TestData.delivered_to_email_text)
+        mbox.add(TestData.email_text)
+        mbox.flush()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_mbox_ingest(self):
+        output = io.StringIO()
+        call_command('ingest', self.mbox_path, workers=1, stdout=output)
+        assert Email.objects.count() == 2
+        assert Email.objects.filter(pk=TestData.email_id).exists()
+        assert '2 created, 1 skipped' in output.getvalue()
+
+    def test_ingest_is_resumable(self):
+        call_command('ingest', self.mbox_path, workers=1, stdout=io.StringIO())
+        output = io.StringIO()
+        call_command('ingest', self.mbox_path, workers=1, stdout=output)
+        assert Email.objects.count() == 2
+        assert '0 created, 3 skipped' in output.getvalue()
+
+    def test_eml_directory_ingest(self):
+        with open(os.path.join(self.directory.name, 'test.eml'), 'w') as f:
+            f.write(TestData.email_text)
+        with open(os.path.join(self.directory.name, 'invalid.eml'), 'w') as f:
+            f.write('this is not an email')
+        output = io.StringIO()
+        call_command('ingest', self.directory.name, workers=1, stdout=output)
+        assert Email.objects.count() == 1
+        assert '1 created, 0 skipped (already in the database), 1 invalid' in output.getvalue()
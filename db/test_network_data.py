@@ -1,7 +1,10 @@
 """Testing functions for total_email."""
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
+from db.models import Body, Email, Header
 from test_resources import DefaultTestObject
 
 TestData = DefaultTestObject()
@@ -74,3 +77,68 @@ class UrlCreationTests(TestCase):
     def test_url_hostname_with_ip_address(self):
         new_url = TestData.create_url(TestData.url_ip_hostname)
         assert new_url.ip_address.ip_address == '192.168.0.1'
+
+
+class NetworkDataOverlapTests(TestCase):
+    def create_related_email(self, email_id, subject):
+        header = Header.objects.create(id='{}-header'.format(email_id), data=[['Subject', subject]])
+        body = Body.objects.create(id='{}-body'.format(email_id), full_text=subject)
+        email = Email.objects.create(
+            id=email_id, cleaned_id=email_id, full_text=subject, submitter='test', structure={}, header=header
+        )
+        email.bodies.add(body)
+        return email
+
+    def test_network_data_overlaps(self):
+        created_email = TestData.create_email()
+        related_email = self.create_related_email('related', 'a related email')
+
+        new_host = TestData.create_host('example.org')
+        new_host.headers.add(created_email.header, related_email.header)
+        new_host.bodies.add(related_email.bodies.all()[0])
+        new_url = TestData.create_url('http://example.org/login')
+        new_url.bodies.add(created_email.bodies.all()[0], related_email.bodies.all()[0])
+
+        network_data, network_data_flat_list, network_data_overlaps, network_data_count = created_email.network_data()
+        assert network_data['header']['hosts']['example.org'] == [
+            {'link': '/email/related#header', 'text': '(header) a related email'},
+            {'link': '/email/related#bodies', 'text': '(body) a related email'},
+        ]
+        assert network_data['bodies']['urls']['http://example.org/login'] == [
+            {'link': '/email/related#bodies', 'text': '(body) a related email'}
+        ]
+        assert 'example.org' in network_data_flat_list
+        assert 'http://example.org/login' in network_data_flat_list
+        assert network_data_overlaps == 3
+
+    def test_network_data_view_more(self):
+        created_email = TestData.create_email()
+        new_host = TestData.create_host('example.org')
+        new_host.headers.add(created_email.header)
+        for i in range(5):
+            new_host.headers.add(self.create_related_email('related{}'.format(i), 'related email {}'.format(i)).header)
+
+        network_data = created_email.network_data()[0]
+        links = network_data['header']['hosts']['example.org']
+        assert len(links) == 4
+        assert links[-1] == {'link': '/search?q=example.org', 'text': ''}
+
+    def test_network_data_query_count(self):
+        """The number of queries used to find the network data does not depend on the amount of network data."""
+        created_email = TestData.create_email()
+        related_email = self.create_related_email('related', 'a related email')
+
+        query_counts = []
+        for i in range(6):
+            new_host = TestData.create_host('example{}.org'.format(i))
+            new_host.headers.add(created_email.header, related_email.header)
+            new_host.bodies.add(created_email.bodies.all()[0], related_email.bodies.all()[0])
+            new_url = TestData.create_url('http://example{}.org/login'.format(i))
+            new_url.bodies.add(created_email.bodies.all()[0], related_email.bodies.all()[0])
+
+            with CaptureQueriesContext(connection) as queries:
+                network_data_count = created_email.network_data()[3]
+            assert network_data_count == 3 * (i + 1)
+            query_counts.append(len(queries))
+
+        assert len(set(query_counts)) == 1
@@ -0,0 +1,95 @@
+"""Testing functions for total_email."""
+
+import datetime
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from db import orphans
+from db.models import AnalysisJob, Body, EmailAddress, Header, HeaderField, Host, Url
+from test_resources import DefaultTestObject
+
+TestData = DefaultTestObject()
+
+
+class OrphanTests(TestCase):
+    def create_orphans(self):
+        self.email = TestData.create_email()
+        self.orphaned_header = Header.objects.create(id='orphaned-header', data=[['Subject', 'orphaned']])
+        HeaderField.objects.create(header=self.orphaned_header, position=0, key='subject', value='orphaned')
+        self.orphaned_body = Body.objects.create(id='orphaned-body', full_text='orphaned')
+
+        # this host is only in the orphaned body, so it is orphaned once the body is deleted
+        self.orphaned_host = TestData.create_host('orphaned.example.com')
+        self.orphaned_host.bodies.add(self.orphaned_body)
+        # this host is in the email's header
+        self.host = TestData.create_host('example.com')
+        self.host.headers.add(self.email.header)
+        # this email address is in the email's body and its host is only referred to by the email address
+        self.email_address = EmailAddress.objects.create(email_address='alice@example.org')
+        self.email_address.bodies.add(self.email.bodies.all()[0])
+        self.orphaned_url = TestData.create_url('http://example.net/orphaned')
+
+    def test_find_orphans(self):
+        self.create_orphans()
+        found_orphans = [
+            orphan_id
+            for checked_count, orphan_ids in orphans.find_orphans('headers', batch_size=1)
+            for orphan_id in orphan_ids
+        ]
+        assert found_orphans == ['orphaned-header']
+        assert [orphan_ids for checked_count, orphan_ids in orphans.find_orphans('bodies')] == [['orphaned-body']]
+
+    def test_cleanup_orphans_dry_run(self):
+        self.create_orphans()
+        output = StringIO()
+        call_command('cleanup_orphans', '--dry-run', stdout=output)
+        assert 'Found 1 orphaned headers' in output.getvalue()
+        assert Header.objects.filter(id='orphaned-header').exists()
+        assert Body.objects.filter(id='orphaned-body').exists()
+
+    def test_cleanup_orphans(self):
+        self.create_orphans()
+        call_command('cleanup_orphans', '--batch-size', '1', stdout=StringIO())
+
+        assert not Header.objects.filter(id='orphaned-header').exists()
+        assert not HeaderField.objects.filter(header_id='orphaned-header').exists()
+        assert not Body.objects.filter(id='orphaned-body').exists()
+        assert not Host.objects.filter(host_name='orphaned.example.com').exists()
+        assert not Url.objects.filter(url='http://example.net/orphaned').exists()
+        # the rows which are still referred to are kept
+        assert Header.objects.filter(id=self.email.header.id).exists()
+        assert set(Body.objects.values_list('id', flat=True)) == {body.id for body in self.email.bodies.all()}
+        assert Host.objects.filter(host_name='example.com').exists()
+        assert EmailAddress.objects.filter(email_address='alice@example.org').exists()
+        assert Host.objects.filter(host_name='example.org').exists()
+
+    def test_cleanup_orphans_of_some_types(self):
+        self.create_orphans()
+        call_command('cleanup_orphans', 'urls', stdout=StringIO())
+        assert not Url.objects.filter(url='http://example.net/orphaned').exists()
+        assert Header.objects.filter(id='orphaned-header').exists()
+
+    def test_cleanup_failed_analysis_jobs(self):
+        AnalysisJob.objects.create(
+            route='analysis',
+            item_id='old',
+            email_id='old',
+            status=AnalysisJob.FAILED,
+            first_seen=timezone.now() - datetime.timedelta(days=30),
+        )
+        AnalysisJob.objects.create(route='analysis', item_id='new', email_id='new', status=AnalysisJob.FAILED)
+
+        output = StringIO()
+        call_command('cleanup_orphans', 'failed_analysis_jobs', '--failed-job-days', '7', stdout=output)
+        assert 'Deleted 1 failed_analysis_jobs older than 7 days' in output.getvalue()
+        assert list(AnalysisJob.objects.values_list('item_id', flat=True)) == ['new']
+
+    def test_delete_orphans_checks_again(self):
+        self.create_orphans()
+        # the body is no longer an orphan by the time it is deleted
+        self.email.bodies.add(self.orphaned_body)
+        assert orphans.delete_orphans('bodies', ['orphaned-body']) == 0
+        assert Body.objects.filter(id='orphaned-body').exists()
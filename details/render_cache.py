@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Cache the rendered sections of the email details pages (which are expensive to render) until something shown in them changes."""
+
+import collections
+import os
+
+from django.core.cache import caches
+from django.template.loader import render_to_string
+
+# the cache the rendered sections are stored in (to share the rendered sections between processes, configure a cache with this alias which uses a file based or shared cache backend)
+DETAILS_CACHE_ALIAS = os.environ.get('DETAILS_CACHE_ALIAS', 'default')
+DETAILS_CACHE_SECONDS = int(os.environ.get('DETAILS_CACHE_SECONDS', 60 * 60))
+# the templates of the sections of the details page which are cached (by the name of the context variable they are rendered into)
+CACHED_SECTION_TEMPLATES = collections.OrderedDict(
+    [
+        ('sections', 'details/details_view/email-sections.html'),
+        ('summary_card', 'details/details_view/email-summary-card.html'),
+    ]
+)
+
+# the number of details pages whose sections were (and were not) in the cache in this process
+stats = collections.Counter(hits=0, misses=0)
+
+
+def cache_key(email):
+    """Return the cache key of the rendered sections of the given email. The key changes whenever something shown in the sections changes: the email's details version is bumped when analyses or network data are added and the votes on the email's header are part of the key. The email's first seen date is also part of the key because the ids of emails are hashes of their text, so an email which is deleted and submitted again has the same id (and details version)."""
+    return 'email_details:{}:{}:{}:{}:{}'.format(
+        email.id,
+        email.first_seen.timestamp(),
+        email.details_version,
+        email.header.subject_suspicious_votes,
+        email.header.subject_not_suspicious_votes,
+    )
+
+
+def rendered_sections(email, get_context):
+    """Return the rendered sections of the details page of the given email from the cache. If they are not cached, they are rendered (with the context returned by get_context) and cached."""
+    cache = caches[DETAILS_CACHE_ALIAS]
+    key = cache_key(email)
+    sections = cache.get(key)
+    if sections is not None:
+        stats['hits'] += 1
+        return sections
+
+    stats['misses'] += 1
+    context = get_context()
+    sections = {name: render_to_string(template, context) for name, template in CACHED_SECTION_TEMPLATES.items()}
+    cache.set(key, sections, DETAILS_CACHE_SECONDS)
+    return sections
@@ -3,9 +3,15 @@
 
 import html
 
+from django.core.cache import caches
+from django.db.models import F
 from django.test import TestCase
 
+from db import db_creator
+from db.models import Analysis, AnalysisJob, Email, Header, Host
+from details import render_cache
 from test_resources import DefaultTestObject
+from utility import utility
 
 TestData = DefaultTestObject()
 
@@ -164,6 +170,24 @@ Good morning to you,
         assert response.status_code == 302
         assert response.url == '/email/{}/'.format(created_email.id)
 
+    def test_reanalyze_email(self):
+        """Make sure the reanalysis message says whether the email was queued or external analysis is disabled."""
+        created_email = TestData.create_email()
+        url = '/email/{}/reanalyze'.format(created_email.id)
+
+        original_is_running_locally = utility.is_running_locally
+        try:
+            utility.is_running_locally = lambda: False
+            response = self.client.get(url, follow=True)
+            assert 'Email submitted for reanalysis.' in response.content.decode('utf-8')
+            assert AnalysisJob.objects.filter(route='analysis', item_id=created_email.id).exists()
+
+            utility.is_running_locally = lambda: True
+            response = self.client.get(url, follow=True)
+            assert 'External analysis is disabled' in response.content.decode('utf-8')
+        finally:
+            utility.is_running_locally = original_is_running_locally
+
 
 class StructureTest(TestCase):
     """Make sure email structures are properly displayed."""
@@ -203,3 +227,91 @@ class StructureTest(TestCase):
             "multipart/alternative<br>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<a href='#54712d1572ff09d73c3baacf0760a42735a3ce6dbd83144eb2f998155f53b740'>text/plain (body)</a><br>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<a href='#b6fba92f1803f9f59d42fdd36b259fe8a550a68fee60808800cb11de14feeb8c'>text/html (body)</a>"
             in response_content
         )
+
+
+class RenderCacheTests(TestCase):
+    """Tests of the cache of the rendered sections of the details page."""
+
+    def setUp(self):
+        self.email = TestData.create_email()
+        self.url = '/email/{}/'.format(self.email.id)
+
+    def tearDown(self):
+        caches[render_cache.DETAILS_CACHE_ALIAS].clear()
+
+    def test_sections_cached(self):
+        misses = render_cache.stats['misses']
+        hits = render_cache.stats['hits']
+        first_response = self.client.get(self.url)
+        second_response = self.client.get(self.url)
+        assert render_cache.stats['misses'] == misses + 1
+        assert render_cache.stats['hits'] == hits + 1
+        assert first_response.context['sections'] == second_response.context['sections']
+        assert 'id="emailHeader"' in second_response.content.decode('utf-8')
+
+    def test_analysis_invalidates_sections(self):
+        key = render_cache.cache_key(Email.objects.get(pk=self.email.id))
+        analysis = Analysis.objects.create(email=self.email, notes='Spam signature matched', score=1, source='Test')
+        db_creator.update_email_score(analysis)
+        assert render_cache.cache_key(Email.objects.get(pk=self.email.id)) != key
+
+        response = self.client.get(self.url)
+        assert 'Spam signature matched' in response.content.decode('utf-8')
+
+    def test_network_data_invalidates_sections(self):
+        self.client.get(self.url)
+        db_creator.bulk_create_network_data(Host, [{'host_name': 'example.org', 'headers': [self.email.header.id]}])
+
+        misses = render_cache.stats['misses']
+        response = self.client.get(self.url)
+        assert render_cache.stats['misses'] == misses + 1
+        assert 'example.org' in response.content.decode('utf-8')
+
+    def create_related_email(self, email_id, subject):
+        header = Header.objects.create(id='{}-header'.format(email_id), data=[['Subject', subject]])
+        return Email.objects.create(
+            id=email_id, cleaned_id=email_id, full_text=subject, submitter='test', structure={}, header=header
+        )
+
+    def test_overlaps_invalidate_sections(self):
+        """The sections of the emails with network data are rendered again when the network data is found in another email (which is then shown as an overlap)."""
+        db_creator.bulk_create_network_data(Host, [{'host_name': 'example.org', 'headers': [self.email.header.id]}])
+        self.client.get(self.url)
+        related_email = self.create_related_email('related', 'a related email')
+        db_creator.bulk_create_network_data(Host, [{'host_name': 'example.org', 'headers': [related_email.header.id]}])
+
+        misses = render_cache.stats['misses']
+        response = self.client.get(self.url)
+        assert render_cache.stats['misses'] == misses + 1
+        assert '(header) a related email' in response.content.decode('utf-8')
+
+        # the same is true of network data which is added using the related managers
+        other_email = self.create_related_email('other', 'another related email')
+        Host.objects.get(pk='example.org').headers.add(other_email.header)
+        misses = render_cache.stats['misses']
+        response = self.client.get(self.url)
+        assert render_cache.stats['misses'] == misses + 1
+        assert '(header) another related email' in response.content.decode('utf-8')
+
+    def test_overlaps_beyond_the_limit_do_not_invalidate_sections(self):
+        """Once there are enough overlaps that a "view more" link is shown, the sections of the emails with the network data are not rendered again when it is found in more emails."""
+        host_name = 'example.org'
+        header_ids = [self.email.header.id] + [
+            self.create_related_email('related{}'.format(i), 'related email {}'.format(i)).header.id for i in range(5)
+        ]
+        db_creator.bulk_create_network_data(Host, [{'host_name': host_name, 'headers': header_ids}])
+        key = render_cache.cache_key(Email.objects.get(pk=self.email.id))
+
+        related_email = self.create_related_email('related5', 'related email 5')
+        db_creator.bulk_create_network_data(Host, [{'host_name': host_name, 'headers': [related_email.header.id]}])
+        assert render_cache.cache_key(Email.objects.get(pk=self.email.id)) == key
+
+    def test_votes_invalidate_sections(self):
+        self.client.get(self.url)
+        Header.objects.filter(pk=self.email.header.id).update(
+            subject_suspicious_votes=F('subject_suspicious_votes') + 1
+        )
+
+        misses = render_cache.stats['misses']
+        self.client.get(self.url)
+        assert render_cache.stats['misses'] == misses + 1
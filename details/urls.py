@@ -9,4 +9,9 @@ urlpatterns = [
     url(r'^(?P<pk>[0-9a-f]{64})/feedback/?$', views.EmailFeedbackView.as_view(), name='feedback'),
     url(r'^(?P<pk>[0-9a-f]{64})/redaction/?$', views.EmailRedactionView.as_view(), name='redaction'),
     url(r'^(?P<pk>[0-9a-f]{64})/reanalyze/?$', views.reanalyze_email, name='reanalyze'),
+    url(
+        r'^(?P<pk>[0-9a-f]{64})/(?P<related_name>bodies|attachments)/(?P<item_id>[0-9a-f]{64})/?$',
+        views.email_content,
+        name='content',
+    ),
 ]
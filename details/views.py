@@ -5,11 +5,13 @@ import datetime
 
 from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponseRedirect
+from django.http import FileResponse, Http404, HttpResponseRedirect
 from django.urls import reverse
 from django.views import generic
 
+from db.blob_store import BlobNotFoundError
 from db.models import Email
+from . import render_cache
 import analyzer
 from utility import utility
 from totalemail import settings
@@ -23,13 +25,34 @@ class EmailDetailView(generic.DetailView):
     model = Email
     template_name = "details/email-details-base.html"
 
+    def get_queryset(self):
+        # the full text of the email is not shown and the data of the header is only needed when the cached sections are rendered
+        return Email.objects.select_related('header').defer('full_text', 'search_vector', 'header__data')
+
     def get_context_data(self, **kwargs):
         context = super(EmailDetailView, self).get_context_data(**kwargs)
-        email_id = self.object.id
-
         # note: we don't need to handle cases where the given email id is invalid because this is handled by the parent class (generic.DetailView)
-        email = Email.objects.get(pk=email_id)
+        email = self.object
+
+        # the sections of the page which show the header, bodies, attachments, analyses, and network data are only rendered when they are not cached (see `details.render_cache`)
+        context.update(render_cache.rendered_sections(email, lambda: self.get_sections_context(email)))
+        context['score'] = email.score
+
+        try:
+            # check to see if email was recently uploaded (if so, how a jgrowl letting them know they can refresh the page to view the external analyses)
+            today = datetime.datetime.today()
+            delta = datetime.timedelta(seconds=20)
+            if (today - delta) < email.modified:
+                context['new'] = True
+            else:
+                context['new'] = False
+        except AttributeError:
+            pass
 
+        return context
+
+    def get_sections_context(self, email):
+        """Return the context used to render the cached sections of the page."""
         network_data, network_data_flat_list, network_data_overlaps, network_data_count = email.network_data()
 
         network_data_header_count = (
@@ -44,26 +67,15 @@ class EmailDetailView(generic.DetailView):
             + len(network_data['bodies']['urls'])
         )
 
-        context['network_data'] = network_data
-        context['network_data_flat_list'] = network_data_flat_list
-        context['network_data_overlaps'] = network_data_overlaps
-        context['network_data_count'] = network_data_count
-        context['network_data_header_count'] = network_data_header_count
-        context['network_data_body_count'] = network_data_body_count
-        context['score'] = utility.email_score_calculate(email)
-
-        try:
-            # check to see if email was recently uploaded (if so, how a jgrowl letting them know they can refresh the page to view the external analyses)
-            today = datetime.datetime.today()
-            delta = datetime.timedelta(seconds=20)
-            if (today - delta) < email.modified:
-                context['new'] = True
-            else:
-                context['new'] = False
-        except AttributeError:
-            pass
-
-        return context
+        return {
+            'email': email,
+            'network_data': network_data,
+            'network_data_flat_list': network_data_flat_list,
+            'network_data_overlaps': network_data_overlaps,
+            'network_data_count': network_data_count,
+            'network_data_header_count': network_data_header_count,
+            'network_data_body_count': network_data_body_count,
+        }
 
 
 def reanalyze_email(request, **kwargs):
@@ -74,11 +86,27 @@ def reanalyze_email(request, **kwargs):
         messages.error(request, 'No email found with the ID: {}'.format(kwargs['pk']))
         return HttpResponseRedirect('/')
     else:
-        analyzer.start_analysis(email, True)
-        messages.info(request, 'Email submitted for reanalysis. Updated results should be posted shortly.')
+        # the request is queued (see `analyzer.external_analysis.analysis_queue`), so it is only not submitted when external analysis is disabled
+        if analyzer.start_analysis(email, True):
+            messages.info(request, 'Email submitted for reanalysis. Updated results should be posted shortly.')
+        else:
+            messages.warning(request, 'External analysis is disabled, so the email was not submitted for reanalysis.')
         return HttpResponseRedirect(reverse('details:details', args=(kwargs['pk'],)))
 
 
+def email_content(request, **kwargs):
+    """Stream the full text of one of an email's bodies or attachments as plain text (this is how the full text of the bodies and attachments which are too large to show in the details page is viewed)."""
+    try:
+        email = Email.objects.get(pk=kwargs['pk'])
+        item = getattr(email, kwargs['related_name']).get(pk=kwargs['item_id'])
+    except ObjectDoesNotExist:
+        raise Http404
+    try:
+        return FileResponse(item.open_full_text(), content_type='text/plain; charset=utf-8')
+    except BlobNotFoundError:
+        raise Http404('The full text of {} is missing from the blob store.'.format(item.id))
+
+
 class EmailFeedbackView(generic.DetailView):
     model = Email
     template_name = 'details/email-feedback.html'
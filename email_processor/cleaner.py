@@ -3,114 +3,166 @@
 
 import re
 
+from . import pii
+from .parse_attachments import UUENCODE_TRANSFER_ENCODINGS
 from .parse_headers import parse_header
+from .parsed_email import ParsedEmail
 from utility import utility
 
-# TODO: make this code beautiful (1)
-
-
-def _clean_pii(text):
-    """."""
-    ssn_pattern = '(\d{3}-\d{2}-\d{4})'
-    cleaned_text = re.sub(ssn_pattern, 'REDACTED', text, flags=re.IGNORECASE)
-
-    phone_number_pattern = '(?<!\d)(?:(?:\(?[0-9]{3}(\)?(?: |[-.]))))[0-9]{3}[ -.][0-9]{4}'
-    cleaned_text = re.sub(phone_number_pattern, 'REDACTED', cleaned_text, flags=re.IGNORECASE)
-
-    return cleaned_text
-
-
-def clean_email(email_text, redaction_values=None, redact_pii=False):
-    """Clean an email."""
-    FIELDS_TO_REDACT = ('to', 'delivered-to')
-    cleaned_email = email_text
-    redaction_value_list = []
+FIELDS_TO_REDACT = ('to', 'delivered-to')
+REDACTION_TEXT = pii.REDACTION_TEXT
+# base64 encoded words (see https://tools.ietf.org/html/rfc2047#section-2) whose decoded content is redacted
+BASE64_ENCODED_WORD_PATTERN = r'=\?[a-zA-Z0-9\-]+\?[Bb]\?(?P<encoded_content>[a-zA-Z0-9+\/=]+)\?='
+
+# the kinds of the payloads of the parts of an email which are not redacted as they are (see `_payload_segments`)
+ATTACHMENT_PAYLOAD = 'attachment'
+BASE64_BODY_PAYLOAD = 'base64 body'
+
+
+class Redactor(object):
+    """Redact the given values (ignoring case) and, optionally, PII (using the given `pii.PIIRedactor`) from text in a single pass using one compiled pattern. The content of base64 encoded words is decoded, redacted, and encoded again."""
+
+    def __init__(self, redaction_values, pii_redactor=None):
+        self.redaction_values = []
+        for value in redaction_values:
+            if value and value.lower() not in (existing_value.lower() for existing_value in self.redaction_values):
+                self.redaction_values.append(value)
+
+        patterns = [BASE64_ENCODED_WORD_PATTERN]
+        # the values are tried in the order they were given at each position in the text (the same order in which they used to be substituted one after the other) and only they ignore case (the IGNORECASE flag makes the PII patterns much slower)
+        if self.redaction_values:
+            first_characters = ''.join(sorted({re.escape(value[0]) for value in self.redaction_values}))
+            patterns.append(
+                '(?i:(?=[{}])(?:{}))'.format(
+                    first_characters, '|'.join(re.escape(value) for value in self.redaction_values)
+                )
+            )
+        self.pii_redactor = pii_redactor
+        if pii_redactor is not None:
+            patterns.append(pii.pattern_source(pii_redactor.categories))
+        self.pattern = re.compile('|'.join(patterns))
+
+    def redact(self, text):
+        """Return the given text with every redaction value (and PII) replaced."""
+        if self.pii_redactor is None:
+            return self.pattern.sub(self._replacement, text)
+
+        # the PII right after a redacted value (or other PII) is found as if the redacted text was already replaced (see `pii.PIIRedactor.finditer`)
+        redacted_text = []
+        end = 0
+        for start, match_end, match in self.pii_redactor.finditer(self.pattern, text):
+            redacted_text.append(text[end:start])
+            redacted_text.append(self._replacement(match))
+            end = match_end
+        redacted_text.append(text[end:])
+        return ''.join(redacted_text)
+
+    def _replacement(self, match):
+        # the matches of PII found right after other matches are matches of the PII pattern only (which has no encoded content group)
+        pii_category = self.pii_redactor.category(match) if self.pii_redactor is not None else None
+        if pii_category is not None:
+            return self.pii_redactor.replacement(match, pii_category)
+        if match.group('encoded_content') is None:
+            return REDACTION_TEXT
+
+        cleaned_content = self.redact(utility.base64_decode(match.group('encoded_content')))
+        return '{}{}?='.format(
+            match.string[match.start() : match.start('encoded_content')], utility.base64_encode(cleaned_content)
+        )
+
+
+def _recipient_values(parsed_email):
+    """Return the display names and email addresses of the recipients of the email (from the fields in FIELDS_TO_REDACT)."""
+    values = []
+    for header_key, header_value in parse_header(parsed_email):
+        if header_key.lower() not in FIELDS_TO_REDACT:
+            continue
+
+        for value in header_value.split(','):
+            parsed_email_address = utility.parse_email_address(value.strip())
+
+            if parsed_email_address.display_name:
+                values.append(parsed_email_address.display_name)
+
+            if parsed_email_address.username and parsed_email_address.domain:
+                values.append('{}@{}'.format(parsed_email_address.username, parsed_email_address.domain))
+
+    return values
+
+
+def _payload_segments(email_text, start, end, message):
+    """Yield the start, end, and kind of the payloads of the base64 (or uuencoded) attachments and base64 encoded bodies of the given message (whose text is email_text[start:end]) in the order they appear in the text. The payloads of the other bodies, and the header fields and boundaries of each part, are redacted as they are, so they are not yielded."""
+    # a part which starts with a blank line has no header fields
+    header_end = re.compile('\r?\n').match(email_text, start, end)
+    if header_end is None:
+        header_end = re.compile('\r?\n\r?\n').search(email_text, start, end)
+    payload_start = header_end.end() if header_end else end
+
+    if message.is_multipart():
+        subparts = message.get_payload()
+        boundary = message.get_boundary()
+        # the payload of a message/rfc822 part is an entire email
+        if boundary is None:
+            if len(subparts) == 1:
+                yield from _payload_segments(email_text, payload_start, end, subparts[0])
+            return
+
+        delimiters = list(
+            re.compile('^--{}(--)?[ \t]*\r?$'.format(re.escape(boundary)), flags=re.MULTILINE).finditer(
+                email_text, payload_start, end
+            )
+        )
+        # the parts are between each pair of consecutive delimiters (anything after the closing delimiter is ignored)
+        for closing_index, delimiter in enumerate(delimiters):
+            if delimiter.group(1):
+                delimiters = delimiters[: closing_index + 1]
+                break
+        if len(delimiters) - 1 != len(subparts):
+            # the boundaries could not be matched up with the parts the email was parsed into, so the entire payload is redacted as it is
+            return
+
+        for subpart, delimiter, next_delimiter in zip(subparts, delimiters, delimiters[1:]):
+            subpart_start = delimiter.end() + 1
+            # the line break before a delimiter belongs to the delimiter (see https://tools.ietf.org/html/rfc2046#section-5.1.1)
+            subpart_end = next_delimiter.start() - 1
+            if email_text[subpart_end - 1 : subpart_end] == '\r':
+                subpart_end -= 1
+            if subpart_start <= subpart_end:
+                yield from _payload_segments(email_text, subpart_start, subpart_end, subpart)
+    else:
+        transfer_encoding = str(message.get('Content-Transfer-Encoding', '')).strip().lower()
+        # the encoded payload of an attachment cannot contain the text being redacted (the payloads of other attachments, e.g. plain text ones, are redacted as they are)
+        if message.get_content_disposition() == 'attachment':
+            if transfer_encoding == 'base64' or transfer_encoding in UUENCODE_TRANSFER_ENCODINGS:
+                yield payload_start, end, ATTACHMENT_PAYLOAD
+        elif transfer_encoding == 'base64':
+            yield payload_start, end, BASE64_BODY_PAYLOAD
+
+
+def clean_email(email_text, redaction_values=None, redact_pii=False, pii_redactor=None):
+    """Clean an email (the email_text can be the text of an email or a ParsedEmail). The recipients of the email and the given (comma separated) redaction values are redacted from the header fields and bodies of the email in a single pass over each part of the email (the base64 and uuencoded attachments are not changed). If redact_pii is true, PII is redacted using the given `pii.PIIRedactor` (which counts the PII redacted) or one for the default categories of PII."""
+    parsed_email = ParsedEmail.from_text(email_text)
+    email_text = parsed_email.text
+    user_redaction_values = []
     if redaction_values:
-        redaction_value_list = [value.strip() for value in redaction_values.split(',')]
-
-    # replace certain headers in the email
-    email_header_json = parse_header(email_text)
-    for header_key, header_value in email_header_json:
-        # if the header is one that we are going to redact, redact appropriately
-        if header_key.lower() in FIELDS_TO_REDACT:
-            if ',' in header_value:
-                values = header_value.split(',')
-            else:
-                values = [header_value]
-
-            for value in values:
-                value = value.strip()
-                parsed_email_address = utility.parse_email_address(value)
-
-                if parsed_email_address.display_name:
-                    cleaned_email = re.sub(
-                        re.escape(parsed_email_address.display_name), 'REDACTED', cleaned_email, flags=re.IGNORECASE
-                    )
-                    redaction_value_list.append(parsed_email_address.display_name)
-
-                if parsed_email_address.username and parsed_email_address.domain:
-                    email_address = '{}@{}'.format(parsed_email_address.username, parsed_email_address.domain)
-                    cleaned_email = re.sub(re.escape(email_address), 'REDACTED', cleaned_email, flags=re.IGNORECASE)
-                    redaction_value_list.append(email_address)
-
-    # redact the headers
-    for header in email_header_json:
-        original_header_content = ': '.join(header)
-        cleaned_header = original_header_content
-        for redaction_value in redaction_value_list:
-            if redaction_value.lower() in cleaned_header.lower():
-                cleaned_header = re.sub(re.escape(redaction_value), 'REDACTED', cleaned_header, flags=re.IGNORECASE)
-        if redact_pii:
-            cleaned_header = _clean_pii(cleaned_header)
-        cleaned_email = re.sub(re.escape(original_header_content), cleaned_header, cleaned_email, flags=re.IGNORECASE)
-
-    # find all base64 encoded header values
-    base64_encoded_header_pattern = '=\?[a-zA-Z0-9\-]+\?B\?([a-zA-Z0-9+\/=]+)\?='
-    for base64_content in re.findall(base64_encoded_header_pattern, email_text):
-        # decode the content
-        decoded_content = utility.base64_decode(base64_content)
-        cleaned_content = decoded_content
-
-        for redaction_value in redaction_value_list:
-            if redaction_value.lower() in decoded_content.lower():
-                cleaned_content = re.sub(re.escape(redaction_value), 'REDACTED', decoded_content, flags=re.IGNORECASE)
-
-        if redact_pii:
-            cleaned_content = _clean_pii(cleaned_content)
-
-        # encode the content and replace it in the email
-        encoded_content = utility.base64_encode(cleaned_content)
-        cleaned_email = re.sub(re.escape(base64_content), encoded_content, cleaned_email, flags=re.IGNORECASE)
-
-    # redact the bodies
-    email_object = utility.email_read(cleaned_email)
-    for body in utility.email_bodies_as_objects(email_object):
-        body_payload = body.get_payload()
-        if body.get('Content-Transfer-Encoding') and body['Content-Transfer-Encoding'].lower() == 'base64':
-            # decode the body
-            decoded_body = utility.base64_decode(body_payload)
-            cleaned_body = decoded_body
-
-            # redact
-            for redaction_value in redaction_value_list:
-                if redaction_value.lower() in decoded_body.lower():
-                    cleaned_body = re.sub(re.escape(redaction_value), 'REDACTED', decoded_body, flags=re.IGNORECASE)
-
-            if redact_pii:
-                cleaned_body = _clean_pii(cleaned_body)
-
-            # reencode and replace the body
-            encoded_body = utility.base64_encode(cleaned_body)
-            cleaned_email = re.sub(re.escape(body_payload), encoded_body, cleaned_email, flags=re.IGNORECASE)
+        user_redaction_values = [value.strip() for value in redaction_values.split(',')]
+    if not redact_pii:
+        pii_redactor = None
+    elif pii_redactor is None:
+        pii_redactor = pii.PIIRedactor()
+    # the recipients used to be redacted from the entire email before the other values, so they are tried first
+    redactor = Redactor(_recipient_values(parsed_email) + user_redaction_values, pii_redactor=pii_redactor)
+
+    cleaned_email = []
+    position = 0
+    for start, end, kind in _payload_segments(email_text, 0, len(email_text), parsed_email.message):
+        cleaned_email.append(redactor.redact(email_text[position:start]))
+        if kind == BASE64_BODY_PAYLOAD:
+            cleaned_body = redactor.redact(utility.base64_decode(email_text[start:end]))
+            cleaned_email.append(utility.base64_encode(cleaned_body))
         else:
-            cleaned_body = body_payload
-            for redaction_value in redaction_value_list:
-                if redaction_value.lower() in cleaned_body.lower():
-                    cleaned_body = re.sub(re.escape(redaction_value), 'REDACTED', cleaned_body, flags=re.IGNORECASE)
-
-            if redact_pii:
-                cleaned_body = _clean_pii(cleaned_body)
-
-            cleaned_email = re.sub(re.escape(body_payload), cleaned_body, cleaned_email, flags=re.IGNORECASE)
+            cleaned_email.append(email_text[start:end])
+        position = end
+    cleaned_email.append(redactor.redact(email_text[position:]))
 
-    return cleaned_email
+    return ''.join(cleaned_email)
@@ -2,41 +2,106 @@
 # -*- coding: utf-8 -*-
 """Provide standardized formatting an email should undergo before being created in the DB."""
 
+import codecs
+import functools
 import re
 
+# the first charset declared in an email (which is used to decode emails which are not utf-8)
+DECLARED_CHARSET_PATTERN = re.compile(rb'charset\s*=\s*["\']?([A-Za-z0-9_.:-]+)', flags=re.IGNORECASE)
+# the ascii characters found in the header fields of an email (an email is only decoded as a charset which decodes them as ascii so that its header fields are not garbled)
+ASCII_SAMPLE = bytes(range(0x20, 0x7F)) + b'\t\r\n'
+# a null character and anything after it on the same line (by the type of the text)
+NULL_CHARACTERS = {str: '\x00', bytes: b'\x00'}
+NULL_CHARACTER_PATTERNS = {str: re.compile('\x00[^\n]*'), bytes: re.compile(b'\x00[^\n]*')}
 
-def _decode_text(text):
-    """Decode the given text appropriately."""
-    if isinstance(text, bytes):
+
+@functools.lru_cache(maxsize=None)
+def _is_ascii_compatible(charset):
+    """Return whether python knows the given charset and it decodes ascii as ascii (e.g. "utf-16", "utf-7", and the EBCDIC charsets do not)."""
+    try:
+        codecs.lookup(charset)
+        return str(ASCII_SAMPLE, charset) == ASCII_SAMPLE.decode('ascii')
+    # a LookupError is raised for codecs which are not text encodings (e.g. "base64")
+    except (LookupError, UnicodeDecodeError):
+        return False
+
+
+def _declared_charset(data):
+    """Return the first charset declared in the given email (if python knows it and it is ascii compatible)."""
+    match = DECLARED_CHARSET_PATTERN.search(data)
+    if match is None:
+        return None
+
+    charset = match.group(1).decode('ascii')
+    if not _is_ascii_compatible(charset.lower()):
+        return None
+    return charset
+
+
+def _decode_non_utf8_bytes(data):
+    """Decode the given bytes (or other bytes-like object) which are not utf-8 as the charset declared in the email (if it is ascii compatible) or, if that fails, as utf-8 with the bytes which cannot be decoded replaced."""
+    charset = _declared_charset(data)
+    if charset is not None:
         try:
-            decoded_text = text.decode('utf-8')
+            return str(data, charset)
         except UnicodeDecodeError:
-            decoded_text = str(text)
-    else:
-        decoded_text = text
+            pass
 
-    # replace any null characters (and anything after a null character)
-    decoded_text = re.sub('\x00.*?\n', '\n', decoded_text)
+    return str(data, 'utf-8', 'replace')
 
-    return decoded_text
+
+def _decode_bytes(data):
+    """Decode the given bytes (or other bytes-like object) as utf-8, then as the charset declared in the email, and finally as utf-8 with the bytes which cannot be decoded replaced."""
+    try:
+        return str(data, 'utf-8')
+    except UnicodeDecodeError:
+        return _decode_non_utf8_bytes(data)
+
+
+def _strip_null_characters(text):
+    """Remove any null characters (and anything after a null character on the same line) from the given str or bytes."""
+    text_type = str if isinstance(text, str) else bytes
+    # the text is only copied if there is a null character in it
+    if NULL_CHARACTERS[text_type] in text:
+        text = NULL_CHARACTER_PATTERNS[text_type].sub(text_type(), text)
+    return text
+
+
+def _decode_text(text):
+    """Decode the given text appropriately."""
+    if not isinstance(text, str):
+        text = _decode_bytes(text)
+
+    # replace any null characters (and anything after a null character)
+    return _strip_null_characters(text)
 
 
 def _remove_line_endings(text):
-    # find all newlines NOT preceded by a carriage return
-    pattern = '(?<!\r)\n'
-    # add a carriage return before all newlines NOT preceded by a carriage return
-    text = re.sub(pattern, '\r\n', text)
+    """Add a carriage return before all newlines NOT preceded by a carriage return in the given str or bytes."""
+    newline, carriage_return_newline = ('\n', '\r\n') if isinstance(text, str) else (b'\n', b'\r\n')
+    # the text is only copied if it has a newline which is not preceded by a carriage return
+    if text.count(newline) != text.count(carriage_return_newline):
+        text = text.replace(carriage_return_newline, newline).replace(newline, carriage_return_newline)
 
     # if the text does not end in a newline, add one (this is according to spec)
-    if not text.endswith('\r\n'):
-        text = text + '\r\n'
+    if not text.endswith(carriage_return_newline):
+        text = text + carriage_return_newline
 
     return text
 
 
+def format_email_bytes(data):
+    """Format the given bytes (or bytearray) for being stored in the DB before decoding them (so they are only decoded once). Returns the formatted bytes and their decoded text. If the bytes are not utf-8, None is returned in place of the formatted bytes (the formatted bytes are only returned when they are the utf-8 encoding of the text so that, for example, the text's hash can be found from them without encoding the text again)."""
+    formatted_data = _remove_line_endings(_strip_null_characters(data))
+    try:
+        return formatted_data, str(formatted_data, 'utf-8')
+    except UnicodeDecodeError:
+        return None, _decode_non_utf8_bytes(formatted_data)
+
+
 def format_email_for_db(email_text):
-    """Format the given request for being stored in the DB."""
-    formatted_email_text = _decode_text(email_text)
-    formatted_email_text = _remove_line_endings(formatted_email_text)
+    """Format the given request for being stored in the DB. The email_text can be a str, bytes, or any other bytes-like object (e.g. a memoryview). Bytes are formatted before they are decoded (see `format_email_bytes`) and other bytes-like objects are decoded without being copied into bytes first."""
+    if isinstance(email_text, (bytes, bytearray)):
+        return format_email_bytes(email_text)[1]
 
-    return formatted_email_text
+    return _remove_line_endings(_decode_text(email_text))
@@ -2,35 +2,213 @@
 # -*- coding: utf-8 -*-
 """Parse attachments and attachment metadata from email text."""
 
+import binascii
+import copy
 import hashlib
+import logging
+import re
 
-from utility import utility
+logger = logging.getLogger(__name__)
 
+# the number of characters of an attachment's payload which are decoded and hashed at a time (so the memory used to hash an attachment does not depend on its size)
+HASH_CHUNK_SIZE = 64 * 1024
+# the characters of base64 (any other characters in a base64 payload are ignored when it is decoded)
+BASE64_CHARACTERS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='
+NON_BASE64_CHARACTERS = bytes(character for character in range(256) if character not in BASE64_CHARACTERS)
+UUENCODE_TRANSFER_ENCODINGS = ('x-uuencode', 'uuencode', 'x-uue', 'uue')
+LINE_PATTERN = re.compile('[^\n]*\n?')
+# the line endings which the `email` module's generator replaces with the policy's line separator
+LINE_ENDING_PATTERN = re.compile('\r\n|\r|\n')
+SURROGATE_PATTERN = re.compile('[\ud800-\udfff]')
 
-def parse_attachment(attachment):
-    """Parse attachments and attachment metadata from email text."""
-    attachment_data = dict()
 
-    formatted_payload_content = str(attachment.get_payload()).replace('\n', '').encode('utf-8')
+class AttachmentHasher(object):
+    """Find the md5, sha1, and sha256 hashes and the size of data which is given to it in chunks (so each chunk only has to be read once)."""
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.sha1 = hashlib.sha1()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        self.sha1.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+
+def _chunks(text):
+    """Yield the given text in chunks (of at most HASH_CHUNK_SIZE characters) which end at the end of a line if there is a line ending in them."""
+    start = 0
+    while start < len(text):
+        end = start + HASH_CHUNK_SIZE
+        if end < len(text):
+            line_end = text.rfind('\n', start, end)
+            if line_end != -1:
+                end = line_end + 1
+        yield text[start:end]
+        start = end
+
 
+def _lines(text):
+    """Yield the lines of the given text (with their line endings) without splitting the entire text at once."""
+    for match in LINE_PATTERN.finditer(text):
+        if match.group():
+            yield match.group()
+
+
+def _hash_base64(payload, hasher):
+    """Decode the given base64 payload and hash it in chunks. The padding is fixed (and the characters which are not base64 are ignored) the same way `utility.decode_base64` does it for the newline-less payload. Returns False if the payload has incorrect padding (in which case some of it may already have been hashed)."""
+    # the number of bytes in the newline-less payload (which the padding is based on)
+    payload_length = 0
+    # the base64 characters which have not been decoded yet (the decoding state is reset after every four base64 characters, so the data is decoded in pieces of a multiple of four characters until padding is found)
+    pending_data = b''
+    found_padding = False
+    for chunk in _chunks(payload):
+        data = chunk.replace('\n', '').encode('utf-8')
+        payload_length += len(data)
+        pending_data += data.translate(None, NON_BASE64_CHARACTERS)
+        # everything after the first padding character is decoded at the end because padding changes how the characters around it are decoded
+        found_padding = found_padding or b'=' in pending_data
+        if not found_padding:
+            decoded_length = len(pending_data) - len(pending_data) % 4
+            hasher.update(binascii.a2b_base64(pending_data[:decoded_length]))
+            pending_data = pending_data[decoded_length:]
+
+    missing_padding = payload_length % 4
+    if missing_padding == 1:
+        pending_data += b'A=='
+    elif missing_padding:
+        pending_data += b'=' * (4 - missing_padding)
     try:
-        decoded_content = utility.decode_base64(formatted_payload_content)
-    except Exception as e:
-        if str(e) == "Incorrect padding":
-            # TODO: Just a reminder for J: I choose not to keep track of whether or not an attachment's hashes came from the decoded attachment or the undecoded version because I plan on later capturing the hashes of both (the decoded and undedoced versions) and we can easily compare the two to determine if an email was correctly decoded or not (2)
-            print("[attachment parser]: Unable to read payload for attachment: {}".format(attachment))
-            decoded_content = formatted_payload_content
-        else:
-            raise e
+        hasher.update(binascii.a2b_base64(pending_data))
+    except binascii.Error:
+        return False
+    return True
+
+
+def _hash_quoted_printable(payload, hasher):
+    """Decode the given quoted-printable payload and hash it in chunks (each of which ends at a line ending unless a line is longer than a chunk)."""
+    pending_text = ''
+    for chunk in _chunks(payload):
+        chunk = pending_text + chunk
+        pending_text = ''
+        # an escaped character or soft line break at the end of a chunk could be cut in half, so it is moved into the next chunk (along with any equals signs before it because "==" is decoded as "=")
+        if not chunk.endswith('\n'):
+            escape_index = chunk.find('=', len(chunk) - 2)
+            if escape_index != -1:
+                while escape_index > 0 and chunk[escape_index - 1] == '=':
+                    escape_index -= 1
+                chunk, pending_text = chunk[:escape_index], chunk[escape_index:]
+        hasher.update(binascii.a2b_qp(chunk.encode('utf-8')))
+    hasher.update(binascii.a2b_qp(pending_text.encode('utf-8')))
+
+
+def _hash_uuencoded(payload, hasher):
+    """Decode the given uuencoded payload (between its "begin" and "end" lines) and hash it in chunks. If the payload has no "begin" line, it is hashed as it is (like the `email` module does)."""
+    decoded_data = bytearray()
+    found_begin_line = False
+    for line in _lines(payload):
+        if not found_begin_line:
+            found_begin_line = line.startswith('begin ')
+            continue
+        if line.strip(' \t\r\n\f') == 'end':
+            break
+
+        line = line.encode('utf-8')
+        try:
+            decoded_data += binascii.a2b_uu(line)
+        except binascii.Error:
+            # some encoders add garbage characters to the end of the lines (this workaround is the same as the one used by the `uu` module)
+            line_length = (((line[0] - 32) & 63) * 4 + 5) // 3
+            decoded_data += binascii.a2b_uu(line[:line_length])
+        if len(decoded_data) >= HASH_CHUNK_SIZE:
+            hasher.update(decoded_data)
+            decoded_data.clear()
+
+    if not found_begin_line:
+        _hash_payload(payload, hasher)
+    hasher.update(decoded_data)
+
+
+def _hash_payload(payload, hasher, remove_newlines=False):
+    """Hash the given undecoded payload (optionally without its newlines) in chunks."""
+    for chunk in _chunks(payload):
+        if remove_newlines:
+            chunk = chunk.replace('\n', '')
+        hasher.update(chunk.encode('utf-8'))
+
+
+def hash_attachment(attachment):
+    """Return an `AttachmentHasher` with the hashes and size of the decoded content of the given attachment. Quoted-printable and uuencoded payloads are decoded as such and any other payload is decoded as base64 (as attachments always have been). The content is decoded and hashed in chunks without copying the entire payload."""
+    payload = attachment.get_payload()
+    if not isinstance(payload, str):
+        payload = str(payload)
+    transfer_encoding = str(attachment.get('Content-Transfer-Encoding', '')).strip().lower()
+
+    hasher = AttachmentHasher()
+    if transfer_encoding == 'quoted-printable':
+        _hash_quoted_printable(payload, hasher)
+    elif transfer_encoding in UUENCODE_TRANSFER_ENCODINGS:
+        _hash_uuencoded(payload, hasher)
+    elif not _hash_base64(payload, hasher):
+        # TODO: Just a reminder for J: I choose not to keep track of whether or not an attachment's hashes came from the decoded attachment or the undecoded version because I plan on later capturing the hashes of both (the decoded and undedoced versions) and we can easily compare the two to determine if an email was correctly decoded or not (2)
+        logger.warning(
+            'Unable to decode the payload of the attachment {} ({}), so its undecoded payload was hashed'.format(
+                attachment.get_filename(), attachment.get_content_type()
+            )
+        )
+        hasher = AttachmentHasher()
+        _hash_payload(payload, hasher, remove_newlines=True)
+
+    return hasher
+
+
+def write_attachment_text(attachment, fp):
+    """Write the text of the given attachment (the same text as `str(attachment)`) to the given file object a piece at a time so that the text of a large attachment is never copied in memory (the `email` module's generator makes a few copies of the payload). Multipart attachments and attached emails (which the generator writes differently) and payloads with surrogates (which the generator re-encodes) are written using the generator."""
+    # the surrogates are found in the payload as it is stored (`get_payload` replaces them)
+    payload = attachment.get_payload()
+    if (
+        attachment.get_content_maintype() in ('multipart', 'message')
+        or not isinstance(payload, str)
+        or SURROGATE_PATTERN.search(attachment._payload)
+    ):
+        fp.write(str(attachment))
+        return
+
+    # the headers are written by the generator (which folds them differently for each type of message) from a copy of the attachment without its payload
+    headers = copy.copy(attachment)
+    headers.set_payload('')
+    fp.write(str(headers))
+
+    # a line ending split between chunks ("\r" at the end of one chunk and "\n" at the start of the next) is moved into the next chunk
+    pending_text = ''
+    for chunk in _chunks(payload):
+        chunk = pending_text + chunk
+        pending_text = ''
+        if chunk.endswith('\r'):
+            chunk, pending_text = chunk[:-1], '\r'
+        fp.write(LINE_ENDING_PATTERN.sub(attachment.policy.linesep, chunk))
+    if pending_text:
+        fp.write(attachment.policy.linesep)
+
+
+def parse_attachment(attachment):
+    """Parse attachments and attachment metadata from email text."""
+    attachment_data = dict()
 
     # find the hashes for the attachment content
-    attachment_data['id'] = hashlib.sha256(decoded_content).hexdigest()
-    attachment_data['md5'] = hashlib.md5(decoded_content).hexdigest()
-    attachment_data['sha1'] = hashlib.sha1(decoded_content).hexdigest()
+    hasher = hash_attachment(attachment)
+    attachment_data['id'] = hasher.sha256.hexdigest()
+    attachment_data['md5'] = hasher.md5.hexdigest()
+    attachment_data['sha1'] = hasher.sha1.hexdigest()
+    attachment_data['size'] = hasher.size
 
     # use the built-in functions from the `email` module to find metadata about the attachment
     attachment_data['content_type'] = attachment.get_content_type()
     attachment_data['filename'] = attachment.get_filename()
-    attachment_data['full_text'] = str(attachment)
+    # the text of the attachment is written to the database (or blob store) from the part (see `db.db_creator.create_attachment`) rather than being copied here
+    attachment_data['part'] = attachment
 
     return attachment_data
@@ -2,15 +2,9 @@
 # -*- coding: utf-8 -*-
 """Parse header fields from an email."""
 
-from utility import utility
+from .parsed_email import ParsedEmail
 
 
 def parse_header(email_text):
-    """Parser email headers."""
-    try:
-        email_object = utility.email_read(email_text)
-        return email_object.items()
-    # an index error sometimes occurs when python's default email policy (https://docs.python.org/3/library/email.policy.html#email.policy.default) does not read the email properly
-    except IndexError:
-        email_object = utility.email_read(email_text, policy='')
-        return email_object.items()
+    """Parser email headers (the email_text can be the text of an email or a ParsedEmail)."""
+    return ParsedEmail.from_text(email_text).header
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Parse an email once and share the parsed pieces of it with the rest of the processing pipeline."""
+
+from utility import utility
+
+
+class ParsedEmail(object):
+    """Wrap the text of an email and lazily cache the parsed message, header, structure, bodies, and attachments so the email text is only parsed once."""
+
+    def __init__(self, email_text):
+        self.text = email_text
+        self._message = None
+        self._header = None
+        self._structure = None
+        self._bodies = None
+        self._attachments = None
+
+    @classmethod
+    def from_text(cls, email_text):
+        """Return a ParsedEmail for the given email text (or the given ParsedEmail if it has already been parsed)."""
+        if isinstance(email_text, cls):
+            return email_text
+        return cls(email_text)
+
+    @property
+    def message(self):
+        """Return the email object (parsed with python's default email policy)."""
+        if self._message is None:
+            self._message = utility.email_read(self.text)
+        return self._message
+
+    @property
+    def header(self):
+        """Return the header fields of the email as a list of (key, value) tuples."""
+        if self._header is None:
+            try:
+                self._header = self.message.items()
+            # an index error sometimes occurs when python's default email policy (https://docs.python.org/3/library/email.policy.html#email.policy.default) does not read the email properly
+            except IndexError:
+                self._header = utility.email_read(self.text, policy='').items()
+        return self._header
+
+    @property
+    def structure(self):
+        if self._structure is None:
+            self._structure = utility.email_structure(self.message)
+        return self._structure
+
+    @property
+    def bodies(self):
+        if self._bodies is None:
+            self._bodies = utility.email_bodies_as_objects(self.message)
+        return self._bodies
+
+    @property
+    def attachments(self):
+        if self._attachments is None:
+            self._attachments = utility.email_attachments(self.message)
+        return self._attachments
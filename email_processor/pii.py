@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Find and redact personally identifiable information (PII) in text using one compiled pattern for all of the kinds (categories) of PII."""
+
+import collections
+import functools
+import re
+
+REDACTION_TEXT = 'REDACTED'
+
+
+def _luhn_checksum_is_valid(text):
+    """Return whether the digits in the given text pass the Luhn checksum (see https://en.wikipedia.org/wiki/Luhn_algorithm)."""
+    digits = [int(character) for character in text if character.isdigit()]
+    checksum = 0
+    for index, digit in enumerate(reversed(digits)):
+        if index % 2 == 1:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        checksum += digit
+    return checksum % 10 == 0
+
+
+def _iban_checksum_is_valid(text):
+    """Return whether the given text is an IBAN with a valid checksum (see https://en.wikipedia.org/wiki/International_Bank_Account_Number#Validating_the_IBAN)."""
+    iban = text.replace(' ', '').upper()
+    if not 15 <= len(iban) <= 34:
+        return False
+    rearranged_iban = iban[4:] + iban[:4]
+    return int(''.join(str(int(character, 36)) for character in rearranged_iban)) % 97 == 1
+
+
+# the pattern of a kind of PII, a pattern matching the start of the text the pattern matches (which is checked before any of the patterns are tried so that the text which cannot be PII is skipped quickly), the length of the longest text the pattern can match (which is used to overlap the chunks of text redacted by `PIIRedactor.redact_chunks`), and an optional function which returns whether or not a match really is PII
+PIIPattern = collections.namedtuple('PIIPattern', ['pattern', 'prefix', 'max_length', 'validator'])
+
+# the kinds of PII which can be redacted (when more than one kind matches at the same place in a text, the first one listed here is used) - the lookbehinds and word boundaries of the patterns only look at the character right before a match (see `PIIRedactor.finditer`)
+PII_PATTERNS = collections.OrderedDict(
+    [
+        ('ssn', PIIPattern(r'\d{3}-\d{2}-\d{4}', r'\d', 11, None)),
+        (
+            'phone_number',
+            PIIPattern(r'(?<!\d)(?:(?:\(?[0-9]{3}(?:\)?(?: |[-.]))))[0-9]{3}[ -.][0-9]{4}', r'[\d(]', 14, None),
+        ),
+        ('credit_card', PIIPattern(r'(?<!\d)(?:\d[ -]?){12,18}\d(?!\d)', r'\d', 37, _luhn_checksum_is_valid)),
+        (
+            'iban',
+            PIIPattern(
+                r'\b[A-Za-z]{2}\d{2}(?: ?[A-Za-z0-9]{4}){2,7}(?: ?[A-Za-z0-9]{1,3})?\b',
+                r'[A-Za-z]{2}\d',
+                42,
+                _iban_checksum_is_valid,
+            ),
+        ),
+        (
+            'email_address',
+            PIIPattern(
+                r'(?<![A-Za-z0-9._%+-])[A-Za-z0-9._%+-]{1,64}@[A-Za-z0-9.-]{1,252}\.[A-Za-z]{2,24}\b',
+                r'(?<![A-Za-z0-9._%+-])[A-Za-z0-9._%+-]{1,64}@',
+                343,
+                None,
+            ),
+        ),
+    ]
+)
+# the kinds of PII redacted from emails when PII redaction is requested (the email addresses in an email are not redacted by default because the sender's address is kept)
+DEFAULT_PII_CATEGORIES = ('ssn', 'phone_number', 'credit_card', 'iban')
+# the number of characters of text before a chunk which are kept so that the lookbehinds of the patterns work across chunks
+CHUNK_CONTEXT_LENGTH = 1
+
+
+@functools.lru_cache(maxsize=None)
+def _compile(categories):
+    """Compile (and cache) the combined pattern of the given categories of PII."""
+    return re.compile(pattern_source(categories))
+
+
+def pattern_source(categories):
+    """Return the source of a pattern which matches any of the given categories of PII (each in a group named after its category). The patterns are case sensitive (so that the pattern can be used without the IGNORECASE flag, which makes it much slower)."""
+    prefixes = []
+    for category in categories:
+        if PII_PATTERNS[category].prefix not in prefixes:
+            prefixes.append(PII_PATTERNS[category].prefix)
+    patterns = ('(?P<{}>{})'.format(category, PII_PATTERNS[category].pattern) for category in categories)
+    return '(?=(?:{}))(?:{})'.format('|'.join(prefixes), '|'.join(patterns))
+
+
+class PIIRedactor(object):
+    """Redact the given categories of PII from text and count how many of each category were redacted (in `counts`). The combined pattern of the categories is only compiled once per process."""
+
+    def __init__(self, categories=DEFAULT_PII_CATEGORIES):
+        unknown_categories = set(categories) - set(PII_PATTERNS)
+        if unknown_categories:
+            raise ValueError('Unknown PII categories: {}'.format(', '.join(sorted(unknown_categories))))
+
+        self.categories = tuple(categories)
+        self.pattern = _compile(self.categories)
+        self.max_length = max(PII_PATTERNS[category].max_length for category in self.categories)
+        self.counts = collections.Counter()
+        self._fallback_redactors = {}
+
+    def category(self, match):
+        """Return the category of PII the given match (of a pattern including `pattern_source(self.categories)`) found or None if it did not find PII."""
+        for category in self.categories:
+            if match.group(category) is not None:
+                return category
+        return None
+
+    def replacement(self, match, category):
+        """Return the replacement of the given match of the given category of PII (and count it). Text which does not pass the category's validator is searched again for PII of the other categories (e.g. a run of digits which is not a credit card number may contain a social security number)."""
+        text = match.group(category)
+        validator = PII_PATTERNS[category].validator
+        if validator is None or validator(text):
+            self.counts[category] += 1
+            return REDACTION_TEXT
+
+        fallback_redactor = self._fallback_redactor(category)
+        if fallback_redactor is None:
+            return text
+        # the text is searched where it is in the original text so that the lookbehinds of the patterns see the text before it
+        return fallback_redactor._substitute(
+            match.string, match.start(category), match.end(category), endpos=match.end(category)
+        )[0]
+
+    def finditer(self, pattern, text, pos=0, endpos=None, after_match=False):
+        """Yield the start, end, and match of each match of the given pattern (which includes `pattern_source(self.categories)`) in text[pos:endpos] like `pattern.finditer` does, except that the lookbehinds of the PII patterns do not see the text of the previous match (or the text before pos if after_match is true), so PII right after other PII is found as it is after the other PII has been redacted. A match found this way is a match in a copy of the text starting where the match starts, so its positions are relative to `match.string` (the start and end which are yielded are positions in the given text)."""
+        if endpos is None:
+            endpos = len(text)
+        while True:
+            match = None
+            if after_match:
+                match = pattern.match(text, pos, endpos)
+                # the other matches of the pattern (e.g. the redaction values of `cleaner.Redactor`) are tried first as they are at every other position
+                if match is None or self.category(match) is not None:
+                    pii_match = self.pattern.match(text[pos : min(pos + self.max_length + 1, endpos)])
+                    if pii_match is not None:
+                        yield pos, pos + pii_match.end(), pii_match
+                        pos += pii_match.end()
+                        continue
+            if match is None:
+                match = pattern.search(text, pos, endpos)
+            if match is None:
+                return
+            yield match.start(), match.end(), match
+            pos = match.end()
+            after_match = True
+
+    def redact(self, text):
+        """Return the given text with the PII in it redacted."""
+        return self._substitute(text, 0, len(text))[0]
+
+    def redact_chunks(self, chunks):
+        """Yield the given chunks of text with the PII in them redacted. The text at the end of each chunk which could be part of PII continuing into the next chunk is held back until the next chunk is read, so PII is redacted even when it is split between chunks and memory use is bounded by the size of the chunks."""
+        pending_text = ''
+        # the number of characters at the start of pending_text which were already redacted (and are only kept for the lookbehinds of the patterns) and whether they end with redacted PII
+        context_length = 0
+        after_match = False
+        for chunk in chunks:
+            pending_text += chunk
+            # a match which starts before the limit is never cut short by the end of the pending text
+            limit = len(pending_text) - self.max_length - 1
+            if limit <= context_length:
+                continue
+
+            redacted_text, end, after_match = self._substitute(
+                pending_text, context_length, limit, after_match=after_match
+            )
+            yield redacted_text
+            context_start = max(end - CHUNK_CONTEXT_LENGTH, 0)
+            pending_text = pending_text[context_start:]
+            context_length = end - context_start
+
+        if len(pending_text) > context_length:
+            yield self._substitute(pending_text, context_length, len(pending_text), after_match=after_match)[0]
+
+    def _fallback_redactor(self, category):
+        """Return a redactor of the categories other than the given category (which shares this redactor's counts) or None if there are none. Each fallback redactor has one category fewer than the redactor it falls back from, so text is never searched for a category which rejected it."""
+        if category not in self._fallback_redactors:
+            other_categories = tuple(other_category for other_category in self.categories if other_category != category)
+            fallback_redactor = None
+            if other_categories:
+                fallback_redactor = PIIRedactor(other_categories)
+                fallback_redactor.counts = self.counts
+            self._fallback_redactors[category] = fallback_redactor
+        return self._fallback_redactors[category]
+
+    def _substitute(self, text, pos, limit, endpos=None, after_match=False):
+        """Redact the PII starting in text[pos:limit] (which ends before the given endpos and starts right after redacted PII if after_match is true) and return the redacted text, the position in the text it ends at (which is after the limit if PII continues past it), and whether PII was redacted right before that position."""
+        redacted_text = []
+        end = pos
+        for start, match_end, match in self.finditer(self.pattern, text, pos, endpos, after_match=after_match):
+            if start >= limit:
+                break
+            redacted_text.append(text[end:start])
+            redacted_text.append(self.replacement(match, self.category(match)))
+            end = match_end
+            after_match = True
+        if end < limit:
+            redacted_text.append(text[end:limit])
+            end = limit
+            after_match = False
+        return ''.join(redacted_text), end, after_match
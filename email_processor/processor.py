@@ -2,14 +2,134 @@
 # -*- coding: utf-8 -*-
 
 from .cleaner import clean_email
-from .formatter import format_email_for_db
+from .formatter import format_email_bytes, format_email_for_db
 from .parse_attachments import parse_attachment
-from .parse_headers import parse_header
-from db import db_creator
+from .parsed_email import ParsedEmail
+from db import blob_store, db_creator
+import analyzer
 from utility import utility
+from utility.metrics import metrics
 from totalemail import settings
 
 
+def _format_email(email_text):
+    """Format the given email text (which can be a str or the raw bytes of an email) and return the formatted text and its hash. The hash of raw utf-8 bytes is found from the formatted bytes so that the formatted text does not have to be encoded again (and the formatted bytes are what is counted as processed in the metrics)."""
+    with metrics.timer('format'):
+        if isinstance(email_text, (bytes, bytearray)):
+            formatted_data, formatted_text = format_email_bytes(email_text)
+        else:
+            formatted_data, formatted_text = None, format_email_for_db(email_text)
+
+    with metrics.timer('hash'):
+        if formatted_data is None:
+            formatted_data = formatted_text.encode('utf-8')
+        email_hash = utility.sha256(formatted_data)
+
+    metrics.record_email(len(formatted_data))
+    return formatted_text, email_hash
+
+
+def _is_stored_elsewhere(part):
+    """Return whether the text of the given part of an email is kept with its own row (and is not needed in the searchable text of the email): the payloads of attachments and of base64 encoded or large bodies are."""
+    if part.get_content_disposition() == 'attachment':
+        return True
+    if str(part.get('Content-Transfer-Encoding', '')).strip().lower() == 'base64':
+        return True
+    return len(part.get_payload()) > blob_store.BLOB_STORE_THRESHOLD
+
+
+def searchable_email_text(parsed_email):
+    """Return the text of the given email which is kept in the database (and matched by text searches) for an email whose full text is stored in the blob store. This is the email without the payloads of its attachments and of its base64 encoded or large bodies (whose text is kept with the attachments and bodies) and is cut off at BLOB_STORE_THRESHOLD characters so that the email's row never has a second copy of most of a large email."""
+    email_text = parsed_email.text
+    pieces = []
+    length = 0
+    start = 0
+    for part in parsed_email.message.walk():
+        # the rest of the email is cut off anyway
+        if length >= blob_store.BLOB_STORE_THRESHOLD:
+            break
+        payload = part.get_payload()
+        if not isinstance(payload, str) or not payload or not _is_stored_elsewhere(part):
+            continue
+        # the parts are walked in the order they are in the email, so each payload is found after the previous one
+        payload_start = email_text.find(payload, start)
+        if payload_start == -1:
+            continue
+        pieces.append(email_text[start:payload_start])
+        length += payload_start - start
+        start = payload_start + len(payload)
+    pieces.append(email_text[start : start + blob_store.BLOB_STORE_THRESHOLD])
+    return ''.join(pieces)[: blob_store.BLOB_STORE_THRESHOLD]
+
+
+def _prepare_formatted_email(email_text, original_sha256, redact_email_data, redaction_values, redact_pii):
+    """Clean and parse the (already formatted) email text."""
+    cleaned_sha256 = original_sha256
+
+    # parse (the parsed email is shared by all of the steps below so the email text is only parsed once)
+    parsed_email = ParsedEmail(email_text)
+
+    # clean
+    if redact_email_data or redaction_values:
+        with metrics.timer('clean'):
+            email_text = clean_email(parsed_email, redaction_values, redact_pii=redact_pii)
+            cleaned_sha256 = utility.sha256(email_text)
+            # only re-parse the email if the cleaning changed it
+            if email_text != parsed_email.text:
+                parsed_email = ParsedEmail(email_text)
+
+    # the email is parsed when its header is first read
+    with metrics.timer('parse_header'):
+        header = parsed_email.header
+
+    # if there are no headers in the email, it is not an email
+    if header == []:
+        return None
+
+    with metrics.timer('parse_bodies'):
+        structure = parsed_email.structure
+        bodies = []
+        for body in parsed_email.bodies:
+            bodies.append(
+                {
+                    'payload': body.get_payload(),
+                    'content_type': body.get_content_type(),
+                    # determine whether or not this body is base64 encoded
+                    'decode_as_base64': body.get('Content-Transfer-Encoding', '').lower() == 'base64',
+                }
+            )
+
+    with metrics.timer('parse_attachments'):
+        attachments = [parse_attachment(attachment) for attachment in parsed_email.attachments]
+
+    # the full text of large emails is stored in the blob store (see `db.db_creator.create_email`)
+    searchable_text = None
+    if len(email_text) > blob_store.BLOB_STORE_THRESHOLD:
+        searchable_text = searchable_email_text(parsed_email)
+
+    return {
+        'full_text': email_text,
+        'searchable_text': searchable_text,
+        'original_sha256': original_sha256,
+        'cleaned_sha256': cleaned_sha256,
+        'header': header,
+        'structure': structure,
+        'bodies': bodies,
+        'attachments': attachments,
+    }
+
+
+def prepare_email(email_text, redact_email_data=False, redaction_values=None, redact_pii=False):
+    """Format, hash, clean, and parse the email text (which can be a str or the raw bytes of an email) into the data needed to create the email in the database (this does not touch the database). Returns None if the text is not an email."""
+    if not email_text:
+        return None
+
+    # format and hash
+    email_text, original_sha256 = _format_email(email_text)
+
+    return _prepare_formatted_email(email_text, original_sha256, redact_email_data, redaction_values, redact_pii)
+
+
 def process_email(
     email_text,
     request_details,
@@ -18,70 +138,137 @@ def process_email(
     redaction_values=None,
     redact_pii=False,
 ):
-    """Process the email text into a form that is ready for the database."""
-    if email_text == '':
+    """Process the email text (which can be a str or the raw bytes of an email) into a form that is ready for the database."""
+    if not email_text:
         return None
 
-    processed_request_data = settings._process_request_data(request_details)
+    # the stages of processing the email are timed when the metrics are enabled (see `utility.metrics`)
+    with metrics.submission():
+        return _process_email(
+            email_text, request_details, redact_email_data, perform_external_analysis, redaction_values, redact_pii
+        )
 
-    # format
-    email_text = format_email_for_db(email_text)
 
-    # hash
-    original_sha256 = utility.sha256(email_text)
-    cleaned_sha256 = original_sha256
-
-    # clean
-    if redact_email_data or redaction_values:
-        email_text = clean_email(email_text, redaction_values, redact_pii=redact_pii)
-        cleaned_sha256 = utility.sha256(email_text)
+def _process_email(
+    email_text, request_details, redact_email_data, perform_external_analysis, redaction_values, redact_pii
+):
+    """Process the email text and create it in the database (see `process_email`)."""
+    processed_request_data = settings._process_request_data(request_details)
 
-    # parse and create headers
-    header_json = parse_header(email_text)
+    prepared_email = prepare_email(
+        email_text, redact_email_data=redact_email_data, redaction_values=redaction_values, redact_pii=redact_pii
+    )
 
     # if there are no headers in the email, abort the import and return None
-    if header_json == []:
+    if prepared_email is None:
         return None
 
-    email_header = db_creator.create_header(
-        header_json, original_sha256, perform_external_analysis=perform_external_analysis
-    )
+    original_sha256 = prepared_email['original_sha256']
 
-    email_structure = utility.email_structure(email_text)
+    # queue all of the analysis requests for this email together
+    with analyzer.external_analysis.batch():
+        with metrics.timer('create_header'):
+            email_header = db_creator.create_header(
+                prepared_email['header'], original_sha256, perform_external_analysis=perform_external_analysis
+            )
 
-    bodies = utility.email_bodies_as_objects(email_text)
-    body_objects = []
-    for body in bodies:
-        # determine whether or not this body is base64 encoded
-        decode_body_as_base64 = body.get('Content-Transfer-Encoding', '').lower() == 'base64'
+        body_objects = []
+        with metrics.timer('create_bodies'):
+            for body in prepared_email['bodies']:
+                new_body = db_creator.create_body(
+                    body['payload'],
+                    body['content_type'],
+                    original_sha256,
+                    perform_external_analysis=perform_external_analysis,
+                    decode_body_as_base64=body['decode_as_base64'],
+                )
+                body_objects.append(new_body)
 
-        new_body = db_creator.create_body(
-            body.get_payload(),
-            body.get_content_type(),
-            original_sha256,
-            perform_external_analysis=perform_external_analysis,
-            decode_body_as_base64=decode_body_as_base64,
-        )
-        body_objects.append(new_body)
-
-    attachments = utility.email_attachments(email_text)
-    attachment_objects = []
-    for attachment in attachments:
-        new_attachment_data = parse_attachment(attachment)
-        new_attachment = db_creator.create_attachment(new_attachment_data)
-        attachment_objects.append(new_attachment)
-
-    # create email
-    new_email = db_creator.create_email(
-        email_text,
-        original_sha256,
-        cleaned_sha256,
-        processed_request_data,
-        email_structure,
-        email_header,
-        body_objects,
-        attachment_objects,
-        perform_external_analysis,
-    )
+        attachment_objects = []
+        with metrics.timer('create_attachments'):
+            for new_attachment_data in prepared_email['attachments']:
+                new_attachment = db_creator.create_attachment(new_attachment_data)
+                attachment_objects.append(new_attachment)
+
+        # create email
+        with metrics.timer('create_email'):
+            new_email = db_creator.create_email(
+                prepared_email['full_text'],
+                original_sha256,
+                prepared_email['cleaned_sha256'],
+                processed_request_data,
+                prepared_email['structure'],
+                email_header,
+                body_objects,
+                attachment_objects,
+                perform_external_analysis,
+                searchable_text=prepared_email['searchable_text'],
+            )
 
     return new_email
+
+
+def prepare_emails(
+    email_texts, redact_email_data=False, redaction_values=None, redact_pii=False, update_duplicates=False
+):
+    """Prepare a batch of email texts (see `prepare_email`). Emails which are already in the database or which are repeated in the batch are found (with a single query) before any of the emails are parsed and are not prepared again. Returns a list of the prepared emails and a list with an (email id, status) tuple for each of the given email texts where the status is one of 'created', 'duplicate', or 'invalid' (the email id is None for invalid emails)."""
+    # format and hash all of the emails first so that duplicates are found before any of the emails are parsed
+    formatted_emails = []
+    for email_text in email_texts:
+        if email_text:
+            formatted_emails.append(_format_email(email_text))
+        else:
+            formatted_emails.append((None, None))
+
+    email_ids = [sha256 for text, sha256 in formatted_emails if sha256]
+    if update_duplicates:
+        duplicate_email_ids = db_creator.update_duplicate_emails(email_ids)
+    else:
+        duplicate_email_ids = db_creator.existing_email_ids(email_ids)
+
+    results = []
+    prepared_emails = []
+    seen_email_ids = set(duplicate_email_ids)
+    for email_text, original_sha256 in formatted_emails:
+        if original_sha256 is None:
+            results.append((None, 'invalid'))
+        elif original_sha256 in seen_email_ids:
+            results.append((original_sha256, 'duplicate'))
+        else:
+            prepared_email = _prepare_formatted_email(
+                email_text, original_sha256, redact_email_data, redaction_values, redact_pii
+            )
+            if prepared_email is None:
+                results.append((None, 'invalid'))
+            else:
+                seen_email_ids.add(original_sha256)
+                prepared_emails.append(prepared_email)
+                results.append((original_sha256, 'created'))
+
+    return prepared_emails, results
+
+
+def process_emails(
+    email_texts,
+    request_details,
+    redact_email_data=False,
+    perform_external_analysis=True,
+    redaction_values=None,
+    redact_pii=False,
+):
+    """Process a batch of email texts and create them in the database using a handful of queries for the entire batch. Returns a list with an (email id, status) tuple for each of the given email texts (see `prepare_emails`)."""
+    processed_request_data = settings._process_request_data(request_details)
+
+    with metrics.submission():
+        prepared_emails, results = prepare_emails(
+            email_texts,
+            redact_email_data=redact_email_data,
+            redaction_values=redaction_values,
+            redact_pii=redact_pii,
+            update_duplicates=True,
+        )
+
+        with metrics.timer('bulk_create'):
+            db_creator.bulk_create_emails(prepared_emails, processed_request_data, perform_external_analysis)
+
+    return results
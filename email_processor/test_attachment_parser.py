@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import base64
+import hashlib
+import io
+import quopri
+import uu
+
 from django.test import TestCase
 
+from . import parse_attachments
+from .formatter import format_email_for_db
 from .parse_attachments import parse_attachment
 from test_resources import DefaultTestObject
+from utility import utility
 
 TestData = DefaultTestObject()
 
@@ -27,7 +36,7 @@ class AttachmentParserTest(TestCase):
 
         assert attachment['content_type'] == 'application/octet-stream'
         assert attachment['filename'] == 'image001.png'
-        assert attachment['full_text'] != ''
+        assert str(attachment['part']) != ''
         # the hashes below aren't verified from the original file... they are only checking the precision of the algorithm (letting us know if it changes over time) and not the accuracy of the algorithm with respect to the actual true hashes
         assert attachment['id'] == 'f342baa4b4b3501bcb18b0b6b4a9d08dbd85f198e5c4fc921251f3a84d04ed23'
         assert attachment['md5'] == '60be626fbf635fa47608d8ac96be1f39'
@@ -41,7 +50,7 @@ class AttachmentParserTest(TestCase):
 
         assert attachment['content_type'] == 'application/octet-stream'
         assert attachment['filename'] == '111111111111111111.txt'
-        assert attachment['full_text'] != ''
+        assert str(attachment['part']) != ''
         # the hashes below aren't verified from the original file... they are only checking the precision of the algorithm (letting us know if it changes over time) and not the accuracy of the algorithm with respect to the actual true hashes
         assert attachment['id'] == 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
         assert attachment['md5'] == 'd41d8cd98f00b204e9800998ecf8427e'
@@ -60,3 +69,88 @@ class AttachmentParserTest(TestCase):
         assert attachment['md5'] == '7c3a5c2355f0da6475ebd8adb0863eab'
         assert attachment['sha1'] == 'b8f2954d5dd28d43dbf7ed4b5916309d0b45586c'
         assert attachment['id'] == '041638601ea6d06d17c70a563e44c8dd5d852fa8cd857e85b1cedcdda0c5c364'
+
+
+def _attachment(transfer_encoding, payload):
+    """Return the attachment of an email with the given Content-Transfer-Encoding and payload."""
+    email_text = format_email_for_db(
+        'Content-Type: multipart/mixed; boundary="boundary"\n\n--boundary\nContent-Type: text/plain\n\nHi\n--boundary\nContent-Type: application/octet-stream\nContent-Disposition: attachment; filename="file.bin"\nContent-Transfer-Encoding: {}\n\n{}\n--boundary--\n'.format(
+            transfer_encoding, payload
+        )
+    )
+    return utility.email_attachments(utility.email_read(email_text))[0]
+
+
+class AttachmentHashingTests(TestCase):
+    content = bytes(range(256)) * 20 + b'Hello = world\n'
+
+    def assert_hashes(self, attachment_data, content):
+        assert attachment_data['id'] == hashlib.sha256(content).hexdigest()
+        assert attachment_data['md5'] == hashlib.md5(content).hexdigest()
+        assert attachment_data['sha1'] == hashlib.sha1(content).hexdigest()
+        assert attachment_data['size'] == len(content)
+
+    def test_base64_attachment_hashing(self):
+        attachment = _attachment('base64', base64.encodebytes(self.content).decode('ascii'))
+        self.assert_hashes(parse_attachment(attachment), self.content)
+
+    def test_quoted_printable_attachment_hashing(self):
+        attachment = _attachment('quoted-printable', quopri.encodestring(self.content).decode('ascii'))
+        # the line endings in the email are carriage return line feeds
+        self.assert_hashes(parse_attachment(attachment), attachment.get_payload(decode=True))
+
+    def test_uuencoded_attachment_hashing(self):
+        uuencoded_content = io.BytesIO()
+        uu.encode(io.BytesIO(self.content), uuencoded_content, 'file.bin')
+        attachment = _attachment('x-uuencode', uuencoded_content.getvalue().decode('ascii'))
+        self.assert_hashes(parse_attachment(attachment), self.content)
+
+    def test_attachment_hashing_in_small_chunks(self):
+        """Make sure attachments are hashed the same way when their payloads are split into many chunks."""
+        attachments = [
+            _attachment('base64', base64.encodebytes(self.content).decode('ascii')),
+            _attachment('quoted-printable', quopri.encodestring(self.content).decode('ascii')),
+        ]
+        expected_hashes = [parse_attachment(attachment)['id'] for attachment in attachments]
+
+        original_chunk_size = parse_attachments.HASH_CHUNK_SIZE
+        try:
+            for chunk_size in (1, 2, 3, 5, 77):
+                parse_attachments.HASH_CHUNK_SIZE = chunk_size
+                assert [parse_attachment(attachment)['id'] for attachment in attachments] == expected_hashes
+        finally:
+            parse_attachments.HASH_CHUNK_SIZE = original_chunk_size
+
+    def test_incorrect_padding_hashing(self):
+        """Make sure the payload of an attachment whose base64 cannot be decoded is hashed as it is (without newlines)."""
+        attachment = _attachment('base64', 'aGVsbG8\nxy')
+        assert parse_attachment(attachment)['id'] == hashlib.sha256(b'aGVsbG8\rxy').hexdigest()
+
+
+class AttachmentTextTests(TestCase):
+    def assert_attachment_text(self, attachment):
+        attachment_text = io.StringIO()
+        parse_attachments.write_attachment_text(attachment, attachment_text)
+        assert attachment_text.getvalue() == str(attachment)
+
+    def test_attachment_text(self):
+        """The text of an attachment is written the same way the `email` module writes it."""
+        payload = base64.encodebytes(bytes(range(256)) * 20).decode('ascii')
+        self.assert_attachment_text(_attachment('base64', payload))
+        self.assert_attachment_text(_attachment('base64', payload.replace('\n', '\r\n')))
+        self.assert_attachment_text(_attachment('quoted-printable', 'caf=C3=A9\rbar\r\n' * 100))
+        self.assert_attachment_text(_attachment('7bit', ''))
+
+        original_chunk_size = parse_attachments.HASH_CHUNK_SIZE
+        try:
+            for chunk_size in (1, 2, 3, 77):
+                parse_attachments.HASH_CHUNK_SIZE = chunk_size
+                self.assert_attachment_text(_attachment('base64', payload.replace('\n', '\r\n')))
+        finally:
+            parse_attachments.HASH_CHUNK_SIZE = original_chunk_size
+
+    def test_attached_email_text(self):
+        email_text = format_email_for_db(
+            'Content-Type: multipart/mixed; boundary="boundary"\n\n--boundary\nContent-Type: text/plain\n\nHi\n--boundary\nContent-Type: message/rfc822\nContent-Disposition: attachment\n\nSubject: Attached\n\nHello\n--boundary--\n'
+        )
+        self.assert_attachment_text(utility.email_read(email_text).get_payload()[1])
@@ -423,3 +423,46 @@ foo
 """
     cleaned_email = clean_email(s, redaction_values='Foobar')
     assert 'Foobar' not in cleaned_email
+
+
+def test_redaction_values_applied_once():
+    """Each part of the email is redacted in a single pass, so the redaction text itself is never redacted and empty redaction values are ignored."""
+    s = """Subject: Buy bitcoin now!
+From: Bob Bradbury <bob@gmail.com>
+To: Alice Asimov <alice@gmail.com>
+
+Hi Alice Asimov, the pass is 1234!"""
+    cleaned_email = clean_email(s, redaction_values='1234, ,DAC')
+    assert 'Hi REDACTED, the pass is REDACTED!' in cleaned_email
+    assert 'To: REDACTED <REDACTED>' in cleaned_email
+
+
+def test_redaction_of_plain_text_attachments():
+    s = """Subject: Report
+From: Bob Bradbury <bob@gmail.com>
+To: Alice Asimov <alice@gmail.com>
+Content-Type: multipart/mixed; boundary="000000000000c4860205873c8e43"
+
+--000000000000c4860205873c8e43
+Content-Type: text/plain; charset="UTF-8"
+
+See the attachment.
+
+--000000000000c4860205873c8e43
+Content-Type: text/plain; charset="US-ASCII"; name="notes.txt"
+Content-Disposition: attachment; filename="notes.txt"
+Content-Transfer-Encoding: quoted-printable
+
+The attachment mentions alice@gmail.com and foo.
+--000000000000c4860205873c8e43--
+"""
+    cleaned_email = clean_email(s, redaction_values='foo')
+    assert 'alice@gmail.com' not in cleaned_email
+    assert 'The attachment mentions REDACTED and REDACTED.' in cleaned_email
+
+
+def test_redaction_of_attachment_headers():
+    cleaned_email = clean_email(ATTACHMENT_EMAIL, redaction_values='test.txt')
+    assert 'test.txt' not in cleaned_email
+    assert 'Zm9vYmFyCg==' in cleaned_email
+    assert cleaned_email.count('--000000000000c4860205873c8e43') == 3
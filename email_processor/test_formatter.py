@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 """Test the formatter."""
 
-from .formatter import _decode_text, format_email_for_db, _remove_line_endings
+from .formatter import _decode_text, format_email_bytes, format_email_for_db, _remove_line_endings
 
 
 def test_decode_text():
@@ -45,3 +45,50 @@ def test_line_endings_formatting():
     s3 = 'this is \n just a \n test\n\n'
     formatted = _remove_line_endings(s3)
     assert formatted == 'this is \r\n just a \r\n test\r\n\r\n'
+
+
+def test_null_character_removal():
+    assert format_email_for_db('foo\x00bar\nbaz') == 'foo\r\nbaz\r\n'
+    assert format_email_for_db(b'foo\x00bar\r\nbaz\x00') == 'foo\r\nbaz\r\n'
+
+
+def test_format_bytes():
+    s = 'Subject: café\n\nthis is \r\n just a \r\r\n test\rfoo'
+    formatted_text = 'Subject: café\r\n\r\nthis is \r\n just a \r\r\n test\rfoo\r\n'
+    assert format_email_for_db(s) == formatted_text
+    assert format_email_for_db(s.encode('utf-8')) == formatted_text
+    assert format_email_for_db(memoryview(s.encode('utf-8'))) == formatted_text
+
+    data = bytearray(s.encode('utf-8'))
+    assert format_email_for_db(data) == formatted_text
+    # the given bytes are not changed
+    assert data == bytearray(s.encode('utf-8'))
+
+
+def test_format_bytes_charset_fallback():
+    s = 'Subject: café\nContent-Type: text/plain; charset="iso-8859-1"\n\ncafé'
+    assert format_email_for_db(s.encode('iso-8859-1')) == s.replace('\n', '\r\n') + '\r\n'
+
+    # bytes which cannot be decoded as utf-8 or as the charset declared in the email are replaced
+    s = 'Subject: café\nContent-Type: text/plain; charset="unknown-charset"\n\nfoo'
+    assert format_email_for_db(s.encode('iso-8859-1')) == s.replace('é', '�').replace('\n', '\r\n') + '\r\n'
+
+
+def test_format_bytes_with_incompatible_charset():
+    """An email is not decoded as a declared charset which would garble its header fields."""
+    for charset in ('utf-16', 'utf-32', 'utf-7', 'cp500', 'base64'):
+        data = b'Subject: hi\nContent-Type: text/plain; charset=' + charset.encode('ascii') + b'\n\n\xff\xfeh\x00i\x00'
+        formatted_text = format_email_for_db(data)
+        assert formatted_text.startswith('Subject: hi\r\nContent-Type: text/plain; charset={}\r\n\r\n'.format(charset))
+        assert formatted_text.endswith('\ufffd\ufffdh\r\n')
+
+
+def test_format_email_bytes():
+    formatted_data, formatted_text = format_email_bytes('Subject: café\n\nfoo'.encode('utf-8'))
+    assert formatted_text == 'Subject: café\r\n\r\nfoo\r\n'
+    assert formatted_data == formatted_text.encode('utf-8')
+
+    # the formatted bytes are only returned if they are utf-8
+    formatted_data, formatted_text = format_email_bytes('Subject: café\n\nfoo'.encode('iso-8859-1'))
+    assert formatted_data is None
+    assert formatted_text == 'Subject: caf�\r\n\r\nfoo\r\n'
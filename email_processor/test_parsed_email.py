@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from .parse_headers import parse_header
+from .parsed_email import ParsedEmail
+from utility import utility
+
+ATTACHMENT_EMAIL = """MIME-Version: 1.0
+Subject: =?UTF-8?B?aGkgYWxpY2UgYXNpbW92?=
+From: Bob Bradbury <bob@gmail.com>
+To: Alice Asimov <alice@gmail.com>
+Content-Type: multipart/mixed; boundary="000000000000c4860205873c8e43"
+
+--000000000000c4860205873c8e43
+Content-Type: multipart/alternative; boundary="000000000000c485ff05873c8e41"
+
+--000000000000c485ff05873c8e41
+Content-Type: text/plain; charset="UTF-8"
+
+This foobar is a test
+
+--000000000000c485ff05873c8e41
+Content-Type: text/html; charset="UTF-8"
+
+<div dir="ltr">This foobar is a test</div>
+
+--000000000000c485ff05873c8e41--
+--000000000000c4860205873c8e43
+Content-Type: text/plain; charset="US-ASCII"; name="test.txt"
+Content-Disposition: attachment; filename="test.txt"
+Content-Transfer-Encoding: base64
+X-Attachment-Id: f_juujbxeu0
+Content-ID: <f_juujbxeu0>
+
+Zm9vYmFyCg==
+--000000000000c4860205873c8e43--"""
+
+
+def test_parsed_email_matches_utility_functions():
+    """Make sure the parsed email returns the same data as the individual parsing functions."""
+    parsed_email = ParsedEmail(ATTACHMENT_EMAIL)
+    assert parsed_email.header == parse_header(ATTACHMENT_EMAIL)
+    assert parsed_email.structure == utility.email_structure(ATTACHMENT_EMAIL)
+    assert [body.get_payload() for body in parsed_email.bodies] == [
+        body.get_payload() for body in utility.email_bodies_as_objects(ATTACHMENT_EMAIL)
+    ]
+    assert [attachment.get_filename() for attachment in parsed_email.attachments] == ['test.txt']
+
+
+def test_parsed_email_only_parses_once():
+    parsed_email = ParsedEmail(ATTACHMENT_EMAIL)
+    message = parsed_email.message
+    parsed_email.header
+    parsed_email.structure
+    parsed_email.bodies
+    parsed_email.attachments
+    assert parsed_email.message is message
+
+
+def test_parsed_email_from_text():
+    parsed_email = ParsedEmail(ATTACHMENT_EMAIL)
+    assert ParsedEmail.from_text(parsed_email) is parsed_email
+    assert ParsedEmail.from_text(ATTACHMENT_EMAIL).text == ATTACHMENT_EMAIL
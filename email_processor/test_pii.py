@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from .cleaner import clean_email
+from .pii import PII_PATTERNS, PIIRedactor
+
+PII_TEXT = '''Call 1 (800) 123-4567 or write to billing@example.com about SSN 123-45-6789.
+The card 4111 1111 1111 1111 (but not the order number 4111 1111 1111 1112) and the account GB82 WEST 1234 5698 7654 32 will be charged on Wed, 08 May 2019 03:44:37 -0400.
+'''
+
+
+def test_pii_redaction():
+    redactor = PIIRedactor(tuple(PII_PATTERNS))
+    assert (
+        redactor.redact(PII_TEXT)
+        == '''Call 1 REDACTED or write to REDACTED about SSN REDACTED.
+The card REDACTED (but not the order number 4111 1111 1111 1112) and the account REDACTED will be charged on Wed, 08 May 2019 03:44:37 -0400.
+'''
+    )
+    assert redactor.counts == {'ssn': 1, 'phone_number': 1, 'credit_card': 1, 'iban': 1, 'email_address': 1}
+
+
+def test_pii_redaction_categories():
+    redactor = PIIRedactor()
+    assert 'billing@example.com' in redactor.redact(PII_TEXT)
+    assert 'email_address' not in redactor.counts
+
+    with pytest.raises(ValueError):
+        PIIRedactor(('ssn', 'passport_number'))
+
+
+def test_pii_redaction_in_chunks():
+    """PII which is split between chunks is still redacted."""
+    text = PII_TEXT * 20
+    expected_text = PIIRedactor(tuple(PII_PATTERNS)).redact(text)
+    for chunk_size in (1, 10, 100, 1000):
+        redactor = PIIRedactor(tuple(PII_PATTERNS))
+        chunks = (text[index : index + chunk_size] for index in range(0, len(text), chunk_size))
+        assert ''.join(redactor.redact_chunks(chunks)) == expected_text
+        assert redactor.counts['credit_card'] == 20
+
+
+def test_email_pii_redaction_counts():
+    s = """Subject: Your card
+From: Bob Bradbury <bob@gmail.com>
+To: Alice Asimov <alice@gmail.com>
+
+Your card 4111 1111 1111 1111 and your SSN 123-45-6789.
+"""
+    redactor = PIIRedactor()
+    cleaned_email = clean_email(s, redact_pii=True, pii_redactor=redactor)
+    assert 'Your card REDACTED and your SSN REDACTED.' in cleaned_email
+    assert 'From: Bob Bradbury <bob@gmail.com>' in cleaned_email
+    assert redactor.counts == {'credit_card': 1, 'ssn': 1}
+
+
+def test_pii_in_digits_which_are_not_a_credit_card_number():
+    """The PII in a run of digits which looks like a credit card number but fails its checksum is still redacted."""
+    s = """Subject: Your reference
+From: Bob Bradbury <bob@gmail.com>
+To: Alice Asimov <alice@gmail.com>
+
+ref 0000 123-45-6789 1111 call 12 555-123-4567 89
+"""
+    redactor = PIIRedactor()
+    cleaned_email = clean_email(s, redact_pii=True, pii_redactor=redactor)
+    assert 'ref 0000 REDACTED 1111 call 12 REDACTED 89' in cleaned_email
+    assert redactor.counts == {'ssn': 1, 'phone_number': 1}
+
+    redactor = PIIRedactor()
+    assert redactor.redact('0000 123-45-6789 1111') == '0000 REDACTED 1111'
+    chunks = ('ref 0000 123-4', '5-6789 1111 call 12 555-12', '3-4567 89')
+    assert ''.join(redactor.redact_chunks(chunks)) == 'ref 0000 REDACTED 1111 call 12 REDACTED 89'
+
+
+def test_pii_right_after_other_pii():
+    """PII right after other PII is redacted as it would be after the other PII has been redacted (the lookbehinds of the patterns do not see the text which is replaced)."""
+    text = 'SSN 123-45-6789(800) 123-4567 and REDACTED123-45-6789555.123.4567 or 555-123-4567555-123-4567.'
+    expected_text = 'SSN REDACTEDREDACTED and REDACTEDREDACTEDREDACTED or REDACTEDREDACTED.'
+    redactor = PIIRedactor()
+    assert redactor.redact(text) == expected_text
+    assert redactor.counts == {'ssn': 2, 'phone_number': 4}
+    for chunk_size in (1, 10, 100):
+        chunks = (text[index : index + chunk_size] for index in range(0, len(text), chunk_size))
+        assert ''.join(PIIRedactor().redact_chunks(chunks)) == expected_text
+
+    s = """Subject: Your details
+From: Bob Bradbury <bob@gmail.com>
+To: Alice Asimov <alice@gmail.com>
+
+SSN 123-45-6789(800) 123-4567 and account 42555.123.4567
+"""
+    cleaned_email = clean_email(s, redaction_values='account 42', redact_pii=True)
+    assert 'SSN REDACTEDREDACTED and REDACTEDREDACTED' in cleaned_email
@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 """Mappings from search functions to db objects."""
 
-header_search_mappings = {'sub': 'subject', 'to': 'to', 'from': 'from'}
+# the header search functions search the summarized values of the headers (see `db.models.Header.summarize`)
+header_search_mappings = {'sub': 'subject_value', 'to': 'to_value', 'from': 'from_value'}
 
 body_search_mappings = ['bod']
 
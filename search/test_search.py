@@ -4,6 +4,10 @@ import html
 
 from django.test import TestCase
 
+from db import db_creator
+from db.models import Email
+from email_processor import processor
+from . import views
 from .search_mappings import header_search_mappings
 from test_resources import DefaultTestObject
 
@@ -120,6 +124,34 @@ class SearchViewTests(TestCase):
             )
             assert desired_string in str(response.content)
 
+    def test_search_function_header_values(self):
+        """Make sure the header search functions search the summarized values of the headers."""
+        email_text = '''Subject: [SPAM] cheap watches
+X-Spam-Prev-Subject: quarterly report
+From: Carol Chen <carol@gmail.com>
+To: {}dave@gmail.com
+
+Hello!
+'''.format('team@gmail.com, ' * 20)
+        prepared_emails, results = processor.prepare_emails([email_text])
+        db_creator.bulk_create_emails(prepared_emails, 'test', perform_external_analysis=False)
+
+        for query, count in [
+            # the subject is the original subject of an email run through SpamAssassin
+            ('sub(quarterly)', 1),
+            ('sub(watches)', 0),
+            ('from(carol@gmail)', 1),
+            ('from(dave@gmail)', 0),
+            # the whole value is searched (and not only its start)
+            ('to(dave@gmail)', 1),
+            ('to(carol@gmail)', 0),
+        ]:
+            response = self.client.get('/search?q={}'.format(query))
+            if count:
+                assert 'Found 1 email matching "<i>{}</i>"'.format(query) in str(response.content)
+            else:
+                assert 'No results found for "<i>{}</i>"'.format(query) in str(response.content)
+
     def test_search_with_spaces(self):
         # create two emails
         TestData.create_email()
@@ -168,3 +200,68 @@ class SearchViewTests(TestCase):
         response = self.client.get(url)
         print('response {}'.format(str(response.content)))
         assert 'Found 1 email matching "<i>hasAttachment()</i>"' in str(response.content)
+
+    def test_search_vector(self):
+        """Make sure the search vector of an email is created with the email and is used to find the email."""
+        TestData.create_email()
+        assert Email.objects.filter(search_vector__isnull=False).count() == 1
+
+        # the full-text search matches other forms of the words in the email
+        url = '/search?q=GitHub'
+        response = self.client.get(url)
+        assert 'Found 1 email matching "<i>GitHub</i>"' in str(response.content)
+
+    def test_search_pagination(self):
+        """Make sure each page of results continues from the last email of the previous page."""
+        email_texts = ['Subject: paginated email {}\nFrom: bob@gmail.com\n\nHello {}\n'.format(i, i) for i in range(5)]
+        prepared_emails, results = processor.prepare_emails(email_texts)
+        db_creator.bulk_create_emails(prepared_emails, 'test', perform_external_analysis=False)
+
+        original_max_results = views.MAX_RESULTS
+        views.MAX_RESULTS = 2
+        try:
+            # test a search function (ordered by date) and a full-text search (ordered by relevance)
+            for query in ['sub(paginated)', 'paginated hello']:
+                seen_email_ids = []
+                url = '/search?q={}'.format(query)
+                for page_number in range(3):
+                    response = self.client.get(url)
+                    assert response.context['total_result_count'] == 5
+                    seen_email_ids.extend(result['email'].id for result in response.context['results'])
+                    if response.context['next_cursor']:
+                        url = '/search?q={}&after={}'.format(query, response.context['next_cursor'])
+                assert response.context['next_cursor'] is None
+                assert len(seen_email_ids) == len(set(seen_email_ids)) == 5
+        finally:
+            views.MAX_RESULTS = original_max_results
+
+    def test_invalid_search_cursors(self):
+        """Make sure a cursor which is missing a value (or has a value of the wrong type) shows the first page of results rather than failing."""
+        processor.process_email(
+            'Subject: cursor email\nFrom: bob@gmail.com\n\nHello\n', 'test', perform_external_analysis=False
+        )
+        first_seen = '2019-05-08T03:44:37'
+        invalid_cursors = [
+            {'first_seen': first_seen},
+            {'first_seen': first_seen, 'id': 5},
+            {'first_seen': 5, 'id': 'a'},
+            {'first_seen': 'not a date', 'id': 'a'},
+            {'first_seen': '2019-13-45T03:44:37', 'id': 'a'},
+            ['a', 'b'],
+        ]
+        # the full-text search results are also ordered by rank
+        invalid_rank_cursors = [
+            {'first_seen': first_seen, 'id': 'a'},
+            {'rank': '5', 'first_seen': first_seen, 'id': 'a'},
+            {'rank': True, 'first_seen': first_seen, 'id': 'a'},
+        ]
+        for query, cursors in (
+            ('sub(cursor)', invalid_cursors),
+            ('cursor hello', invalid_cursors + invalid_rank_cursors),
+        ):
+            for cursor in cursors:
+                response = self.client.get('/search?q={}&after={}'.format(query, views._encode_cursor(cursor)))
+                assert response.status_code == 200
+                assert len(response.context['results']) == 1
+            response = self.client.get('/search?q={}&after=garbage'.format(query))
+            assert len(response.context['results']) == 1
@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import base64
+import json
 import re
 
 from django.shortcuts import render
 from django.views.generic.base import TemplateView
 from django.contrib import messages
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import Case, CharField, ExpressionWrapper, F, FloatField, IntegerField, Q, Value, When
+from django.db.models.functions import Cast, Coalesce
+from django.utils.dateparse import parse_datetime
 
-from db.models import Email
+from db.models import Email, Header, SEARCH_CONFIG
 from .search_mappings import (
     header_search_mappings,
     body_search_mappings,
@@ -15,23 +22,111 @@ from .search_mappings import (
     attachment_search_mappings,
 )
 from totalemail.settings import _validate_search_query, MAX_RESULTS
-from utility import utility
 
 SEARCH_PATTERN_REGEX = '(\w*\(.*?\))'
 
-
-def _add_email_results(existing_email_list, new_emails, search_query):
-    unique_new_emails = []
-    existing_email_ids = [email['email'].id for email in existing_email_list]
-
-    for email in new_emails:
-        if email.id not in existing_email_ids:
-            unique_new_emails.append(
-                {'email': email, 'search_query': search_query, 'score': utility.email_score_calculate(email)}
-            )
-            existing_email_ids.append(email.id)
-
-    return unique_new_emails
+# the number of (integer) steps in the rank of a full-text search result
+RANK_PRECISION = 1000000
+# if the database estimates that there are more emails than this, the estimate is displayed rather than counting the emails
+ESTIMATED_COUNT_THRESHOLD = 100000
+# the only fields of the emails (and their headers) which are read to display the search results (the full text of the emails and the data of their headers are never displayed)
+SEARCH_RESULT_FIELDS = ('id', 'first_seen', 'score', 'header', 'header__subject_value', 'header__has_subject')
+# the type of the value of each field which can be in a pagination cursor (the first seen date is an ISO formatted string)
+CURSOR_VALUE_TYPES = {'rank': int, 'first_seen': str, 'id': str}
+
+
+def _email_results(emails):
+    """Return the search results for the given emails."""
+    return [{'email': email, 'search_query': email.search_query, 'score': email.score} for email in emails]
+
+
+def _email_count():
+    """Return the number of emails. For large tables, this is the database's estimate (counting every row of a large table is slow)."""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [Email._meta.db_table])
+        row = cursor.fetchone()
+    if row and row[0] > ESTIMATED_COUNT_THRESHOLD:
+        return int(row[0])
+    return Email.objects.count()
+
+
+def _text_search_filter(query_string):
+    """Return the filter and the search query for emails matching the given text. Emails match if their header values or body text match the text as a full-text query (using the indexed search vector) or if the email contains the text (using the trigram index)."""
+    search_query = SearchQuery(query_string, config=SEARCH_CONFIG)
+    return Q(search_vector=search_query) | Q(full_text__icontains=query_string), search_query
+
+
+def _function_filter(function, search):
+    """Return the filter for emails matching the given search function (or None if the function is not a search function). Each filter matches every email at most once so that the filters can be combined."""
+    if function in header_search_mappings:
+        # the first value of the header key is searched (using the trigram index of its column)
+        return Q(**{'header__{}__icontains'.format(header_search_mappings[function]): search})
+    elif function in body_search_mappings:
+        if function == 'bod':
+            matching_emails = Email.bodies.through.objects.filter(
+                Q(body__full_text__icontains=search) | Q(body__decoded_text__icontains=search)
+            ).values('email')
+            return Q(pk__in=matching_emails)
+    elif function in network_data_search_mappings:
+        header_filter = Q(header__in=Header.objects.filter(host__host_name__icontains=search).values('pk'))
+        body_filter = Q(
+            pk__in=Email.bodies.through.objects.filter(body__host__host_name__icontains=search).values('email')
+        )
+        # find emails with the domain
+        if function == 'dom':
+            return header_filter | body_filter
+        # find emails with the domain in the header
+        elif function == 'domh':
+            return header_filter
+        # find emails with the domain in the body
+        elif function == 'domb':
+            return body_filter
+    elif function in attachment_search_mappings:
+        if function == 'hasAttachment':
+            return Q(pk__in=Email.attachments.through.objects.values('email'))
+    return None
+
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('utf-8')
+
+
+def _decode_cursor(cursor, ordering):
+    """Return the values of the fields in the given ordering from the given cursor (or None if the cursor is not valid for the ordering)."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, dict):
+        return None
+
+    for field_name in ordering:
+        value = values.get(field_name)
+        # bools are ints in python, so they are checked for separately
+        if not isinstance(value, CURSOR_VALUE_TYPES[field_name]) or isinstance(value, bool):
+            return None
+
+    try:
+        first_seen = parse_datetime(values['first_seen'])
+    except ValueError:
+        return None
+    if first_seen is None:
+        return None
+
+    cursor_values = {field_name: values[field_name] for field_name in ordering}
+    cursor_values['first_seen'] = first_seen
+    return cursor_values
+
+
+def _keyset_filter(ordering, cursor_values):
+    """Return the filter for the emails which come after the cursor in the given (descending) ordering."""
+    keyset_filter = Q()
+    for index, field_name in enumerate(ordering):
+        field_filter = Q(**{'{}__lt'.format(field_name): cursor_values[field_name]})
+        for previous_field_name in ordering[:index]:
+            field_filter &= Q(**{previous_field_name: cursor_values[previous_field_name]})
+        keyset_filter |= field_filter
+    return keyset_filter
 
 
 class IndexSearchView(TemplateView):
@@ -40,8 +135,7 @@ class IndexSearchView(TemplateView):
     def get(self, request):
         """Handle get requests."""
         template_name = "search/search_index.html"
-        all_email_objects = Email.objects.all()
-        total_email_count = len(all_email_objects)
+        total_email_count = _email_count()
         query_string = request.GET.get("q")
         original_query_string = query_string
         if query_string:
@@ -49,7 +143,9 @@ class IndexSearchView(TemplateView):
                 messages.info(request, 'Please enter a search term that is 3 characters or longer')
                 return render(request, template_name, {'q': query_string})
 
-            emails = list()
+            # the filters for each part of the search and the query which is displayed with the emails matching each part
+            search_filters = list()
+            search_query = None
 
             _validate_search_query(query_string)
 
@@ -63,66 +159,85 @@ class IndexSearchView(TemplateView):
                 function = query.split('(')[0]
                 # find the search value of the custom query (we are joining on '(' in case the query has a '(' in it)
                 search = '('.join(query.split('(')[1:]).lower().strip(')')
-                function_found = False
-
-                if function in header_search_mappings:
-                    function_found = True
-                    results = [
-                        email
-                        for email in all_email_objects.order_by('-first_seen')
-                        if email.header.header_value_contains(header_search_mappings[function])
-                    ]
-                    emails.extend(_add_email_results(emails, results, query))
-                elif function in body_search_mappings:
-                    function_found = True
-                    if function == 'bod':
-                        results = Email.objects.filter(bodies__full_text__icontains=search).order_by('-first_seen')
-                        emails.extend(_add_email_results(emails, results, query))
-                elif function in network_data_search_mappings:
-                    function_found = True
-                    # find emails with the domain
-                    if function == 'dom':
-                        results = Email.objects.filter(header__host__host_name__icontains=search).order_by(
-                            '-first_seen'
-                        )
-                        emails.extend(_add_email_results(emails, results, query))
-                        results = Email.objects.filter(bodies__host__host_name__icontains=search).order_by(
-                            '-first_seen'
-                        )
-                    # find emails with the domain in the header
-                    elif function == 'domh':
-                        results = Email.objects.filter(header__host__host_name__icontains=search).order_by(
-                            '-first_seen'
-                        )
-                    # find emails with the domain in the body
-                    elif function == 'domb':
-                        results = Email.objects.filter(bodies__host__host_name__icontains=search).order_by(
-                            '-first_seen'
-                        )
-                    emails.extend(_add_email_results(emails, results, query))
-                elif function in attachment_search_mappings:
-                    function_found = True
-                    if function == 'hasAttachment':
-                        results = Email.objects.filter(attachments__isnull=False).order_by('-first_seen')
-                    emails.extend(_add_email_results(emails, results, query))
-
-                if function_found:
+                function_filter = _function_filter(function, search)
+
+                if function_filter is not None:
+                    search_filters.append((function_filter, query))
                     # remove the query from the full search query
                     query_string = query_string.replace(query, '')
 
             query_string = query_string.strip()
             if query_string:
                 # search for the remaining query (which has the queries with custom functions removed)
-                results = Email.objects.filter(full_text__icontains=query_string).order_by('-first_seen')
-                emails.extend(_add_email_results(emails, results, query_string))
+                text_filter, search_query = _text_search_filter(query_string)
+                search_filters.append((text_filter, query_string))
+
+            combined_filter = Q()
+            for search_filter, query in search_filters:
+                combined_filter |= search_filter
+            results = Email.objects.filter(combined_filter)
+            total_result_count = results.count()
+
+            # results are paginated using the values of the last email on the previous page (rather than an offset) so that each page is found using the index
+            if search_query is not None:
+                # full-text searches are ordered by relevance
+                # the rank is stored as an integer so that the values in the cursor are exact
+                results = results.annotate(
+                    rank=Coalesce(
+                        Cast(
+                            ExpressionWrapper(
+                                SearchRank(F('search_vector'), search_query) * Value(RANK_PRECISION),
+                                output_field=FloatField(),
+                            ),
+                            IntegerField(),
+                        ),
+                        Value(0),
+                    )
+                )
+                ordering = ['rank', 'first_seen', 'id']
+            else:
+                ordering = ['first_seen', 'id']
+
+            # an invalid cursor shows the first page of results
+            cursor_values = _decode_cursor(request.GET.get('after', ''), ordering)
+            if cursor_values is not None:
+                results = results.filter(_keyset_filter(ordering, cursor_values))
+
+            # record which part of the search each email matched
+            results = results.annotate(
+                search_query=Case(
+                    *[When(search_filter, then=Value(query)) for search_filter, query in search_filters],
+                    output_field=CharField()
+                )
+            )
+
+            page = list(
+                results.select_related('header')
+                .only(*SEARCH_RESULT_FIELDS)
+                .order_by(*['-{}'.format(field_name) for field_name in ordering])[: MAX_RESULTS + 1]
+            )
+            next_cursor = None
+            if len(page) > MAX_RESULTS:
+                page = page[:MAX_RESULTS]
+                last_email = page[-1]
+                next_cursor = _encode_cursor(
+                    {
+                        field_name: getattr(last_email, field_name).isoformat()
+                        if field_name == 'first_seen'
+                        else getattr(last_email, field_name)
+                        for field_name in ordering
+                    }
+                )
 
             return render(
                 request,
                 template_name,
                 {
                     "max_results": MAX_RESULTS,
-                    "total_result_count": len(emails),
-                    "results": emails[:MAX_RESULTS],
+                    "total_result_count": total_result_count,
+                    "results": _email_results(page),
+                    "next_cursor": next_cursor,
+                    "after": request.GET.get('after'),
                     "q": original_query_string,
                     "total_email_count": total_email_count,
                 },
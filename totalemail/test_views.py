@@ -4,11 +4,14 @@
 import html
 import os
 
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase
 
 from db.models import Email
 from test_resources import DefaultTestObject
 from utility import utility
+from utility.metrics import metrics
+from totalemail import views
 
 TestData = DefaultTestObject()
 
@@ -135,6 +138,49 @@ REDACTED
         assert Email.objects.get(id=utility.sha256(TestData.email_text.replace('\n', '\r\n')))
         assert Email.objects.get(id=utility.sha256(TestData.single_attachment_email_text.replace('\n', '\r\n')))
 
+    def test_save_view_with_non_utf8_file_upload(self):
+        s = 'Subject: Coffee\nFrom: Bob Bradbury <bob@gmail.com>\nTo: Alice Asimov <alice@gmail.com>\nContent-Type: text/plain; charset="iso-8859-1"\n\nUn café ?\n'
+        email_file = SimpleUploadedFile('cafe.eml', s.encode('iso-8859-1'))
+        response = self.client.post('/save/', {'email_file': [email_file]})
+
+        formatted_text = s.replace('\n', '\r\n')
+        assert response.url == '/email/{}'.format(utility.sha256(formatted_text))
+        assert Email.objects.get().full_text == formatted_text
+
+    def test_save_view_with_large_file_upload(self):
+        original_limit = views.EMAIL_FILE_SIZE_LIMIT
+        views.EMAIL_FILE_SIZE_LIMIT = 10
+        try:
+            email_file = SimpleUploadedFile('large.eml', TestData.email_text.encode('utf-8'))
+            response = self.client.post('/save/', {'email_file': [email_file]}, follow=True)
+        finally:
+            views.EMAIL_FILE_SIZE_LIMIT = original_limit
+
+        assert 'That email is too large.' in response.content.decode('utf-8')
+        assert not Email.objects.exists()
+
+    def test_metrics_view(self):
+        original_enabled = metrics.enabled
+        try:
+            metrics.enabled = False
+            disabled_response = self.client.get('/metrics')
+
+            metrics.enabled = True
+            self.client.post('/save/', {'full_text': 'Subject: Hi\nFrom: bob@gmail.com\n\nHi there\n'})
+            response = self.client.get('/metrics')
+        finally:
+            metrics.enabled = original_enabled
+
+        assert disabled_response.status_code == 404
+        assert response.status_code == 200
+        assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+        content = response.content.decode('utf-8')
+        for stage in ('format', 'hash', 'parse_header', 'create_header', 'create_email', 'submission'):
+            assert 'totalemail_stage_duration_seconds_count{{stage="{}"}}'.format(stage) in content
+        assert 'totalemail_details_cache_hits_total' in content
+        assert 'totalemail_analysis_queue_depth' in content
+        assert 'totalemail_analysis_failed_requests' in content
+
     def test_empty_save_without_following_redirect(self):
         response = self.client.post('/save/', {})
         assert response.status_code == 302
@@ -6,6 +6,7 @@ from . import views
 urlpatterns = [
     url(r'^$', views.IndexView.as_view(), name='index'),
     url(r'^save/$', views.save, name='save'),
+    url(r'^metrics$', views.metrics_view, name='metrics'),
     url(r'^api/v1/', include('api.urls')),
     url(r'^about/', views.AboutView.as_view(), name='about'),
     url(r'^email/', include('details.urls')),
@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import traceback
 
 from django.views import generic
 from django.contrib import messages
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import render
 from django.urls import reverse
 
+from analyzer.external_analysis import analysis_queue
+from details import render_cache
 from utility import utility
+from utility.metrics import metrics
 from email_processor.processor import process_email
 from .settings import (
     TOTALEMAIL_VERSION_NUMBER,
@@ -20,6 +24,9 @@ from .settings import (
     _get_request_data,
 )
 
+# the size (in bytes) of the largest email file which can be uploaded (larger files are not read into memory)
+EMAIL_FILE_SIZE_LIMIT = int(os.environ.get('EMAIL_FILE_SIZE_LIMIT', 25 * 1024 * 1024))
+
 
 class IndexView(generic.TemplateView):
     """Display an import page on the landing page."""
@@ -41,24 +48,41 @@ class AboutView(generic.TemplateView):
         return context
 
 
+def _read_email_file(file):
+    """Return the raw bytes of the given uploaded file or None if the file is larger than EMAIL_FILE_SIZE_LIMIT. The file is read in chunks (large uploads are stored in temporary files) so no more than the limit is ever read into memory."""
+    if file.size is not None and file.size > EMAIL_FILE_SIZE_LIMIT:
+        return None
+
+    raw_email = bytearray()
+    for chunk in file.chunks():
+        raw_email += chunk
+        if len(raw_email) > EMAIL_FILE_SIZE_LIMIT:
+            return None
+    return raw_email
+
+
 def save(request):
     """Save an email to the DB."""
-    full_email_texts = []
-
-    # handle files uploaded by user
+    # handle files uploaded by user (the raw bytes of each file are decoded while the email is formatted and each file is only read when it is processed)
     if request.FILES.get('email_file'):
-        for file in request.FILES.getlist('email_file')[:EMAIL_UPLOAD_LIMIT]:
-            raw_email = file.read()
-            full_email_text = raw_email.decode()
-            full_email_texts.append(full_email_text)
+        full_email_texts = (_read_email_file(file) for file in request.FILES.getlist('email_file')[:EMAIL_UPLOAD_LIMIT])
     # handles text input into textarea
     elif request.POST.get('full_text'):
-        full_email_texts.append(request.POST['full_text'])
+        full_email_texts = [request.POST['full_text']]
     else:
         messages.error(request, 'Please upload an email or paste the text of an email to analyze it')
         return HttpResponseRedirect('/')
 
     for full_email_text in full_email_texts:
+        if full_email_text is None:
+            messages.error(
+                request,
+                'That email is too large. Please upload emails which are smaller than {} MB.'.format(
+                    EMAIL_FILE_SIZE_LIMIT // (1024 * 1024)
+                ),
+            )
+            return HttpResponseRedirect('/')
+
         new_email = process_email(
             full_email_text,
             _get_request_data(request),
@@ -77,6 +101,35 @@ def save(request):
     return HttpResponseRedirect(reverse('details:details', args=(new_email.id,)))
 
 
+def metrics_view(request):
+    """Return the metrics of this process in the Prometheus text format (the metrics are only available if they are enabled with the METRICS_ENABLED environment variable)."""
+    if not metrics.enabled:
+        raise Http404('Metrics are not enabled')
+
+    extra_metrics = [
+        (
+            'details_cache_hits_total',
+            'counter',
+            'The details pages whose sections were cached.',
+            render_cache.stats['hits'],
+        ),
+        (
+            'details_cache_misses_total',
+            'counter',
+            'The details pages whose sections were rendered.',
+            render_cache.stats['misses'],
+        ),
+        ('analysis_queue_depth', 'gauge', 'The analysis requests waiting to be sent.', analysis_queue.queue_depth()),
+        (
+            'analysis_failed_requests',
+            'gauge',
+            'The analysis requests which were given up on (and have not been deleted by cleanup_orphans yet).',
+            analysis_queue.failed_count(),
+        ),
+    ]
+    return HttpResponse(metrics.render(extra_metrics), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 def error_404_handler(request):
     """Try redirecting to a lowercased version of a url if the given url has uppercase characters in it."""
     lower_cased_path = request.path.lower()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Time the stages of processing submitted emails and expose the timings (and other processing metrics) in the Prometheus text format."""
+
+import bisect
+import collections
+import logging
+import os
+import threading
+import time
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+logger = logging.getLogger(__name__)
+
+# whether or not the stages of processing emails are timed (the timers do almost nothing when this is off)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+# submissions which take longer than this many seconds are logged with the time each stage took (0 turns the logging off)
+SLOW_SUBMISSION_SECONDS = float(os.environ.get('SLOW_SUBMISSION_SECONDS', 0))
+# the upper bounds (in seconds) of the buckets of the stage duration histograms
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRIC_PREFIX = 'totalemail'
+
+
+class _NullTimer(object):
+    """A timer which does nothing (used when the metrics are disabled)."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _QueryCountingCursor(object):
+    """Wrap a database cursor to count the queries executed with it in the given thread-local state (without logging them like the debug cursor does)."""
+
+    def __init__(self, cursor, local):
+        self._cursor = cursor
+        self._local = local
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._cursor.__exit__(exc_type, exc_value, traceback)
+
+    def callproc(self, *args, **kwargs):
+        self._local.query_count += 1
+        return self._cursor.callproc(*args, **kwargs)
+
+    def execute(self, *args, **kwargs):
+        self._local.query_count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._local.query_count += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+
+class _QueryCountingCursors(object):
+    """Wrap the cursors the given connection makes in this block to count the queries executed with them in the given thread-local state. This is used on versions of django without execute wrappers (which were added in django 2.0), which have no documented way to wrap the cursors of a connection, so the cursor makers of the connection are replaced and the previous ones are put back when the block finishes."""
+
+    CURSOR_MAKER_NAMES = ('make_cursor', 'make_debug_cursor')
+
+    def __init__(self, connection, local):
+        self.connection = connection
+        self.local = local
+
+    def __enter__(self):
+        # the cursor makers set on the connection itself (rather than its class) before this block
+        self.previous_cursor_makers = {
+            method_name: vars(self.connection)[method_name]
+            for method_name in self.CURSOR_MAKER_NAMES
+            if method_name in vars(self.connection)
+        }
+        # the cursors are wrapped whether or not the connection is logging queries (in which case the wrapped cursor is a debug cursor)
+        for method_name in self.CURSOR_MAKER_NAMES:
+            setattr(self.connection, method_name, self._counting_cursor_maker(getattr(self.connection, method_name)))
+        return self
+
+    def _counting_cursor_maker(self, make_cursor):
+        local = self.local
+        return lambda cursor: _QueryCountingCursor(make_cursor(cursor), local)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for method_name in self.CURSOR_MAKER_NAMES:
+            if method_name in self.previous_cursor_makers:
+                setattr(self.connection, method_name, self.previous_cursor_makers[method_name])
+            else:
+                # the methods of the connection's class are used again
+                delattr(self.connection, method_name)
+        return False
+
+
+class Histogram(object):
+    """Count observations in buckets with the given upper bounds (and keep their sum) like a Prometheus histogram."""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the number of observations in each bucket (the last one is for observations larger than all of the bounds)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """Return the number of observations which are less than or equal to each bound (and to +Inf)."""
+        counts = []
+        total = 0
+        for bucket_count in self.bucket_counts:
+            total += bucket_count
+            counts.append(total)
+        return counts
+
+
+class _Timer(object):
+    """Time a stage (and count the queries made during it) and record it in the given metrics when it finishes."""
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start_query_count = self.metrics.query_count()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start_time
+        query_count = None
+        if self.start_query_count is not None:
+            query_count = self.metrics.query_count() - self.start_query_count
+        self.metrics.record_stage(self.stage, duration, query_count)
+        return False
+
+
+class _SubmissionTimer(_Timer):
+    """Time an entire submission (as the "submission" stage), log a breakdown of the stages if it is slow, and count the queries made during it (with an execute wrapper of the connection or, on older versions of django, by wrapping its cursors)."""
+
+    def __init__(self, metrics):
+        super(_SubmissionTimer, self).__init__(metrics, 'submission')
+
+    def __enter__(self):
+        self.metrics._local.breakdown = collections.OrderedDict()
+        self.metrics._local.email_count = 0
+        self.metrics._local.byte_count = 0
+        self.metrics._local.query_count = 0
+        # the connection itself is used (rather than `django.db.connection`, which is a proxy of it) so that the attributes set on it are seen
+        db_connection = connections[DEFAULT_DB_ALIAS]
+        if hasattr(db_connection, 'execute_wrapper'):
+            self.query_counter = db_connection.execute_wrapper(self._count_query)
+        else:
+            self.query_counter = _QueryCountingCursors(db_connection, self.metrics._local)
+        self.query_counter.__enter__()
+        return super(_SubmissionTimer, self).__enter__()
+
+    def _count_query(self, execute, sql, params, many, context):
+        """Count a query executed by the connection (as an execute wrapper, see https://docs.djangoproject.com/en/stable/topics/db/instrumentation/)."""
+        self.metrics._local.query_count += 1
+        return execute(sql, params, many, context)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            super(_SubmissionTimer, self).__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.query_counter.__exit__(exc_type, exc_value, traceback)
+            breakdown = self.metrics._local.breakdown
+            self.metrics._local.breakdown = None
+            self.metrics._local.query_count = None
+
+        self.metrics.increment('submissions')
+        duration = breakdown['submission'][0]
+        if self.metrics.slow_submission_seconds and duration > self.metrics.slow_submission_seconds:
+            self.metrics.increment('slow_submissions')
+            logger.warning(
+                'Slow submission ({:.3f}s, {} emails, {} bytes): {}'.format(
+                    duration,
+                    self.metrics._local.email_count,
+                    self.metrics._local.byte_count,
+                    ', '.join(
+                        '{} {:.3f}s ({} queries)'.format(stage, stage_duration, stage_query_count)
+                        for stage, (stage_duration, stage_query_count) in breakdown.items()
+                        if stage != 'submission'
+                    ),
+                )
+            )
+        return False
+
+
+class Metrics(object):
+    """Collect the duration and number of queries of each stage of processing emails and the number of emails (and bytes) processed in this process."""
+
+    def __init__(self, enabled=METRICS_ENABLED, slow_submission_seconds=SLOW_SUBMISSION_SECONDS):
+        self.enabled = enabled
+        self.slow_submission_seconds = slow_submission_seconds
+        self.stage_durations = collections.OrderedDict()
+        self.stage_queries = collections.Counter()
+        self.counters = collections.Counter(submissions=0, slow_submissions=0, emails=0, bytes=0)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def timer(self, stage):
+        """Return a context manager which times the given stage (or does nothing if the metrics are disabled)."""
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, stage)
+
+    def submission(self):
+        """Return a context manager which times an entire submission (the queries made during it are counted and, if it takes longer than slow_submission_seconds, the time each stage took is logged). Nested submissions are timed as part of the outer submission."""
+        if not self.enabled or getattr(self._local, 'breakdown', None) is not None:
+            return NULL_TIMER
+        return _SubmissionTimer(self)
+
+    def query_count(self):
+        """Return the number of queries made in this thread during the current submission or None if there is not a submission being timed."""
+        return getattr(self._local, 'query_count', None)
+
+    def record_email(self, byte_count):
+        """Count an email (with the given number of bytes) as processed."""
+        if not self.enabled:
+            return
+        self.increment('emails')
+        self.increment('bytes', byte_count)
+        if getattr(self._local, 'breakdown', None) is not None:
+            self._local.email_count += 1
+            self._local.byte_count += byte_count
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def record_stage(self, stage, duration, query_count=None):
+        """Record the duration (and the number of queries) of a stage."""
+        with self._lock:
+            if stage not in self.stage_durations:
+                self.stage_durations[stage] = Histogram()
+            self.stage_durations[stage].observe(duration)
+            if query_count is not None:
+                self.stage_queries[stage] += query_count
+
+        breakdown = getattr(self._local, 'breakdown', None)
+        if breakdown is not None:
+            # a stage which runs more than once in a submission (e.g. once for each body) is shown once with its total duration
+            previous_duration, previous_query_count = breakdown.get(stage, (0, 0))
+            breakdown[stage] = (previous_duration + duration, previous_query_count + (query_count or 0))
+
+    def render(self, extra_metrics=()):
+        """Return the metrics in the Prometheus text format. The extra metrics are (name, type, help text, value) tuples of other counters and gauges to include."""
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            name = '{}_{}'.format(METRIC_PREFIX, name)
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, label_value) for key, label_value in labels)
+                lines.append('{}{}{} {}'.format(name, suffix, '{' + label_text + '}' if labels else '', value))
+
+        with self._lock:
+            histogram_samples = []
+            for stage, histogram in self.stage_durations.items():
+                bounds = [repr(float(bound)) for bound in histogram.buckets] + ['+Inf']
+                for bound, count in zip(bounds, histogram.cumulative_counts()):
+                    histogram_samples.append(('_bucket', (('stage', stage), ('le', bound)), count))
+                histogram_samples.append(('_sum', (('stage', stage),), repr(histogram.sum)))
+                histogram_samples.append(('_count', (('stage', stage),), histogram.count))
+            query_samples = [('', (('stage', stage),), count) for stage, count in self.stage_queries.items()]
+            counters = dict(self.counters)
+
+        add_metric(
+            'stage_duration_seconds',
+            'histogram',
+            'The time spent in each stage of processing emails.',
+            histogram_samples,
+        )
+        add_metric('stage_queries_total', 'counter', 'The database queries made in each stage.', query_samples)
+        add_metric('submissions_total', 'counter', 'The submissions processed.', [('', (), counters['submissions'])])
+        add_metric(
+            'slow_submissions_total',
+            'counter',
+            'The submissions which took longer than SLOW_SUBMISSION_SECONDS.',
+            [('', (), counters['slow_submissions'])],
+        )
+        add_metric('emails_processed_total', 'counter', 'The emails processed.', [('', (), counters['emails'])])
+        add_metric(
+            'processed_bytes_total', 'counter', 'The size of the emails processed.', [('', (), counters['bytes'])]
+        )
+        for name, metric_type, help_text, value in extra_metrics:
+            add_metric(name, metric_type, help_text, [('', (), value)])
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
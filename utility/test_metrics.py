@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test import TestCase
+from django.utils import timezone
+
+from db import db_creator
+from db.models import AnalysisJob, Email
+from email_processor import processor
+from .metrics import Histogram, Metrics, NULL_TIMER
+
+
+class HistogramTests(TestCase):
+    def test_cumulative_counts(self):
+        histogram = Histogram(buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+
+        # the bounds are inclusive
+        assert histogram.cumulative_counts() == [2, 3, 4]
+        assert histogram.sum == 14.5
+        assert histogram.count == 4
+
+
+class MetricsTests(TestCase):
+    def test_disabled_metrics(self):
+        metrics = Metrics(enabled=False)
+        assert metrics.timer('format') is NULL_TIMER
+        assert metrics.submission() is NULL_TIMER
+
+        with metrics.submission():
+            with metrics.timer('format'):
+                metrics.record_email(100)
+
+        assert not metrics.stage_durations
+        assert metrics.counters['emails'] == 0
+        assert metrics.counters['submissions'] == 0
+
+    def test_stage_timing_and_query_counting(self):
+        metrics = Metrics(enabled=True)
+        with metrics.submission():
+            metrics.record_email(100)
+            with metrics.timer('create_email'):
+                Email.objects.count()
+                Email.objects.count()
+            with metrics.timer('format'):
+                pass
+            # the queries are counted without being logged
+            assert not connection.queries_logged
+        # the cursors are not wrapped once the submission is over
+        assert 'make_cursor' not in vars(connections[DEFAULT_DB_ALIAS])
+        assert 'make_debug_cursor' not in vars(connections[DEFAULT_DB_ALIAS])
+
+        assert list(metrics.stage_durations) == ['create_email', 'format', 'submission']
+        assert metrics.stage_durations['create_email'].count == 1
+        assert metrics.stage_queries['create_email'] == 2
+        assert metrics.stage_queries['format'] == 0
+        assert metrics.stage_queries['submission'] == 2
+        assert metrics.counters['emails'] == 1
+        assert metrics.counters['bytes'] == 100
+        assert metrics.counters['submissions'] == 1
+
+    def test_query_counting_restores_the_connection(self):
+        """Make sure the connection is left as it was before the submission (including a cursor maker set on it by something else)."""
+        db_connection = connections[DEFAULT_DB_ALIAS]
+        make_cursor = db_connection.make_cursor
+        db_connection.make_cursor = make_cursor
+        try:
+            metrics = Metrics(enabled=True)
+            with metrics.submission():
+                Email.objects.count()
+            assert vars(db_connection)['make_cursor'] is make_cursor
+            assert 'make_debug_cursor' not in vars(db_connection)
+            assert not getattr(db_connection, 'execute_wrappers', [])
+        finally:
+            del db_connection.make_cursor
+
+        assert metrics.stage_queries['submission'] == 1
+
+    def test_bulk_insert_query_counting(self):
+        metrics = Metrics(enabled=True)
+        now = timezone.now()
+        jobs = [
+            AnalysisJob(route='analysis', item_id=str(index), email_id=str(index), first_seen=now)
+            for index in range(db_creator.BULK_INSERT_PAGE_SIZE + 1)
+        ]
+        with metrics.submission():
+            with metrics.timer('create_email'):
+                db_creator._bulk_insert(AnalysisJob, jobs)
+
+        # each page of the bulk insert is a query
+        assert metrics.stage_queries['create_email'] == 2
+        assert AnalysisJob.objects.count() == db_creator.BULK_INSERT_PAGE_SIZE + 1
+
+    def test_byte_counting(self):
+        original_metrics = processor.metrics
+        processor.metrics = Metrics(enabled=True)
+        try:
+            formatted_text, email_hash = processor._format_email('Subject: Caf\u00e9\n\nHi')
+            assert processor.metrics.counters['bytes'] == len(formatted_text.encode('utf-8'))
+            assert processor.metrics.counters['bytes'] > len(formatted_text)
+
+            formatted_text, email_hash = processor._format_email('Subject: Caf\u00e9\n\nHi'.encode('utf-8'))
+            assert processor.metrics.counters['bytes'] == 2 * len(formatted_text.encode('utf-8'))
+            assert processor.metrics.counters['emails'] == 2
+        finally:
+            processor.metrics = original_metrics
+
+    def test_slow_submission_logging(self):
+        metrics = Metrics(enabled=True, slow_submission_seconds=1e-9)
+        with self.assertLogs('utility.metrics', level='WARNING') as logs:
+            with metrics.submission():
+                metrics.record_email(100)
+                with metrics.timer('create_email'):
+                    Email.objects.count()
+
+        assert metrics.counters['slow_submissions'] == 1
+        assert len(logs.output) == 1
+        assert '1 emails, 100 bytes' in logs.output[0]
+        assert 'create_email' in logs.output[0]
+        assert '(1 queries)' in logs.output[0]
+
+    def test_prometheus_rendering(self):
+        metrics = Metrics(enabled=True)
+        metrics.record_stage('format', 0.002)
+        metrics.record_stage('format', 100)
+        metrics.record_stage('create_email', 0.5, 3)
+        rendered_metrics = metrics.render([('analysis_queue_depth', 'gauge', 'The queue depth.', 7)])
+
+        assert '# TYPE totalemail_stage_duration_seconds histogram\n' in rendered_metrics
+        assert 'totalemail_stage_duration_seconds_bucket{stage="format",le="0.001"} 0\n' in rendered_metrics
+        assert 'totalemail_stage_duration_seconds_bucket{stage="format",le="0.0025"} 1\n' in rendered_metrics
+        assert 'totalemail_stage_duration_seconds_bucket{stage="format",le="+Inf"} 2\n' in rendered_metrics
+        assert 'totalemail_stage_duration_seconds_count{stage="format"} 2\n' in rendered_metrics
+        assert 'totalemail_stage_queries_total{stage="create_email"} 3\n' in rendered_metrics
+        assert '# TYPE totalemail_analysis_queue_depth gauge\ntotalemail_analysis_queue_depth 7\n' in rendered_metrics
@@ -82,6 +82,14 @@ def test_email_attachments():
     assert len(attachments) == 1
 
 
+def test_compiled_weightings():
+    """Make sure the compiled weightings give the same scores as the weighting formulas."""
+    for source_name, function in SOURCE_WEIGHTINGS.items():
+        for score in (0, 0.5, 1, 3):
+            assert _calculate(score, source_name) == eval(function.replace('x', str(float(score))))
+    assert _calculate(0.75, 'unweighted source') == 0.75
+
+
 def test_calculate_1():
     for source_name, function in SOURCE_WEIGHTINGS.items():
         print('\n{}'.format(source_name))
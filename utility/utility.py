@@ -32,11 +32,10 @@ def is_running_locally():
 
 
 def sha256(text):
-    """Find the hash of the given text."""
-    if isinstance(text, bytes):
-        return hashlib.sha256(text).hexdigest()
-    else:
-        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+    """Find the hash of the given text (which can be a str or a bytes-like object)."""
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    return hashlib.sha256(text).hexdigest()
 
 
 def create_alerta_alert(event, severity, text):
@@ -196,33 +195,29 @@ SOURCE_WEIGHTINGS = {
 }
 
 
+def _compile_weighting(score_function):
+    """Compile the given weighting (a formula of `x`) into a function of the score."""
+    return eval('lambda x: {}'.format(score_function))
+
+
+# the weightings are compiled once rather than each time a score is calculated
+SOURCE_WEIGHTING_FUNCTIONS = {source: _compile_weighting(weighting) for source, weighting in SOURCE_WEIGHTINGS.items()}
+
+
 def _calculate(score, source):
     """Calculate the weighted score for the given score."""
-    if SOURCE_WEIGHTINGS.get(source):
-        score_function = SOURCE_WEIGHTINGS[source]
-        score_function = score_function.replace('x', str(score))
-        return eval(score_function)
+    if SOURCE_WEIGHTING_FUNCTIONS.get(source):
+        return SOURCE_WEIGHTING_FUNCTIONS[source](float(score))
     else:
         return score
 
 
-def email_score_calculate(email):
-    """Calculate the score of the email from the email's analysis results."""
-    email_analysis_score_data = {}
-
+def email_score(weighted_scores):
+    """Calculate the score of an email from the (weighted) scores of the most recent analysis from each source."""
     # TODO: factor the suspicious votes into an email's score
 
-    # collect (and create the score) based only on the most recent analysis from each source (ignore older analyses)
-    for analysis in email.analysis_set.all().order_by('-first_seen'):
-        if not email_analysis_score_data.get(analysis.source):
-            email_analysis_score_data[analysis.source] = analysis.score
-
-    values_to_average = []
-    for source, score in email_analysis_score_data.items():
-        values_to_average.append(_calculate(score, source))
-
-    if len(values_to_average) > 0:
-        final_score = sum(values_to_average) / len(values_to_average)
+    if len(weighted_scores) > 0:
+        final_score = sum(float(score) for score in weighted_scores) / len(weighted_scores)
 
         # add a final gut-check to make sure that the final score is with-in the appropriate boundaries
         if final_score > 1:
@@ -236,6 +231,22 @@ def email_score_calculate(email):
     return final_score
 
 
+def email_score_calculate(email):
+    """Calculate the score of the email from the email's analysis results (the score is also stored on the email when analyses are created - see `db.db_creator.update_email_score`)."""
+    email_analysis_score_data = {}
+
+    # collect (and create the score) based only on the most recent analysis from each source (ignore older analyses)
+    for analysis in email.analysis_set.all().order_by('-first_seen'):
+        if not email_analysis_score_data.get(analysis.source):
+            email_analysis_score_data[analysis.source] = analysis.score
+
+    values_to_average = []
+    for source, score in email_analysis_score_data.items():
+        values_to_average.append(_calculate(score, source))
+
+    return email_score(values_to_average)
+
+
 def _string_has_match(regex_list, string):
     """Determine if a string matches any of the regexes in the regex list."""
     for regex in regex_list:
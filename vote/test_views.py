@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from db.models import Header
+from test_resources import DefaultTestObject
+from vote import views
+
+TestData = DefaultTestObject()
+
+EMAIL_TEXT_TEMPLATE = '''Subject: {}
+From: Bob Bradbury <bob@gmail.com>
+To: Alice Asimov <alice@gmail.com>
+
+Hello!
+'''
+
+
+class VoteViewTests(TestCase):
+    def setUp(self):
+        cache.delete(views.VOTE_CANDIDATE_CACHE_KEY)
+        self.emails = [TestData.create_email(EMAIL_TEXT_TEMPLATE.format('Subject {}'.format(i))) for i in range(12)]
+        # headers without a subject are never candidates
+        TestData.create_email('From: Bob Bradbury <bob@gmail.com>\nTo: Alice Asimov <alice@gmail.com>\n\nHello!\n')
+
+    def tearDown(self):
+        cache.delete(views.VOTE_CANDIDATE_CACHE_KEY)
+
+    def test_vote_index_view(self):
+        response = self.client.get('/vote/')
+        assert response.status_code == 200
+        subjects = json.loads(response.context['subjects'])
+        assert len(subjects) == views.MAX_SUBJECTS_DISPLAYED
+        emails_by_header = {email.header.id: email for email in self.emails}
+        for subject in subjects:
+            email = emails_by_header[subject['id']]
+            assert subject['subject'] == email.header.subject
+            assert subject['link'] == '/email/{}#header'.format(email.id)
+
+    def test_vote_candidates(self):
+        with self.assertNumQueries(2):
+            candidates = views.vote_candidates()
+        assert sorted(candidate['subject'] for candidate in candidates) == sorted(
+            'Subject {}'.format(i) for i in range(12)
+        )
+        # the pool of candidates is cached
+        with self.assertNumQueries(0):
+            assert views.vote_candidates() == candidates
+
+    def test_sampled_vote_candidates(self):
+        # the table is sampled if the database estimates that it is large
+        original_header_count_estimate = views._header_count_estimate
+        views._header_count_estimate = lambda: views.SAMPLED_HEADER_THRESHOLD + 1
+        try:
+            candidates = views._vote_candidates()
+        finally:
+            views._header_count_estimate = original_header_count_estimate
+        assert {candidate['id'] for candidate in candidates} <= set(
+            Header.objects.exclude(subject_value='').values_list('id', flat=True)
+        )
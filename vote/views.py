@@ -4,13 +4,84 @@
 import json
 import random
 
+from django.core.cache import cache
+from django.db import connection
 from django.shortcuts import render
 from django.views.generic.base import TemplateView
 from django.contrib import messages
 
-from db.models import Header
+from db.models import Email, Header
 
 MAX_SUBJECTS_DISPLAYED = 10
+# the number of headers in the pool the subjects displayed are sampled from (the pool is cached so that it is not found for every page view)
+VOTE_CANDIDATE_POOL_SIZE = 200
+VOTE_CANDIDATE_CACHE_KEY = 'vote_candidates'
+VOTE_CANDIDATE_CACHE_SECONDS = 60
+# if the database estimates that there are more headers than this, the pool is drawn from a sample of the table's pages rather than by ordering every header randomly
+SAMPLED_HEADER_THRESHOLD = 10000
+# the number of times more headers than are needed which are sampled (some of the sampled headers do not have a subject)
+SAMPLE_OVERSAMPLING = 5
+
+# the id and subject of random headers with a subject and the id of the first email with each header (which is only found for the headers chosen)
+VOTE_CANDIDATES_SQL = '''
+SELECT candidate.{header_id}, candidate.{subject}, (
+    SELECT {email}.{email_id} FROM {email}
+    WHERE {email}.{email_header_id} = candidate.{header_id}
+    ORDER BY {email}.{email_id}
+    LIMIT 1
+) FROM (
+    SELECT {header}.{header_id}, {header}.{subject} FROM {header} {sample}
+    WHERE {header}.{subject} <> ''
+    ORDER BY random()
+    LIMIT %s
+) candidate
+'''
+
+
+def _header_count_estimate():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [Header._meta.db_table])
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def _vote_candidates():
+    """Return a random pool of the subjects (and links to the emails) of headers with a subject using one query. Large tables are sampled by page (using `TABLESAMPLE SYSTEM`) so that the whole table is not read."""
+    sample = ''
+    sample_parameters = []
+    header_count = _header_count_estimate()
+    if header_count > SAMPLED_HEADER_THRESHOLD:
+        sample = 'TABLESAMPLE SYSTEM (%s)'
+        sample_parameters = [min(100.0, 100.0 * VOTE_CANDIDATE_POOL_SIZE * SAMPLE_OVERSAMPLING / header_count)]
+
+    quote_name = connection.ops.quote_name
+    sql = VOTE_CANDIDATES_SQL.format(
+        header=quote_name(Header._meta.db_table),
+        header_id=quote_name(Header._meta.pk.column),
+        subject=quote_name(Header._meta.get_field('subject_value').column),
+        email=quote_name(Email._meta.db_table),
+        email_id=quote_name(Email._meta.pk.column),
+        email_header_id=quote_name(Email._meta.get_field('header').column),
+        sample=sample,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, sample_parameters + [VOTE_CANDIDATE_POOL_SIZE])
+        rows = cursor.fetchall()
+
+    return [
+        {'subject': subject, 'link': '/email/{}#header'.format(email_id), 'id': header_id}
+        for header_id, subject, email_id in rows
+        if email_id
+    ]
+
+
+def vote_candidates():
+    """Return the cached pool of vote candidates (finding a new pool if the cached pool has expired)."""
+    candidates = cache.get(VOTE_CANDIDATE_CACHE_KEY)
+    if candidates is None:
+        candidates = _vote_candidates()
+        cache.set(VOTE_CANDIDATE_CACHE_KEY, candidates, VOTE_CANDIDATE_CACHE_SECONDS)
+    return candidates
 
 
 class IndexView(TemplateView):
@@ -20,12 +91,7 @@ class IndexView(TemplateView):
         """Handle get requests."""
         template_name = 'vote/vote-index.html'
 
-        headers = Header.objects.all()[:100]
-        subject_data = []
-
-        for header in headers:
-            if header.subject != 'N/A':
-                subject_data.append({'subject': header.subject, 'link': '/{}'.format(header.link), 'id': header.id})
+        subject_data = vote_candidates()
 
         if len(subject_data) > MAX_SUBJECTS_DISPLAYED:
             selected_subjects = random.sample(subject_data, MAX_SUBJECTS_DISPLAYED)